@@ -0,0 +1,378 @@
+'''
+Created on Oct 18, 2026
+Author: George Lifchits
+
+Fixes iTunes tracks unattended, from a job file instead of prompts:
+
+    python batch.py jobs.txt --log results.jsonl --min-confidence 0.8
+
+Each line of the job file is a JSON object: the Discogs release ID (or none,
+to look the release up by album) and the tracks it is for, as a playlist,
+persistent IDs or an album (and artist) to search the library for. Lines
+starting with # are comments.
+
+    {"release": 1491027, "playlist": "Pump Up The Jam"}
+    {"release": 2771174, "persistent_ids": ["5A2C1E9F0B7D3A11", "5A2C1E9F0B7D3A12"]}
+    {"album": "Homework", "artist": "Daft Punk", "min_confidence": 0.9}
+
+A job is written only if every track matched with at least the minimum
+confidence (or, with --partial, only its confident tracks are). Each job
+gets a line in the result log (JSON lines) saying what was done and why.
+'''
+
+from discogs_tracklist import DiscogsTracklist, RealName
+from discogs_api import default_api
+from discovery import ReleaseFinder, ReleaseIndex, normalize
+from itunes import FixerUtilities, WritePlan, connect_to_itunes, snapshot
+from pipeline import Pipeline
+from profiling import profile
+import argparse
+import atexit
+import codecs
+import threading
+import json
+import time
+import sys
+
+SELECTORS = ('playlist', 'persistent_ids', 'album')
+FIELDS = SELECTORS + ('release', 'artist', 'min_confidence')
+
+# ITPlaylistSearchFieldAlbums of the iTunes COM API
+SEARCH_ALBUMS = 3
+
+
+class Job(object):
+    '''
+    One line of a job file: the tracks to fix and the release to fix them from
+    '''
+
+    def __init__(self, line, selector, value, release_id = None, artist = None,
+                 min_confidence = None):
+        self.line = line
+        self.selector = selector
+        self.value = value
+        self.release_id = release_id
+        self.artist = artist
+        self.min_confidence = min_confidence
+
+    def describe(self):
+        described = {self.selector: self.value}
+        if self.artist is not None:
+            described['artist'] = self.artist
+        return described
+
+    def __str__(self):
+        return 'job on line %s' % self.line
+
+
+def parse_job(line, data, path = 'jobs'):
+    '''
+    A Job from the JSON object on :line: of the job file, or ValueError
+    '''
+    if not isinstance(data, dict):
+        raise ValueError('%s line %s: a job is a JSON object' % (path, line))
+    unknown = sorted(set(data) - set(FIELDS))
+    if unknown != []:
+        raise ValueError('%s line %s: unknown fields %s' % (path, line, ', '.join(unknown)))
+    selectors = [selector for selector in SELECTORS if selector in data]
+    if len(selectors) != 1:
+        raise ValueError('%s line %s: needs one of %s' % (path, line, ', '.join(SELECTORS)))
+    selector = selectors[0]
+
+    value = data[selector]
+    if selector != 'persistent_ids' and not isinstance(value, basestring):
+        raise ValueError('%s line %s: %s is a name' % (path, line, selector))
+    if selector == 'persistent_ids':
+        if not isinstance(value, list) or value == []:
+            raise ValueError('%s line %s: persistent_ids is a list of IDs' % (path, line))
+        for persistent_id in value:
+            split_persistent_id(persistent_id, '%s line %s' % (path, line))
+    if 'artist' in data and selector != 'album':
+        raise ValueError('%s line %s: artist only goes with album' % (path, line))
+
+    release_id = data.get('release')
+    if release_id is not None and not isinstance(release_id, int):
+        raise ValueError('%s line %s: release is a Discogs release ID' % (path, line))
+    min_confidence = data.get('min_confidence')
+    if min_confidence is not None and \
+       (not isinstance(min_confidence, (int, float)) or not 0 <= min_confidence <= 1):
+        raise ValueError('%s line %s: min_confidence is between 0 and 1' % (path, line))
+
+    return Job(line, selector, value, release_id, data.get('artist'), min_confidence)
+
+def read_jobs(path):
+    '''
+    Every Job in a job file. The whole file is checked before anything runs.
+    '''
+    f = codecs.open(path, encoding = 'utf-8-sig')
+    try:
+        lines = f.read().split('\n')
+    finally:
+        f.close()
+
+    jobs = []
+    for number, line in enumerate(lines):
+        line = line.strip()
+        if line == '' or line.startswith('#'):
+            continue
+        try:
+            data = json.loads(line)
+        except ValueError, e:
+            raise ValueError('%s line %s: %s' % (path, number + 1, e))
+        jobs.append(parse_job(number + 1, data, path))
+    return jobs
+
+def split_persistent_id(persistent_id, where = 'persistent ID'):
+    '''
+    (high, low) of a persistent ID as iTunes shows it ('5A2C1E9F0B7D3A11'),
+    signed like the COM API wants them
+    '''
+    try:
+        value = int(persistent_id, 16)
+    except (TypeError, ValueError):
+        raise ValueError('%s: %r is not a persistent ID' % (where, persistent_id))
+    if not 0 <= value < 1 << 64:
+        raise ValueError('%s: %r is not a persistent ID' % (where, persistent_id))
+
+    signed = lambda n: n - (1 << 32) if n >= 1 << 31 else n
+    return signed(value >> 32), signed(value & 0xffffffff)
+
+
+class ResultLog(object):
+    '''
+    One JSON object per job, appended to :log_file: as each job finishes
+    '''
+
+    def __init__(self, log_file = None):
+        self.log_file = log_file
+        self.results = []
+
+    def add(self, job, status, release_id = None, error = None, **details):
+        result = {'line': job.line,
+                  'tracks_for': job.describe(),
+                  'release': release_id if release_id is not None else job.release_id,
+                  'status': status,
+                  'error': error,
+                  'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        result.update(details)
+        self.results.append(result)
+
+        if self.log_file is not None:
+            f = open(self.log_file, 'ab')
+            try:
+                f.write(json.dumps(result, sort_keys = True) + '\n')
+            finally:
+                f.close()
+        return result
+
+    def counts(self):
+        counts = {}
+        for result in self.results:
+            counts[result['status']] = counts.get(result['status'], 0) + 1
+        return counts
+
+
+class BatchFixer(object):
+    '''
+    Runs jobs without asking anything. Releases are fetched and matched in
+    a pipeline, like Scanner does; selecting and writing tracks stays in
+    this thread, which the iTunes COM objects belong to.
+
+    Tracks that match with less than :min_confidence: are never written; a
+    job with any such track is left for review, or with :partial: only its
+    confident tracks are written. A release found by album has to score at
+    least :min_score:. A release whose connection fails :attempts: times
+    (:retry_delay: seconds apart) fails its job.
+    '''
+
+    def __init__(self, itunes = None, api = None, real_name = None,
+                 min_confidence = 0.6, partial = False, min_score = 0.75,
+                 dry_run = False, fetchers = 4, queue_size = 2, log_file = None,
+                 attempts = 3, retry_delay = 10):
+        self.iTunes = itunes if itunes is not None else connect_to_itunes()
+        self.api = api if api is not None else default_api()
+        self.real_name = real_name if real_name is not None else RealName(api = self.api)
+        self.min_confidence = min_confidence
+        self.partial = partial
+        self.min_score = min_score
+        self.dry_run = dry_run
+        self.fetchers = fetchers
+        self.queue_size = queue_size
+        self.attempts = attempts
+        self.retry_delay = retry_delay
+        self.log = ResultLog(log_file)
+        self.utils = FixerUtilities()
+        self._finder = None
+        self.finder_lock = threading.Lock()
+
+    @property
+    def finder(self):
+        # the fetch workers all want it: build the index once
+        with self.finder_lock:
+            if self._finder is None:
+                store = self.api.store
+                index = ReleaseIndex.from_store(store) if store is not None else None
+                self._finder = ReleaseFinder(self.api, index)
+        return self._finder
+
+    def select(self, job):
+        '''
+        The iTunes tracks of a job, in disc and track order
+        '''
+        if job.selector == 'playlist':
+            playlist = self.iTunes.LibrarySource.Playlists.ItemByName(job.value)
+            if playlist is None:
+                raise LookupError('no playlist %s' % job.value)
+            tracks = list(playlist.Tracks)
+
+        elif job.selector == 'persistent_ids':
+            library = self.iTunes.LibraryPlaylist.Tracks
+            tracks = []
+            for persistent_id in job.value:
+                track = library.ItemByPersistentID(*split_persistent_id(persistent_id))
+                if track is None:
+                    raise LookupError('no track with persistent ID %s' % persistent_id)
+                tracks.append(track)
+
+        else:
+            found = self.iTunes.LibraryPlaylist.Search(job.value, SEARCH_ALBUMS) or []
+            album = normalize(job.value)
+            artist = normalize(job.artist) if job.artist is not None else None
+            tracks = [track for track in found
+                      if normalize(track.Album) == album and
+                         (artist is None or
+                          artist in (normalize(track.Artist), normalize(track.AlbumArtist)))]
+
+        if tracks == []:
+            raise LookupError('no tracks for %s' % job.describe())
+        tracks.sort(key = lambda track: (track.DiscNumber, track.TrackNumber))
+        return tracks
+
+    def fetch(self, item):
+        job, tracks = item
+        release_id = job.release_id
+        if release_id is None:
+            candidate = self.finder.best([s for track, s in tracks], self.min_score)
+            if candidate is None:
+                raise LookupError('no release scores %.0f%% for %s' %
+                                  (self.min_score * 100, job.describe()))
+            release_id = candidate.release_id
+        return job, tracks, DiscogsTracklist(release_id, build = False, api = self.api,
+                                             real_name = self.real_name)
+
+    def resolve(self, item):
+        job, tracks, discogs = item
+        # a release that keeps failing fails its job instead of holding a worker
+        discogs.max_attempts = self.attempts
+        discogs.retry_delay = self.retry_delay
+        return job, tracks, discogs.release['id'], discogs.get_release_info()
+
+    def match(self, item):
+        job, tracks, release_id, discogs_tracklist = item
+        matched = self.utils.match_tracks([s for track, s in tracks], discogs_tracklist)
+        # back from the snapshots to the iTunes tracks
+        return job, release_id, [(track, d_track, confidence)
+                                 for (track, s), (unused, d_track, confidence)
+                                 in zip(tracks, matched)]
+
+    def write(self, item):
+        job, release_id, matched = item
+        threshold = job.min_confidence if job.min_confidence is not None else self.min_confidence
+        confident = [(track, d_track) for track, d_track, confidence in matched
+                     if d_track is not None and confidence >= threshold]
+        matches = [{'name': track.Name,
+                    'match': d_track.Name if d_track is not None else None,
+                    'confidence': round(confidence, 3)}
+                   for track, d_track, confidence in matched]
+        details = {'tracks': len(matched),
+                   'confident': len(confident),
+                   'min_confidence': threshold,
+                   'matches': matches}
+
+        if len(confident) < len(matched) and not self.partial:
+            self.log.add(job, 'review', release_id,
+                         '%s of %s tracks matched with less than %.0f%% confidence' %
+                         (len(matched) - len(confident), len(matched), threshold * 100),
+                         **details)
+            return
+
+        plan = WritePlan(confident)
+        with profile.timer('write', release_id):
+            plan.read()
+            if not self.dry_run:
+                plan.apply()
+        details.update(changes = plan.count(), writes = plan.writes,
+                       write_failures = plan.failed)
+
+        if self.dry_run:
+            status = 'dry_run'
+        elif plan.failed:
+            status = 'write_failed'
+        elif len(confident) < len(matched):
+            status = 'partial'
+        else:
+            status = 'written'
+        self.log.add(job, status, release_id, **details)
+
+    def run(self, jobs):
+        '''
+        Runs every job and returns the ResultLog
+        '''
+        selected = []
+        for job in jobs:
+            try:
+                tracks = self.select(job)
+            except Exception, e:
+                self.log.add(job, 'failed', error = 'select: %s' % e)
+                continue
+            selected.append((job, [(track, snapshot(track)) for track in tracks]))
+
+        pipeline = Pipeline(self.queue_size)
+        pipeline.stage('fetch', self.fetch, self.fetchers)
+        pipeline.stage('resolve names', self.resolve, self.fetchers)
+        pipeline.stage('match', self.match)
+        failures = pipeline.run(selected, self.write)
+
+        for failure in failures:
+            self.log.add(failure.item[0], 'failed',
+                         error = '%s: %s' % (failure.stage, failure.exc_info[1]))
+        return self.log
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.split('\n\n')[1])
+    parser.add_argument('jobs', help = 'job file: one JSON job per line')
+    parser.add_argument('--log', default = 'batch_results.jsonl',
+                        help = 'result log to append to (JSON lines)')
+    parser.add_argument('--min-confidence', type = float, default = 0.6,
+                        help = 'match confidence a track needs to be written')
+    parser.add_argument('--partial', action = 'store_true',
+                        help = 'write the confident tracks of a job even if others are not')
+    parser.add_argument('--min-score', type = float, default = 0.75,
+                        help = 'score a release found by album needs to be used')
+    parser.add_argument('--dry-run', action = 'store_true', help = 'write nothing')
+    parser.add_argument('--fetchers', type = int, default = 4,
+                        help = 'releases fetched at the same time')
+    parser.add_argument('--attempts', type = int, default = 3,
+                        help = 'connection failures a release gets before its job fails')
+    parser.add_argument('--profile', nargs = '?', const = 'profile.json', metavar = 'FILE',
+                        help = 'at exit, write timings and counters to FILE (profile.json)')
+    args = parser.parse_args()
+    if args.profile is not None:
+        atexit.register(profile.dump, args.profile)
+
+    jobs = read_jobs(args.jobs)
+    fixer = BatchFixer(min_confidence = args.min_confidence, partial = args.partial,
+                       min_score = args.min_score, dry_run = args.dry_run,
+                       fetchers = args.fetchers, log_file = args.log,
+                       attempts = args.attempts)
+    counts = fixer.run(jobs).counts()
+
+    print '%s jobs: %s' % (len(jobs), ', '.join('%s %s' % (count, status)
+                                                for status, count in sorted(counts.items())))
+    print 'results in %s' % args.log
+    sys.exit(0 if set(counts) <= set(['written', 'dry_run']) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,448 @@
+'''
+Created on Oct 18, 2026
+Author: George Lifchits
+
+End-to-end benchmark: builds the tracklists of a set of releases against
+the offline Discogs stand-in (FixtureTransport) and reports wall time and
+request counts, first with an empty cache, then with a warm one.
+
+    python benchmark.py --record     records the fixtures from Discogs, once
+    python benchmark.py              replays them
+    python benchmark.py --latency 0.2 --error-rate 0.05 --throttle-rate 0.01
+    python benchmark.py --concurrency 8 <release IDs>
+
+Without recorded fixtures it replays synthetic releases (see SHAPES)
+instead, so it also runs from a clean checkout.
+
+With --suite it benchmarks the core algorithms instead, on synthetic
+releases (no Discogs, no iTunes): the position and list utilities,
+my_algorithm.similar, TrackMatcher and its Hungarian assignment, and whole
+get_release_info builds of albums, compilations, box sets and heavily
+credited releases. Each is timed at several sizes, which gives its growth
+exponent (1 for linear, 2 for quadratic), and the results are compared
+against the baseline in benchmark_baseline.json. The committed baseline
+only has growth exponents; timings depend on the machine.
+
+    python benchmark.py --suite                     compares against the baseline
+    python benchmark.py --suite --save-baseline     stores a new one
+'''
+
+from discogs_tracklist import DiscogsTracklist, RealName, Utilities
+from itunes import WritePlan
+from matching import TrackMatcher, hungarian
+from builder import TracklistBuilder
+from discogs_api import DiscogsAPI, FixtureTransport, RecordingTransport
+from cache import PersistentCache, PayloadStore
+from profiling import profile
+from contextlib import contextmanager
+import my_algorithm
+import discogs_client as discogs
+import argparse
+import timeit
+import math
+import random
+import tempfile
+import shutil
+import sys
+import time
+import json
+import os
+
+# the releases that have to work (see todo.txt)
+RELEASES = [1491027, 2771174]
+
+BASELINE_FILE = 'benchmark_baseline.json'
+
+# sizes the suite times everything at, to see how the time grows
+SIZES = (10, 30, 100)
+
+# synthetic releases of the suite: (discs, tracks per disc, credits per track)
+SHAPES = {'album': (1, 10, 1),
+          'compilation': (1, 100, 1),
+          'box_set': (20, 12, 1),
+          'credited': (1, 12, 25)}
+
+ROLES = ('Written-By', 'Producer', 'Featuring', 'Mixed By', 'Lyrics By',
+         'Vocals', 'Engineer', 'Music By')
+
+
+def run(release_ids, api, cache_file, concurrency = 1):
+    real_name = RealName(cache = PersistentCache(cache_file), api = api)
+    builder = TracklistBuilder(concurrency, api = api, real_name = real_name,
+                               retry_delay = 0)
+    api.reset_stats()
+
+    start = time.time()
+    tracklists, failures = builder.build_many(release_ids)
+    if failures:
+        raise failures.values()[0]
+
+    result = {'wall_time': time.time() - start,
+              'releases': len(release_ids),
+              'tracks': sum(len(tracklist.discogs_tracklist)
+                            for tracklist in tracklists.values()),
+              'concurrency': concurrency}
+    result.update(api.stats())
+    return result
+
+
+def record(release_ids, fixture_dir, transport = None):
+    '''
+    Builds the releases once through :transport: (Discogs by default),
+    saving everything fetched as fixtures
+    '''
+    temp_dir = tempfile.mkdtemp()
+    try:
+        # only the real Discogs needs the rate limit
+        rate = 1.0 if transport is None else None
+        api = DiscogsAPI(RecordingTransport(fixture_dir, transport), rate = rate)
+        return run(release_ids, api, os.path.join(temp_dir, 'cache.db'))
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def synthetic_releases():
+    '''
+    {release ID: release} of one synthetic release of every shape
+    '''
+    releases = {}
+    for n, shape in enumerate(sorted(SHAPES)):
+        releases[n + 1] = synthetic_release(n + 1, *SHAPES[shape])
+    return releases
+
+
+def benchmark(release_ids, transport, rate = None, concurrency = 1):
+    '''
+    Runs the releases with a cold cache and release store, then again with
+    them warm
+    '''
+    temp_dir = tempfile.mkdtemp()
+    try:
+        cache_file = os.path.join(temp_dir, 'cache.db')
+        store = PayloadStore(os.path.join(temp_dir, 'payloads.db'))
+        api = DiscogsAPI(transport, rate = rate, store = store)
+        cold = run(release_ids, api, cache_file, concurrency)
+        warm = run(release_ids, api, cache_file, concurrency)
+        return {'cold': cold, 'warm': warm}
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def credit(name, role = '', tracks = ''):
+    return {'name': name, 'anv': '', 'join': '', 'role': role, 'tracks': tracks}
+
+def synthetic_release(release_id = 1, discs = 1, tracks = 10, credits = 1):
+    '''
+    A release dict shaped like the API's: :discs: discs of :tracks: tracks,
+    each with its own artist and :credits: credits, and as many release-wide
+    credits scoped to ranges of tracks
+    '''
+    tracklist = []
+    extraartists = []
+    for disc in range(1, discs + 1):
+        if discs > 1:
+            tracklist.append({'position': '', 'title': 'CD %s' % disc}) # index track
+        for number in range(1, tracks + 1):
+            position = '%s-%s' % (disc, number) if discs > 1 else str(number)
+            n = len(tracklist)
+            tracklist.append({
+                'position': position,
+                'title': 'Track %s (Original Mix)' % n,
+                'duration': '%s:%02d' % (3 + n % 4, n % 60),
+                'artists': [credit('Artist %s' % (n % 40))],
+                'extraartists': [credit('Writer %s' % ((n + k) % 60), ROLES[k % len(ROLES)])
+                                 for k in range(credits)]})
+        first = '%s-1' % disc if discs > 1 else '1'
+        last = '%s-%s' % (disc, tracks) if discs > 1 else str(tracks)
+        extraartists += [credit('Credit %s' % ((disc + k) % 60), ROLES[k % len(ROLES)],
+                                '%s to %s' % (first, last))
+                         for k in range(credits)]
+
+    return {'id': release_id, 'title': 'Synthetic %s' % release_id, 'year': 2012,
+            'genres': ['Electronic'], 'styles': ['House'],
+            'labels': [{'name': 'Label (2)', 'catno': 'SYN%s' % release_id}],
+            'artists': [credit('Various')],
+            'extraartists': extraartists,
+            'tracklist': tracklist}
+
+
+class SyntheticTransport(object):
+    '''
+    Transport with the :releases: it is given and a made-up artist for any
+    name, every other one with a real name. Masters are 404s.
+    '''
+
+    def __init__(self, releases):
+        self.releases = releases
+
+    def fetch(self, kind, key):
+        if kind == 'release' and key in self.releases:
+            return self.releases[key]
+        if kind == 'artist':
+            data = {'id': abs(hash(key)) % 100000, 'name': key}
+            if hash(key) % 2:
+                data['realname'] = '%s Realname' % key
+            return data
+        raise discogs.DiscogsAPIError('404 Not Found')
+
+
+class FakeItunesTrack(object):
+    '''
+    Stand-in for an iTunes track, with the fields of a Discogs one
+    '''
+
+    def __init__(self, track, **fields):
+        for d_field, i_field in WritePlan.FIELDS:
+            setattr(self, i_field, getattr(track, d_field))
+        self.__dict__.update(fields)
+
+
+def best_time(function, repeat = 3, min_time = 0.05):
+    '''
+    Seconds per call of function(), the best of :repeat: runs of enough
+    calls to take at least :min_time: (short timings are mostly noise)
+    '''
+    timer = timeit.Timer(function)
+    number = 1
+    while timer.timeit(number) < min_time and number < 10 ** 6:
+        number *= 2
+    return min(timer.repeat(repeat, number)) / number
+
+def build_release(release):
+    '''
+    get_release_info of :release: from scratch: nothing cached
+    '''
+    api = DiscogsAPI(SyntheticTransport({release['id']: release}), rate = None)
+    real_name = RealName(cache = PersistentCache(':memory:'), api = api)
+    tracklist = DiscogsTracklist(release['id'], api = api, real_name = real_name)
+    return tracklist.discogs_tracklist
+
+def match_all(tracks):
+    '''
+    TrackMatcher.match of a synthetic tracklist, as iTunes tracks in
+    reverse order, against the tracklist itself
+    '''
+    itunes_tracks = [FakeItunesTrack(track, Name = track.Name.lower())
+                     for track in reversed(tracks)]
+    return TrackMatcher().match(itunes_tracks, tracks)
+
+def cost_matrix(n, seed = 0):
+    rand = random.Random(seed)
+    return [[rand.random() for j in range(n)] for i in range(n)]
+
+def micro_benchmarks(n):
+    '''
+    {name: function} of the algorithms, on inputs of size :n:
+    '''
+    utils = Utilities()
+    box_set = synthetic_release(discs = max(1, n // 10), tracks = 10)
+    positions = [track['position'] for track in box_set['tracklist']
+                 if track['position'] != '']
+    sides = ['%s%s' % (chr(65 + k % 26), k // 26 + 1) for k in range(n)]
+    names = ['Artist %s' % k for k in range(n)]
+    titles = [track['title'] for track in box_set['tracklist']]
+    with quiet():
+        built = build_release(synthetic_release(tracks = n))
+    costs = cost_matrix(n)
+
+    def track_and_disc():
+        for position in positions + sides:
+            utils.track_and_disc(position)
+
+    return {'track_and_disc': track_and_disc,
+            'compare_track_numbers':
+                lambda: sorted(reversed(positions), cmp = utils.compare_track_numbers),
+            'concat_list': lambda: utils.concat_list(names),
+            'similar': lambda: [my_algorithm.similar(titles[0], title) for title in titles],
+            'match_tracks': lambda: match_all(built),
+            'hungarian': lambda: hungarian(costs)}
+
+def release_benchmarks(n):
+    '''
+    {name: function} of get_release_info builds; the release shapes are
+    scaled to :n: tracks per disc
+    '''
+    benchmarks = {}
+    for shape, (discs, tracks, credits) in SHAPES.items():
+        release = synthetic_release(discs = discs, tracks = max(1, tracks * n // 100),
+                                    credits = credits)
+        benchmarks['get_release_info.' + shape] = \
+            lambda release = release: build_release(release)
+    return benchmarks
+
+@contextmanager
+def quiet():
+    '''
+    Throws away what is printed (progress dots) inside the with block
+    '''
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+def growth_exponent(timings):
+    '''
+    Slope of log(time) against log(size), fitted over {size: seconds}:
+    1 for linear, 2 for quadratic
+    '''
+    points = [(math.log(int(size)), math.log(max(seconds, 1e-9)))
+              for size, seconds in timings.items()]
+    mean_x = sum(x for x, y in points) / len(points)
+    mean_y = sum(y for x, y in points) / len(points)
+    variance = sum((x - mean_x) ** 2 for x, y in points)
+    if variance == 0:
+        return 0.0
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / variance
+
+def suite(sizes = SIZES, repeat = 3):
+    '''
+    Runs every benchmark at every size. Returns
+    {'timings': {name: {size: seconds}},
+     'growth': {name: exponent of the time in the size}}
+    '''
+    timings = {}
+    with quiet():
+        for size_benchmarks in (micro_benchmarks, release_benchmarks):
+            benchmarks = [(size, size_benchmarks(size)) for size in sizes]
+            for name in sorted(benchmarks[0][1]):
+                timings[name] = dict((str(size), best_time(by_name[name], repeat))
+                                     for size, by_name in benchmarks)
+    growth = dict((name, growth_exponent(times)) for name, times in timings.items())
+    return {'timings': timings, 'growth': growth,
+            'sizes': list(sizes), 'repeat': repeat}
+
+def compare(results, baseline, tolerance = 0.25, growth_tolerance = 0.5):
+    '''
+    Regressions against :baseline:, as (name, what, baseline, now) tuples:
+    timings more than :tolerance: slower at any size, and growth exponents
+    more than :growth_tolerance: larger (say, linear turning quadratic).
+    A baseline without timings (they depend on the machine) only checks
+    the growth.
+    '''
+    regressions = []
+    for name, times in sorted(results['timings'].items()):
+        before_times = baseline.get('timings', {}).get(name, {})
+        for size, seconds in sorted(times.items(), key = lambda item: int(item[0])):
+            before = before_times.get(size)
+            if before is not None and seconds > before * (1 + tolerance):
+                regressions.append(('%s@%s' % (name, size), 'timing', before, seconds))
+    for name, exponent in sorted(results['growth'].items()):
+        before = baseline.get('growth', {}).get(name)
+        if before is not None and exponent > before + growth_tolerance:
+            regressions.append((name, 'growth', before, exponent))
+    return regressions
+
+def run_suite(args):
+    '''
+    Prints the results as JSON; everything else goes to stderr
+    '''
+    sizes = [int(size) for size in args.sizes.split(',')]
+    results = suite(sizes, args.repeat)
+    print json.dumps(results, indent = 2, sort_keys = True)
+    if args.output:
+        write_json(args.output, results)
+
+    if args.save_baseline:
+        write_json(args.baseline, results)
+        sys.stderr.write('baseline saved to %s\n' % args.baseline)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        sys.stderr.write('no baseline at %s (--save-baseline stores one)\n' % args.baseline)
+        return 1
+    f = open(args.baseline, 'rb')
+    baseline = json.load(f)
+    f.close()
+
+    regressions = compare(results, baseline, args.tolerance, args.growth_tolerance)
+    for name, what, before, now in regressions:
+        sys.stderr.write('REGRESSION %s %s: %.4g -> %.4g\n' % (name, what, before, now))
+    if regressions == []:
+        sys.stderr.write('no regressions against %s\n' % args.baseline)
+    return 1 if regressions else 0
+
+def write_json(path, data):
+    f = open(path, 'wb')
+    json.dump(data, f, indent = 2, sort_keys = True)
+    f.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.split('\n\n')[1])
+    parser.add_argument('releases', nargs = '*', type = int)
+    parser.add_argument('--fixtures', default = 'fixtures')
+    parser.add_argument('--record', action = 'store_true',
+                        help = 'fetch the releases from Discogs and save them as fixtures')
+    parser.add_argument('--latency', type = float, default = 0.0,
+                        help = 'seconds every request takes')
+    parser.add_argument('--jitter', type = float, default = 0.0)
+    parser.add_argument('--error-rate', type = float, default = 0.0,
+                        help = 'share of requests that fail with a ConnectionError')
+    parser.add_argument('--throttle-rate', type = float, default = 0.0,
+                        help = 'share of requests that are throttled (HTTP 429)')
+    parser.add_argument('--retry-after', type = float, default = 1.0,
+                        help = 'Retry-After of throttled requests, in seconds')
+    parser.add_argument('--rate', type = float, default = None,
+                        help = 'client rate limit in requests per second (default: none)')
+    parser.add_argument('--concurrency', type = int, default = 1,
+                        help = 'releases built at the same time')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--output', help = 'also write the results to this JSON file')
+    parser.add_argument('--profile', help = 'write the stage timings and counters to this JSON file')
+    parser.add_argument('--suite', action = 'store_true',
+                        help = 'benchmark the core algorithms on synthetic releases')
+    parser.add_argument('--baseline', default = BASELINE_FILE,
+                        help = 'suite results to compare against')
+    parser.add_argument('--save-baseline', action = 'store_true',
+                        help = 'store the suite results as the baseline')
+    parser.add_argument('--tolerance', type = float, default = 0.25,
+                        help = 'share a suite timing may be slower than the baseline')
+    parser.add_argument('--growth-tolerance', type = float, default = 0.5,
+                        help = 'how much a suite growth exponent may exceed the baseline')
+    parser.add_argument('--sizes', default = ','.join(map(str, SIZES)),
+                        help = 'comma-separated sizes the suite runs at')
+    parser.add_argument('--repeat', type = int, default = 3)
+    args = parser.parse_args()
+
+    if args.suite:
+        sys.exit(run_suite(args))
+
+    release_ids = args.releases or RELEASES
+    fixture_dir = args.fixtures
+    temp_dir = None
+    if not args.record and not os.path.isdir(fixture_dir):
+        if args.releases:
+            parser.error('no fixtures in %s: record them with --record' % fixture_dir)
+        sys.stderr.write('No fixtures in %s: using synthetic releases\n' % fixture_dir)
+        temp_dir = tempfile.mkdtemp()
+        fixture_dir = temp_dir
+        releases = synthetic_releases()
+        release_ids = sorted(releases)
+        with quiet():
+            record(release_ids, fixture_dir, SyntheticTransport(releases))
+
+    try:
+        with quiet():
+            if args.record:
+                result = record(release_ids, fixture_dir)
+            else:
+                transport = FixtureTransport(fixture_dir, args.latency, args.jitter,
+                                             args.error_rate, args.seed,
+                                             args.throttle_rate, args.retry_after)
+                result = benchmark(release_ids, transport, args.rate, args.concurrency)
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir)
+
+    print json.dumps(result, indent = 2, sort_keys = True)
+    if args.profile:
+        profile.dump(args.profile)
+    if args.output:
+        write_json(args.output, result)
+
+
+if __name__ == '__main__':
+    main()
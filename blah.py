@@ -3,12 +3,10 @@ Created on Jul 9, 2012
 Author: George Lifchits
 '''
 
-import discogs_client as discogs
+from discogs_api import default_api
 import pprint as p
 
-discogs.user_agent = 'test/glifchits'
+artist = default_api().artist('kraftwerk')
+print artist['name']
 
-artist = discogs.Artist('kraftwerk')
-print artist
-
-p.pprint (artist.data)
+p.pprint (artist)
@@ -0,0 +1,95 @@
+'''
+Created on Oct 18, 2026
+Author: George Lifchits
+
+Builds the tracklists of many releases at once, for whole-library rescans.
+Every build is a task on a bounded WorkerPool and submit() returns its
+Future, so any number of releases can be queued while only :concurrency:
+of them are being built. Inside a build the master release and the artist
+lookups already run on their own shared pools (see DiscogsTracklist.fetches
+and RealName.lookups), so the number of threads stays fixed no matter how
+many releases there are.
+'''
+
+import sys
+import time
+from requests.exceptions import ConnectionError
+from discogs_tracklist import DiscogsTracklist, RealName
+from discogs_api import default_api
+from workers import WorkerPool
+
+
+class TracklistBuilder(object):
+    '''
+    submit() a release ID to get a Future of its built DiscogsTracklist, or
+    build_many() to build a batch and wait for all of it.
+    '''
+
+    def __init__(self, concurrency = 8, api = None, real_name = None,
+                 checkpoint_dir = None, attempts = 10, retry_delay = 10):
+        if attempts < 1:
+            raise ValueError('attempts must be at least 1, got %r' % attempts)
+        self.api = api if api is not None else default_api()
+        # one RealName for every build: the exceptions file is read once
+        self.real_name = real_name if real_name is not None else RealName(api = self.api)
+        self.checkpoint_dir = checkpoint_dir
+        self.attempts = attempts
+        self.retry_delay = retry_delay
+        self.pool = WorkerPool(workers = concurrency)
+
+    def submit(self, release_id):
+        return self.pool.submit(self.build, release_id)
+
+    def build(self, release_id):
+        '''
+        Fetches and builds one release. Fetching the release and building
+        its tracks each get up to :attempts: attempts, :retry_delay:
+        seconds apart, before the ConnectionError fails the build.
+        '''
+        for attempt in range(self.attempts):
+            try:
+                tracklist = DiscogsTracklist(release_id, build = False, api = self.api,
+                                             real_name = self.real_name,
+                                             checkpoint_dir = self.checkpoint_dir)
+                break
+            except ConnectionError:
+                if attempt == self.attempts - 1:
+                    raise
+                time.sleep(self.retry_delay)
+
+        tracklist.retry_delay = self.retry_delay
+        tracklist.max_attempts = self.attempts
+        tracklist.discogs_tracklist = tracklist.get_release_info()
+        return tracklist
+
+    def build_many(self, release_ids, callback = None):
+        '''
+        Builds every release and returns (tracklists, failures): dicts of
+        release ID to DiscogsTracklist and to the exception it failed with.
+        callback(release_id, future) is called as each build finishes, from
+        the thread that built it.
+        '''
+        futures = {}
+        for release_id in release_ids:
+            if release_id in futures:
+                continue
+            futures[release_id] = self.submit(release_id)
+            if callback is not None:
+                futures[release_id].add_done_callback(
+                    lambda future, release_id = release_id: callback(release_id, future))
+
+        tracklists = {}
+        failures = {}
+        for release_id, future in futures.items():
+            try:
+                tracklists[release_id] = future.result()
+            except Exception:
+                failures[release_id] = sys.exc_info()[1]
+        return tracklists, failures
+
+
+def build_tracklists(release_ids, concurrency = 8, **kwargs):
+    '''
+    Shortcut for TracklistBuilder(concurrency, ...).build_many(release_ids)
+    '''
+    return TracklistBuilder(concurrency, **kwargs).build_many(release_ids)
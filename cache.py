@@ -0,0 +1,289 @@
+'''
+Created on Oct 18, 2026
+Author: George Lifchits
+
+A small persistent cache for things fetched from Discogs. Artist data and
+resolved real names barely ever change, so there is no reason to ask Discogs
+for them again every time a release is fixed. Release and master data go in
+a PayloadStore, which can be revalidated cheaply when it gets old.
+'''
+
+import sqlite3
+import json
+import hashlib
+import time
+import threading
+from profiling import profile
+from collections import OrderedDict
+
+# returned by PersistentCache.get
+MISS = object()     # nothing usable is cached for this key
+FAILED = object()   # the lookup was tried before and failed (negative entry)
+
+DAY = 24 * 60 * 60
+
+
+class PersistentCache(object):
+    '''
+    Two-tier key/value cache: a bounded in-memory LRU in front of an SQLite
+    file that is shared between runs.
+
+    Entries live in namespaces ('artist', 'realname', ...) and expire after
+    :ttl: seconds. Failed lookups are stored as negative entries with their
+    own (shorter) :negative_ttl:. The file holds at most :max_entries: rows;
+    the least recently used ones are evicted first. Reads don't write to the
+    file: access times are kept in memory and written in batches, with the
+    next store or every :flush_every: reads.
+    '''
+
+    def __init__(self,
+                 cache_file = 'discogs_cache.db',
+                 ttl = 30 * DAY,
+                 negative_ttl = DAY,
+                 max_entries = 50000,
+                 memory_entries = 2000,
+                 flush_every = 500):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self.flush_every = flush_every
+
+        self.memory = OrderedDict()
+        self.accessed = {} # (ns, key) -> access time not written yet
+        self.lock = threading.RLock()
+
+        self.db = sqlite3.connect(cache_file, check_same_thread = False)
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS entries (
+                               ns TEXT NOT NULL,
+                               key TEXT NOT NULL,
+                               value TEXT,
+                               negative INTEGER NOT NULL,
+                               expires REAL NOT NULL,
+                               accessed REAL NOT NULL,
+                               PRIMARY KEY (ns, key))''')
+        self.db.execute('''CREATE INDEX IF NOT EXISTS entries_accessed
+                           ON entries (accessed)''')
+        self.purge()
+
+    def get(self, ns, key):
+        '''
+        Returns the cached value, FAILED for a negative entry or MISS if there
+        is nothing (unexpired) cached.
+        '''
+        result = self.lookup(ns, key)
+        # 'realname:<digest>' is counted as 'realname'
+        profile.count('cache.%s.%s' % (ns.split(':')[0], 'miss' if result is MISS else 'hit'))
+        return result
+
+    def lookup(self, ns, key):
+        now = time.time()
+        with self.lock:
+            entry = self.memory.pop((ns, key), None)
+            if entry is None:
+                row = self.db.execute('''SELECT value, negative, expires
+                                         FROM entries WHERE ns = ? AND key = ?''',
+                                      (ns, key)).fetchone()
+                if row is None:
+                    return MISS
+                value, negative, expires = row
+                entry = (None if negative else json.loads(value),
+                         bool(negative), expires)
+
+            value, negative, expires = entry
+            if expires < now:
+                return MISS
+
+            self.remember((ns, key), entry)
+            self.accessed[(ns, key)] = now
+            if len(self.accessed) >= self.flush_every:
+                self.flush()
+                self.db.commit()
+
+        if negative:
+            return FAILED
+        return value
+
+    def put(self, ns, key, value):
+        self.store(ns, key, value, False, self.ttl)
+
+    def put_negative(self, ns, key):
+        self.store(ns, key, None, True, self.negative_ttl)
+
+    def store(self, ns, key, value, negative, ttl):
+        now = time.time()
+        entry = (value, negative, now + ttl)
+        with self.lock:
+            self.remember((ns, key), entry)
+            self.accessed.pop((ns, key), None)
+            self.flush()
+            self.db.execute('''INSERT OR REPLACE INTO entries
+                               (ns, key, value, negative, expires, accessed)
+                               VALUES (?, ?, ?, ?, ?, ?)''',
+                            (ns, key, json.dumps(value), int(negative),
+                             now + ttl, now))
+            self.evict()
+            self.db.commit()
+
+    def remember(self, memory_key, entry):
+        '''
+        Puts an entry at the most recently used end of the memory tier.
+        '''
+        self.memory.pop(memory_key, None)
+        self.memory[memory_key] = entry
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last = False)
+
+    def flush(self):
+        '''
+        Writes the access times of the entries read since the last flush
+        (the caller commits)
+        '''
+        if self.accessed:
+            self.db.executemany('''UPDATE entries SET accessed = ?
+                                   WHERE ns = ? AND key = ?''',
+                                [(accessed, ns, key) for (ns, key), accessed
+                                 in self.accessed.items()])
+            self.accessed.clear()
+
+    def evict(self):
+        '''
+        Drops the least recently used rows beyond :max_entries:
+        '''
+        self.db.execute('''DELETE FROM entries WHERE rowid IN
+                           (SELECT rowid FROM entries ORDER BY accessed DESC
+                            LIMIT -1 OFFSET ?)''', (self.max_entries,))
+
+    def purge(self):
+        '''
+        Removes every expired row from the file.
+        '''
+        with self.lock:
+            self.flush()
+            self.db.execute('DELETE FROM entries WHERE expires < ?',
+                            (time.time(),))
+            self.evict()
+            self.db.commit()
+
+    def clear(self, ns = None):
+        with self.lock:
+            self.flush()
+            if ns is None:
+                self.memory.clear()
+                self.db.execute('DELETE FROM entries')
+            else:
+                for memory_key in self.memory.keys():
+                    if memory_key[0] == ns:
+                        del self.memory[memory_key]
+                self.db.execute('DELETE FROM entries WHERE ns = ?', (ns,))
+            self.db.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+def shared_cache(cache_file = 'discogs_cache.db'):
+    '''
+    Every RealName in the process uses the same cache object per file.
+    '''
+    with _shared_lock:
+        if cache_file not in _shared:
+            _shared[cache_file] = PersistentCache(cache_file)
+        return _shared[cache_file]
+
+
+class PayloadStore(object):
+    '''
+    Raw release and master JSON as Discogs sent it. Each distinct payload is
+    stored once, keyed by the SHA-1 of its content, and (kind, ID) refers to
+    the payload it had when last fetched, with its ETag and when that was.
+
+    A payload younger than :max_age: seconds is fresh and can be used
+    without asking Discogs; an older one should be revalidated first.
+
+    It has a file of its own so its writes never wait on PersistentCache's.
+    '''
+
+    def __init__(self, store_file = 'discogs_payloads.db', max_age = 7 * DAY):
+        self.store_file = store_file
+        self.max_age = max_age
+        self.lock = threading.RLock()
+
+        self.db = sqlite3.connect(store_file, check_same_thread = False)
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS payloads (
+                               hash TEXT PRIMARY KEY,
+                               data TEXT NOT NULL)''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS payload_refs (
+                               kind TEXT NOT NULL,
+                               key TEXT NOT NULL,
+                               hash TEXT NOT NULL,
+                               etag TEXT,
+                               fetched REAL NOT NULL,
+                               PRIMARY KEY (kind, key))''')
+        self.db.commit()
+
+    def get(self, kind, key):
+        '''
+        Returns (data, etag, fetched) or None if nothing is stored
+        '''
+        with self.lock:
+            row = self.db.execute('''SELECT data, etag, fetched
+                                     FROM payload_refs JOIN payloads USING (hash)
+                                     WHERE kind = ? AND key = ?''',
+                                  (kind, unicode(key))).fetchone()
+        if row is None:
+            return None
+        data, etag, fetched = row
+        return json.loads(data), etag, fetched
+
+    def put(self, kind, key, data, etag = None):
+        text = json.dumps(data, sort_keys = True)
+        digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        with self.lock:
+            self.db.execute('INSERT OR IGNORE INTO payloads (hash, data) VALUES (?, ?)',
+                            (digest, text))
+            self.db.execute('''INSERT OR REPLACE INTO payload_refs
+                               (kind, key, hash, etag, fetched)
+                               VALUES (?, ?, ?, ?, ?)''',
+                            (kind, unicode(key), digest, etag, time.time()))
+            self.db.commit()
+        return digest
+
+    def items(self, kind):
+        '''
+        (key, data) of everything of :kind: that is stored
+        '''
+        with self.lock:
+            rows = self.db.execute('''SELECT key, data
+                                      FROM payload_refs JOIN payloads USING (hash)
+                                      WHERE kind = ?''', (kind,)).fetchall()
+        return [(key, json.loads(data)) for key, data in rows]
+
+    def touch(self, kind, key):
+        '''
+        The stored payload was revalidated: it's fresh again
+        '''
+        with self.lock:
+            self.db.execute('''UPDATE payload_refs SET fetched = ?
+                               WHERE kind = ? AND key = ?''',
+                            (time.time(), kind, unicode(key)))
+            self.db.commit()
+
+    def is_fresh(self, fetched):
+        return time.time() - fetched < self.max_age
+
+    def prune(self):
+        '''
+        Removes payloads nothing refers to any more
+        '''
+        with self.lock:
+            self.db.execute('''DELETE FROM payloads WHERE hash NOT IN
+                               (SELECT hash FROM payload_refs)''')
+            self.db.commit()
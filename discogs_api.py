@@ -0,0 +1,504 @@
+'''
+Created on Oct 18, 2026
+Author: George Lifchits
+
+Everything PyTunesFixer fetches from Discogs goes through DiscogsAPI. Where
+the data actually comes from is up to its transport: the live API through
+discogs_client, or recorded JSON fixtures on disk for working offline and
+for benchmarks.
+
+DiscogsAPI keeps to Discogs' rate limit with a token bucket, retries
+requests that failed for transient reasons with jittered exponential
+backoff, and adjusts how many requests it has in flight to how quickly (and
+how willingly) Discogs answers.
+'''
+
+import discogs_client as discogs
+from cache import PayloadStore
+from dumps import DumpStore
+from profiling import profile
+from requests.exceptions import ConnectionError, Timeout
+import os
+import json
+import time
+import random
+import urllib
+import threading
+import hashlib
+import email.utils
+
+KINDS = ('release', 'master', 'artist', 'search')
+STORED_KINDS = ('release', 'master')  # kept in the PayloadStore
+DUMP_FILE = 'discogs_dump.db'
+
+
+class TransientHTTPError(ConnectionError):
+    '''
+    Discogs answered, but with something worth retrying: 429 (throttled) or
+    a 5xx. Subclasses ConnectionError so code that copes with a lost
+    connection copes with this too.
+    '''
+
+    def __init__(self, status, retry_after = None):
+        ConnectionError.__init__(self, 'HTTP %s' % status)
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def throttled(self):
+        return self.status == 429
+
+
+def parse_retry_after(value):
+    '''
+    Seconds to wait from a Retry-After header: either a number of seconds or
+    an HTTP date. None if there is no (valid) header.
+    '''
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        date = email.utils.parsedate_tz(value)
+        if date is None:
+            return None
+        return max(0.0, email.utils.mktime_tz(date) - time.time())
+
+
+class TokenBucket(object):
+    '''
+    Allows :rate: requests per second on average, and bursts of up to
+    :capacity:. pause() stops everything for a while, eg. when Discogs says
+    when to come back.
+    '''
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+            self.tokens = 0.0
+
+
+class AdaptiveLimit(object):
+    '''
+    How many requests may be in flight at once. Grows by one after :window:
+    quick answers in a row, and halves when Discogs throttles us or an
+    answer takes longer than :slow: seconds.
+    '''
+
+    def __init__(self, initial = 4, minimum = 1, maximum = 16, slow = 2.0,
+                 window = 10):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.slow = slow
+        self.window = window
+        self.in_flight = 0
+        self.streak = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait(1)
+            self.in_flight += 1
+
+    def release(self, latency, throttled = False):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled or latency > self.slow:
+                self.limit = max(self.minimum, self.limit // 2)
+                self.streak = 0
+            else:
+                self.streak += 1
+                if self.streak >= self.window:
+                    self.limit = min(self.maximum, self.limit + 1)
+                    self.streak = 0
+            self.condition.notify_all()
+
+
+class LiveTransport(object):
+    '''
+    Fetches from the Discogs API with discogs_client.
+    '''
+
+    def __init__(self, user_agent = 'test/glifchits'):
+        discogs.user_agent = user_agent
+        self.classes = {'release': discogs.Release,
+                        'master': discogs.MasterRelease,
+                        'artist': discogs.Artist,
+                        'search': discogs.Search}
+
+    def fetch(self, kind, key):
+        return self.fetch_with_etag(kind, key)[0]
+
+    def fetch_with_etag(self, kind, key, etag = None):
+        '''
+        Returns (data, etag). With an :etag: the request is conditional, and
+        data is None if what we have is still current (304).
+        '''
+        resource = self.classes[kind](key)
+        if etag is not None and hasattr(resource, '_headers'):
+            resource._headers['If-None-Match'] = etag
+        try:
+            data = resource.data
+        except discogs.DiscogsAPIError:
+            response = getattr(resource, '_response', None)
+            status = getattr(response, 'status_code', None)
+            if status == 304:
+                return None, etag
+            if status == 429 or (status is not None and status >= 500):
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                raise TransientHTTPError(status, retry_after)
+            raise
+
+        if kind == 'search':
+            data = search_results(data)
+        response = getattr(resource, '_response', None)
+        return data, getattr(response, 'headers', {}).get('ETag')
+
+
+def search_results(data):
+    '''
+    The releases in a Discogs search response, as {'id', 'artist', 'title'}
+    '''
+    data = data.get('searchresults', data)
+    results = []
+    for result in data.get('results', []):
+        if result.get('type') != 'release':
+            continue
+        release_id = result.get('id') or result['uri'].rstrip('/').rsplit('/', 1)[1]
+        artist, dash, title = result.get('title', '').partition(' - ')
+        if not dash:
+            artist, title = u'', artist
+        results.append({'id': int(release_id), 'artist': artist, 'title': title})
+    return results
+
+
+class FixtureTransport(object):
+    '''
+    Stand-in for the Discogs API which replays JSON recorded with
+    RecordingTransport, from :fixture_dir:/<kind>/<key>.json
+
+    Every request takes :latency: seconds, plus up to :jitter: more. It
+    fails with a ConnectionError with probability :error_rate:, and is
+    throttled (429, with a Retry-After of :retry_after: seconds) with
+    probability :throttle_rate:. Anything without a fixture is a 404, like
+    the real thing.
+    '''
+
+    def __init__(self, fixture_dir = 'fixtures', latency = 0.0, jitter = 0.0,
+                 error_rate = 0.0, seed = None, throttle_rate = 0.0,
+                 retry_after = 1.0):
+        self.fixture_dir = fixture_dir
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def path(self, kind, key):
+        return fixture_path(self.fixture_dir, kind, key)
+
+    def fetch(self, kind, key):
+        return self.fetch_with_etag(kind, key)[0]
+
+    def fetch_with_etag(self, kind, key, etag = None):
+        '''
+        Like LiveTransport.fetch_with_etag; the ETag of a fixture is the hash
+        of its file.
+        '''
+        with self.lock:
+            delay = self.latency + self.random.random() * self.jitter
+            fail = self.random.random() < self.error_rate
+            throttle = self.random.random() < self.throttle_rate
+        if delay > 0:
+            time.sleep(delay)
+        if fail:
+            raise ConnectionError('injected error fetching %s %s' % (kind, key))
+        if throttle:
+            raise TransientHTTPError(429, self.retry_after)
+
+        path = self.path(kind, key)
+        if not os.path.exists(path):
+            raise discogs.DiscogsAPIError('404 Not Found')
+
+        f = open(path, 'rb')
+        try:
+            content = f.read()
+        finally:
+            f.close()
+
+        current = hashlib.sha1(content).hexdigest()
+        if current == etag:
+            return None, etag
+        return json.loads(content), current
+
+
+class RecordingTransport(object):
+    '''
+    Passes requests on to another transport (the live API by default) and
+    saves everything it gets back as fixtures for FixtureTransport.
+    '''
+
+    def __init__(self, fixture_dir = 'fixtures', transport = None):
+        self.fixture_dir = fixture_dir
+        self.transport = transport if transport is not None else LiveTransport()
+
+    def fetch(self, kind, key):
+        data = self.transport.fetch(kind, key)
+
+        path = fixture_path(self.fixture_dir, kind, key)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        f = open(path, 'wb')
+        try:
+            json.dump(data, f, indent = 1, sort_keys = True)
+        finally:
+            f.close()
+        return data
+
+
+def fixture_path(fixture_dir, kind, key):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    filename = urllib.quote(str(key), safe = '') + '.json'
+    return os.path.join(fixture_dir, kind, filename)
+
+
+class DiscogsAPI(object):
+    '''
+    release(), master() and artist() return the data dicts Discogs has for
+    them; search() returns the releases a query finds.
+
+    At most :rate: requests per second are made (bursts of :burst:; None for
+    no limit). A request that fails for a transient reason is retried up to
+    :retries: times, waiting :backoff: * 2^attempt seconds (randomized, at
+    most :max_backoff:) or as long as Discogs' Retry-After says. The number
+    of requests in flight is adjusted by an AdaptiveLimit.
+
+    With a :store: (a PayloadStore), releases and masters are kept locally:
+    fresh ones are used without any request, stale ones are revalidated
+    with a conditional request where the transport supports it. When
+    :offline:, stored payloads are used however old they are, and anything
+    not stored is a ConnectionError.
+
+    With a :dump: (a DumpStore), anything that is in the Discogs data dumps
+    is read from there, before the store and without any request.
+
+    Counts requests and the time spent on them, per kind.
+    '''
+
+    def __init__(self, transport = None, rate = 1.0, burst = 5, retries = 5,
+                 backoff = 0.5, max_backoff = 60.0, limit = None, store = None,
+                 offline = False, dump = None):
+        self.transport = transport if transport is not None else LiveTransport()
+        self.bucket = TokenBucket(rate, burst) if rate is not None else None
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.limit = limit if limit is not None else AdaptiveLimit()
+        self.store = store
+        self.offline = offline
+        self.dump = dump
+        self.random = random.Random()
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.lock:
+            self.requests = dict((kind, 0) for kind in KINDS)
+            self.errors = 0
+            self.retried = 0
+            self.throttled = 0
+            self.stored = 0
+            self.revalidated = 0
+            self.dumped = 0
+            self.request_time = 0.0
+
+    def delay(self, attempt, error):
+        '''
+        Seconds to wait before retrying after :attempt: failed attempts
+        '''
+        retry_after = getattr(error, 'retry_after', None)
+        if retry_after is not None:
+            return retry_after
+        ceiling = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return self.random.uniform(ceiling / 2, ceiling)
+
+    def request(self, kind, key, etag = None):
+        '''
+        One attempt, within the rate and concurrency limits.
+        Returns (data, etag); data is None if :etag: is still current.
+        '''
+        if self.offline:
+            raise ConnectionError('offline: %s %s is not stored' % (kind, key))
+        if self.bucket is not None:
+            self.bucket.acquire()
+        self.limit.acquire()
+
+        start = time.time()
+        throttled = False
+        try:
+            if hasattr(self.transport, 'fetch_with_etag'):
+                return self.transport.fetch_with_etag(kind, key, etag)
+            return self.transport.fetch(kind, key), None
+        except TransientHTTPError, e:
+            throttled = e.throttled
+            raise
+        finally:
+            latency = time.time() - start
+            profile.observe('api.' + kind, latency)
+            self.limit.release(latency, throttled)
+            with self.lock:
+                self.requests[kind] += 1
+                self.request_time += latency
+                if throttled:
+                    self.throttled += 1
+
+    def fetch_remote(self, kind, key, etag = None):
+        '''
+        request(), retried for as long as it's worth it
+        '''
+        attempt = 0
+        while True:
+            try:
+                return self.request(kind, key, etag)
+            except (ConnectionError, Timeout), e:
+                if attempt >= self.retries or self.offline:
+                    with self.lock:
+                        self.errors += 1
+                    profile.count('api.errors')
+                    raise
+
+                wait = self.delay(attempt, e)
+                if getattr(e, 'retry_after', None) is not None and \
+                   self.bucket is not None:
+                    # nobody else should keep knocking either
+                    self.bucket.pause(wait)
+                with self.lock:
+                    self.retried += 1
+                profile.count('api.retries')
+                with profile.timer('api.backoff'):
+                    time.sleep(wait)
+                attempt += 1
+            except Exception:
+                with self.lock:
+                    self.errors += 1
+                profile.count('api.errors')
+                raise
+
+    def fetch(self, kind, key):
+        if self.dump is not None:
+            data = self.dump.get(kind, key)
+            profile.count('dump.%s' % ('miss' if data is None else 'hit'))
+            if data is not None:
+                with self.lock:
+                    self.dumped += 1
+                return data
+
+        if self.store is None or kind not in STORED_KINDS:
+            return self.fetch_remote(kind, key)[0]
+
+        stored = self.store.get(kind, key)
+        if stored is None:
+            profile.count('store.miss')
+            data, etag = self.fetch_remote(kind, key)
+            self.store.put(kind, key, data, etag)
+            return data
+
+        data, etag, fetched = stored
+        if self.offline or self.store.is_fresh(fetched):
+            with self.lock:
+                self.stored += 1
+            profile.count('store.hit')
+            return data
+
+        profile.count('store.stale')
+        new_data, new_etag = self.fetch_remote(kind, key, etag)
+        if new_data is None:
+            # not modified
+            self.store.touch(kind, key)
+            with self.lock:
+                self.revalidated += 1
+            return data
+
+        self.store.put(kind, key, new_data, new_etag)
+        return new_data
+
+    def release(self, release_id):
+        return self.fetch('release', release_id)
+
+    def master(self, master_id):
+        return self.fetch('master', master_id)
+
+    def artist(self, name):
+        return self.fetch('artist', name)
+
+    def search(self, query):
+        '''
+        Releases matching :query:, as {'id', 'artist', 'title'}
+        '''
+        return self.fetch('search', query)
+
+    def stats(self):
+        with self.lock:
+            return {'requests': dict(self.requests),
+                    'total_requests': sum(self.requests.values()),
+                    'errors': self.errors,
+                    'retried': self.retried,
+                    'throttled': self.throttled,
+                    'stored': self.stored,
+                    'revalidated': self.revalidated,
+                    'dumped': self.dumped,
+                    'concurrency_limit': self.limit.limit,
+                    'request_time': self.request_time}
+
+
+_default_api = None
+_default_api_lock = threading.Lock()
+
+def default_api():
+    '''
+    The DiscogsAPI used when none is given: the live API, with a local store
+    of releases and masters and the Discogs data dumps if they were read into
+    DUMP_FILE (see dumps.py), unless something else was set with
+    set_default_api.
+    '''
+    global _default_api
+    with _default_api_lock:
+        if _default_api is None:
+            dump = DumpStore(DUMP_FILE) if os.path.exists(DUMP_FILE) else None
+            _default_api = DiscogsAPI(store = PayloadStore(), dump = dump)
+        return _default_api
+
+def set_default_api(api):
+    global _default_api
+    with _default_api_lock:
+        _default_api = api
@@ -7,21 +7,68 @@ Author: George Lifchits
 import discogs_client as discogs
 from constants import *
 import re
+import os
+import sys
+import json
 import pickle
 import win32com.client
-from copy import deepcopy as copy
 import codecs
 from requests.exceptions import ConnectionError
 import time
 import threading
+import hashlib
+import unicodedata
+from array import array
+from functools import total_ordering
+from bisect import bisect_left, bisect_right
+from cache import shared_cache, MISS, FAILED
+from workers import WorkerPool, SingleFlight
+from library import LibrarySnapshot
+from discogs_api import default_api
+from profiling import profile
+
+
+@total_ordering
+class TrackOrder(object):
+    '''
+    Orders tracks by disc, then track number. Used by Track and by the rows
+    of a TracklistTable, so the two can be compared with each other.
+    '''
+
+    __slots__ = ()
+
+    def position(self):
+        return (self.DiscNumber, self.TrackNumber)
+
+    def __eq__(self, other):
+        if not isinstance(other, TrackOrder):
+            return NotImplemented
+        return self.position() == other.position()
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __lt__(self, other):
+        if not isinstance(other, TrackOrder):
+            return NotImplemented
+        return self.position() < other.position()
 
+    # equal tracks are still different tracks
+    __hash__ = object.__hash__
 
-class Track(object):
+
+class Track(TrackOrder):
     '''
     A Discogs track object
     Modelled after iTunes SDK track object
     '''
 
+    # no per-track __dict__: batch scans hold a lot of these
+    __slots__ = ('Name', 'Artist', 'Composer', 'Genre', 'AlbumArtist', 'Album',
+                 'Grouping', 'Comments', 'Year', 'TrackNumber', 'TrackCount',
+                 'DiscNumber', 'DiscCount')
+
     def __init__(self,
                  Name = None,
                  Artist = None,
@@ -66,21 +113,126 @@ class Track(object):
         return '{tn:>3}/{tc:<2} {dc:>2}/{dn:<3} {a} - {n}\n              ({c})'\
                 .format(**info)
 
-    def __cmp__(self, other):
+    def __getstate__(self):
+        return dict((field, getattr(self, field)) for field in self.__slots__)
+
+    def __setstate__(self, state):
+        # also reads tracks pickled before Track had __slots__
+        for field in self.__slots__:
+            setattr(self, field, state.get(field))
+
+
+class TracklistTable(object):
+    '''
+    Many tracks' metadata stored by column: the numbers in arrays, the
+    strings as indexes into one table of interned strings, so a string
+    that is on thousands of tracks (an album artist, a label) is stored
+    once. table[i] is a row view that reads and writes the columns in
+    place, and behaves like a Track.
+    '''
+
+    NUMBERS = ('Year', 'TrackNumber', 'TrackCount', 'DiscNumber', 'DiscCount')
+    TEXT = ('Name', 'Artist', 'Composer', 'Genre', 'AlbumArtist', 'Album',
+            'Grouping', 'Comments')
+
+    NONE = -1 # stands for None in the columns
+
+    def __init__(self, tracks = ()):
+        self.columns = {}
+        for field in self.NUMBERS + self.TEXT:
+            self.columns[field] = array('i')
+        self.strings = []
+        self.string_ids = {}
+        self.extend(tracks)
+
+    def __len__(self):
+        return len(self.columns['Name'])
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError('track index out of range')
+        return TrackRow(self, row)
+
+    def __iter__(self):
+        for row in xrange(len(self)):
+            yield TrackRow(self, row)
+
+    def append(self, track):
+        for field in Track.__slots__:
+            self.columns[field].append(self.encode(field, getattr(track, field)))
+
+    def extend(self, tracks):
+        for track in tracks:
+            self.append(track)
+
+    def encode(self, field, value):
+        if value is None:
+            return self.NONE
+        if field in self.NUMBERS:
+            return value
+        if value not in self.string_ids:
+            self.string_ids[value] = len(self.strings)
+            self.strings.append(intern(value) if type(value) is str else value)
+        return self.string_ids[value]
+
+    def get(self, field, row):
+        value = self.columns[field][row]
+        if value == self.NONE:
+            return None
+        if field in self.NUMBERS:
+            return value
+        return self.strings[value]
+
+    def set(self, field, row, value):
+        self.columns[field][row] = self.encode(field, value)
+
+    def order(self):
         '''
-        Comparison function for tracks: only compares track/disc position
+        Row numbers sorted by (disc, track)
         '''
-        if self.DiscNumber > other.DiscNumber:
-            return 1
-        elif self.DiscNumber < other.DiscNumber:
-            return -1
-        else:
-            if self.TrackNumber > other.TrackNumber:
-                return 1
-            elif self.TrackNumber < other.TrackNumber:
-                return -1
-            else:
-                return 0
+        discs = self.columns['DiscNumber']
+        tracks = self.columns['TrackNumber']
+        return sorted(xrange(len(self)), key = lambda row: (discs[row], tracks[row]))
+
+    def sort(self):
+        '''
+        Reorders the rows by (disc, track), in place
+        '''
+        order = self.order()
+        for field, column in self.columns.items():
+            self.columns[field] = array(column.typecode, (column[row] for row in order))
+
+    def track(self, row):
+        '''
+        A standalone Track copy of a row
+        '''
+        return Track(**dict((field, self.get(field, row)) for field in Track.__slots__))
+
+
+class TrackRow(TrackOrder):
+    '''
+    One row of a TracklistTable; its fields are read from and written to
+    the table's columns.
+    '''
+
+    __slots__ = ('table', 'row')
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    def __str__(self):
+        return str(self.table.track(self.row))
+
+
+def _column_property(field):
+    return property(lambda row: row.table.get(field, row.row),
+                    lambda row, value: row.table.set(field, row.row, value))
+
+for _field in Track.__slots__:
+    setattr(TrackRow, _field, _column_property(_field))
 
 
 class DiscogsTracklist(object):
@@ -92,32 +244,48 @@ class DiscogsTracklist(object):
     API which are used to build this list.
     '''
 
-    def __init__(self, release_id):
-        discogs.user_agent = 'test/glifchits'
+    # fetches for release-wide data that run alongside everything else
+    fetches = SingleFlight(WorkerPool(workers = 4))
+
+    def __init__(self, release_id, build = True, api = None, real_name = None,
+                 checkpoint_dir = None, year_policy = 'auto'):
+        '''
+        With :build: False only the release-wide information is fetched;
+        get_release_info builds the tracklist later.
+        With a :checkpoint_dir: the tracks built so far are saved there as
+        they are built, and a later run for the same release picks up where
+        this one stopped.
+        :year_policy: decides when the master release's year is used
+        instead of the release's (see needs_master).
+        '''
+        self.api = api if api is not None else default_api()
 
         self.utils = Utilities()
-        self.real_name = RealName()
+        self.real_name = real_name if real_name is not None else RealName(api = self.api)
 
-        self.itunesinfo = ItunesInfo()
-        self.itunes_genres = self.itunesinfo.get_genres()
-        self.itunes_labels = self.itunesinfo.get_labels()
+        # only connects to iTunes and loads the library stats when needed
+        self.itunesinfo = shared_itunes_info()
 
         self.featuringroles = ('featuring', 'vocals')
         self.composerinclude = ('written', 'lyrics', 'music')
         self.composerexclude = ()
 
         self.anv_preferred = True
-
-        self.release = discogs.Release(release_id)
-        try:
-            self.release.data
-        except:
-            raise
-
-        try:
-            self.master = discogs.MasterRelease(self.release.data['master_id'])
-        except KeyError:
-            self.master = None
+        self.retry_delay = 10
+        self.max_attempts = None # connection failures get_release_info survives; None: any
+        self.reissue_descriptions = ('reissue', 'remastered', 'repress')
+
+        with profile.timer('release.fetch', release_id):
+            self.release = self.api.release(release_id)
+        start = time.time()
+        # the master release is only needed for its year: fetch it alongside
+        # everything else, and only if the year policy asks for it
+        self.year_policy = year_policy
+        self.master_id = self.release.get('master_id')
+        self.master = None
+        self._year = None
+        if self.needs_master():
+            self.fetch_master()
 
         self.release_tracklist = self.get_discogs_raw_tracklist()
 
@@ -125,68 +293,167 @@ class DiscogsTracklist(object):
         # this stuff is the same for all tracks in a release.
         self.album = self.get_album_name()
         self.album_artist = self.get_album_artist()
-        self.release_composers = self.get_release_credits_people()['writers']
-        self.release_featured = self.get_release_credits_people()['featured']
-        self.year = self.get_year()
+        credits = self.get_release_credits_people()
+        self.release_composers = credits['writers']
+        self.release_featured = credits['featured']
+        self.composer_index = self.get_credit_index(self.release_composers, True)
+        self.featured_index = self.get_credit_index(self.release_featured, False)
         self.grouping = self.get_label()
         self.discogs_id = self.get_discogsid()
+        self.positions = TrackPositions([track['position']
+                                         for track in self.release_tracklist])
         self.tracklisting = self.get_track_position_listing()
         self.genre = self.get_genre()
         self.disc_total = self.get_disc_total()
 
+        # writer credits and their real names, filled in by prefetch_writers
+        self.track_writers = None
+        self.real_names = {}
+
+        # tracks built so far, kept across connection failures
+        # (saved every :checkpoint_every: tracks, and when the connection fails)
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_every = 10
+        self._release_digest = None
+        self.built = []
+        self.load_checkpoint()
+        profile.add_time('release.prepare', time.time() - start, release_id)
+
         # This is the money maker.
-        self.discogs_tracklist = self.get_release_info()
+        self.discogs_tracklist = None
+        if build:
+            self.discogs_tracklist = self.get_release_info()
 
     def get_release_info(self):
+        '''
+        Builds the tracklist. Tracks that are done are kept when the
+        connection fails, so a retry resumes at the track that failed (and
+        with a checkpoint_dir, so does a re-run). After :max_attempts:
+        failed attempts the ConnectionError is raised.
+        '''
         complete = False
+        attempts = 0
 
         while not complete:
             try:
-                discogs_tracklist = []
-
-                count = 0
-                for track in self.release_tracklist:
-                    count += 1
-                    position = track['position']
-
-                    name = self.fix_name(self.get_name(track))
-                    artist = self.get_artist(track, position)
-                    composer = self.get_writers(track, position)
-                    genre = self.genre
-                    a_artist = self.album_artist
-                    album = self.album
-                    grouping = self.grouping
-                    comments = "D:" + self.discogs_id
-                    year = self.year
-                    track_this = self.get_track_this(count)
-                    disc_this = self.get_disc_this(count)
-                    track_total = self.get_track_total(disc_this)
-                    disc_total = self.disc_total
-
-                    new_track = Track()
-                    new_track.Name = name
-                    new_track.Artist = artist
-                    new_track.Composer = composer
-                    new_track.Genre = genre
-                    new_track.AlbumArtist = a_artist
-                    new_track.Album = album
-                    new_track.Grouping = grouping
-                    new_track.Comments = comments
-                    new_track.Year = year
-                    new_track.TrackNumber = track_this
-                    new_track.DiscNumber = disc_this
-                    new_track.TrackCount = track_total
-                    new_track.DiscCount = disc_total
-
-                    discogs_tracklist.append(new_track)
+                with profile.timer('release.writers', self.release['id']):
+                    self.prefetch_writers()
+
+                with profile.timer('release.tracks', self.release['id']):
+                    for count in range(len(self.built) + 1, len(self.release_tracklist) + 1):
+                        track = self.release_tracklist[count - 1]
+                        self.built.append(self.build_track(track, count))
+                        if count % self.checkpoint_every == 0:
+                            self.save_checkpoint()
                 print ''
                 complete = True
 
             except ConnectionError:
-                print 'Connection timed out. Trying again in 10 seconds.'
-                time.sleep(10)
+                attempts += 1
+                self.save_checkpoint()
+                if self.max_attempts is not None and attempts >= self.max_attempts:
+                    raise
+                profile.count('release.retries')
+                print 'Connection timed out. Resuming at track %s in %s seconds.' % \
+                      (len(self.built) + 1, self.retry_delay)
+                time.sleep(self.retry_delay)
+
+        self.remove_checkpoint()
+        return list(self.built)
+
+    def build_track(self, track, count):
+        position = track['position']
+
+        name = self.fix_name(self.get_name(track))
+        artist = self.get_artist(track, position)
+        composer = self.get_writers(track, position)
+        genre = self.genre
+        a_artist = self.album_artist
+        album = self.album
+        grouping = self.grouping
+        comments = "D:" + self.discogs_id
+        year = self.year
+        track_this = self.get_track_this(count)
+        disc_this = self.get_disc_this(count)
+        track_total = self.get_track_total(disc_this)
+        disc_total = self.disc_total
+
+        new_track = Track()
+        new_track.Name = name
+        new_track.Artist = artist
+        new_track.Composer = composer
+        new_track.Genre = genre
+        new_track.AlbumArtist = a_artist
+        new_track.Album = album
+        new_track.Grouping = grouping
+        new_track.Comments = comments
+        new_track.Year = year
+        new_track.TrackNumber = track_this
+        new_track.DiscNumber = disc_this
+        new_track.TrackCount = track_total
+        new_track.DiscCount = disc_total
+
+        return new_track
+
+    '''
+    CHECKPOINTS
+    '''
+
+    def checkpoint_file(self):
+        if self.checkpoint_dir is None:
+            return None
+        return os.path.join(self.checkpoint_dir, '%s.pkl' % self.release['id'])
 
-        return discogs_tracklist
+    def release_digest(self):
+        '''
+        Fingerprint of the release data: a checkpoint of an older version of
+        the release is not used
+        '''
+        if self._release_digest is None:
+            self._release_digest = hashlib.md5(json.dumps(self.release,
+                                                          sort_keys = True)).hexdigest()
+        return self._release_digest
+
+    def load_checkpoint(self):
+        path = self.checkpoint_file()
+        if path is None or not os.path.exists(path):
+            return
+
+        checkpoint_pickle = open(path, 'rb')
+        try:
+            checkpoint = pickle.load(checkpoint_pickle)
+        except Exception:
+            return # unreadable, eg. the write was interrupted: start over
+        finally:
+            checkpoint_pickle.close()
+
+        # the real names depend on the name exceptions as well
+        if checkpoint.get('digest') == self.release_digest() and \
+           checkpoint.get('realname_ns') == self.real_name.realname_ns:
+            self.built = checkpoint['built']
+            self.real_names.update(checkpoint['real_names'])
+
+    def save_checkpoint(self):
+        path = self.checkpoint_file()
+        if path is None:
+            return
+        if not os.path.isdir(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+
+        checkpoint = {'digest': self.release_digest(),
+                      'realname_ns': self.real_name.realname_ns,
+                      'built': self.built,
+                      'real_names': self.real_names}
+        checkpoint_pickle = open(path, 'wb')
+        try:
+            pickle.dump(checkpoint, checkpoint_pickle, pickle.HIGHEST_PROTOCOL)
+        finally:
+            checkpoint_pickle.close()
+
+    def remove_checkpoint(self):
+        path = self.checkpoint_file()
+        if path is not None and os.path.exists(path):
+            os.remove(path)
 
     '''
     INFO RETRIEVAL FUNCTIONS
@@ -194,18 +461,24 @@ class DiscogsTracklist(object):
 
     def update_itunes_library_data(self):
         self.itunesinfo.update_info()
-        self.genres = self.itunesinfo.get_genres()
-        self.labels = self.itunesinfo.get_labels()
         return
 
+    @property
+    def itunes_genres(self):
+        return self.itunesinfo.get_genres()
+
+    @property
+    def itunes_labels(self):
+        return self.itunesinfo.get_labels()
+
     def include_producer(self):
-        if self.utils.values_in_tuple(self.release.data['genres'], ('electronic', 'hip hop')):
+        if self.utils.values_in_tuple(self.release['genres'], ('electronic', 'hip hop')):
             self.composerinclude += ('producer',)
             self.composerexclude += ('producer [', 'executive producer')
         return
 
     def get_discogs_raw_tracklist(self):
-        tlist = self.release.data['tracklist']
+        tlist = self.release['tracklist']
 
         # filters out 'index' tracks which are of no relevance to iTunes
         return filter(lambda track: track['position'] != '', tlist)
@@ -214,7 +487,7 @@ class DiscogsTracklist(object):
         writers = []
         featured = []
 
-        for artist in self.release.data['extraartists']:
+        for artist in self.release['extraartists']:
             if self.utils.values_in_tuple(artist['role'], self.composerinclude, self.composerexclude):
                 writers.append(artist)
 
@@ -223,11 +496,15 @@ class DiscogsTracklist(object):
 
         return {'writers': writers, 'featured': featured}
 
+    def get_credit_index(self, credits, unscoped):
+        positions = [track['position'] for track in self.release_tracklist]
+        return CreditIndex(credits, positions, unscoped)
+
     def get_album_artist(self):
         artist_list = []
         feat_list = []
         feat = False
-        for artist in self.release.data['artists']:
+        for artist in self.release['artists']:
             if self.anv_preferred:
                 name = artist['anv']
                 get_name = name == ''
@@ -253,17 +530,50 @@ class DiscogsTracklist(object):
 
         return artist_string + feat_string
 
+    def needs_master(self):
+        '''
+        Whether the year has to come from the master release:
+        year_policy 'master' always, 'release' never, and 'auto' only if the
+        release has no year of its own or is a reissue
+        '''
+        if self.master_id is None or self.year_policy == 'release':
+            return False
+        if self.year_policy == 'master' or not self.release.get('year'):
+            return True
+
+        descriptions = []
+        for release_format in self.release.get('formats', []):
+            descriptions += release_format.get('descriptions', [])
+        return self.utils.values_in_tuple(descriptions, self.reissue_descriptions)
+
+    def fetch_master(self):
+        key = ('master', self.master_id)
+        self.master = self.fetches.submit(key, self.api.master, self.master_id)
+
+    @property
+    def year(self):
+        if self._year is None:
+            self._year = self.get_year()
+        return self._year
+
     def get_year(self):
         if self.master is None:
-            return self.release.data['year']
-        else:
-            return self.master.data['year']
+            return self.release['year']
+
+        try:
+            with profile.timer('release.master', self.release['id']):
+                return self.master.result()['year']
+        except ConnectionError:
+            self.fetch_master() # so that a retry fetches it again
+            raise
+        except discogs.DiscogsAPIError:
+            return self.release['year']
 
     def get_label(self):
-        if len(self.release.data['labels']) > 1:
+        if len(self.release['labels']) > 1:
             temp = {}
 
-            for label in self.release.data['labels']:
+            for label in self.release['labels']:
                 labelname = label['name']
 
                 if labelname in self.itunes_labels.keys():
@@ -282,44 +592,27 @@ class DiscogsTracklist(object):
 
             labelname = temp.keys()[highest]
         else:
-            labelname = self.release.data['labels'][0]['name']
+            labelname = self.release['labels'][0]['name']
 
         return self.utils.fix_discogs_string(labelname)
 
     def get_genre(self):
-        #genres = self.release.data['genres']
-        #styles = self.release.data['styles']
+        #genres = self.release['genres']
+        #styles = self.release['styles']
         return None
 
     def get_discogsid(self):
         # kind of redundant since the user must input the ID, but I guess more legitimate
-        return str(self.release.data['id'])
+        return str(self.release['id'])
 
     def get_album_name(self):
-        return self.release.data['title']
+        return self.release['title']
 
     def get_track_position_listing(self):
         '''
-        this goes through the tracklist and creates an index of the track POSITIONS:
-        uses ridiculous methods to count the number of discs used, number of tracks in a disc
-        mostly necessary because vinyl track numbers are fucking impossible to deal with
-        also very easy to get track/disc counts by requesting the last element in this list
+        (track, disc) for every track, in tracklist order (see TrackPositions)
         '''
-        tracklist = self.release_tracklist
-
-        tracklisting = []
-
-        prev_disc = -1
-        count = 0
-        for track in tracklist:
-            count += 1
-            d = self.utils.track_and_disc(track['position'])[1]
-            if prev_disc < d:
-                count = 1
-                prev_disc = d
-            tracklisting.append((count, copy(d)))
-
-        return tracklisting
+        return self.positions.numbers
 
     def get_name(self, track):
         return track['title']
@@ -364,15 +657,8 @@ class DiscogsTracklist(object):
                 if self.utils.values_in_tuple(artist['role'], self.featuringroles):
                     feat_list.append(artist)
 
-        cf = self.utils.compare_track_numbers
-        for artist in self.release_featured:
-            if artist['tracks'] != '': # this artist has credits for specific tracks -- find this one
-                track_positions = artist['tracks'].split(', ')
-                for pos in track_positions:
-                    first, last = self.utils.track_range(pos)
-                    if cf(first, position) <= 0 and cf(last, position) >= 0:
-                        feat_list.append(artist)
-                        break
+        # featured artists credited for specific tracks on the release
+        feat_list += self.featured_index.get(position)
 
         temp = []
         for artist in feat_list:
@@ -399,48 +685,60 @@ class DiscogsTracklist(object):
 
         return artist_string + feat_string
 
-    def thread_get_name(self, name, output_list):
-        real_name = self.real_name.get(name)
-        output_list += real_name
-
-    def get_writers(self, track, position):
-        cf = self.utils.compare_track_numbers
+    def get_writer_credits(self, track, position):
         writers = []
         if 'extraartists' in track.keys(): # extract writers from extraartist key in track
             for writer in track['extraartists']:
                 if self.utils.values_in_tuple(writer['role'], self.composerinclude, self.composerexclude):
                     writers.append(writer)
 
-        for writer in self.release_composers: # get writers relevant to this track from global credits
-            if writer['tracks'] != '': # this writer has credits for specific tracks -- find this one
-                track_positions = writer['tracks'].split(', ')
-                for pos in track_positions:
-                    first, last = self.utils.track_range(pos)
-                    if cf(first, position) <= 0 and cf(last, position) >= 0:
-                        writers.append(writer)
-                        break
-            else: # no specific tracks -> all tracks -> this one counts
-                writers.append(writer)
+        # get writers relevant to this track from global credits
+        writers += self.composer_index.get(position)
 
         if writers == [] and 'artists' in track.keys(): # no actual writers listed: use names of track artists
             writers += track['artists']
 
         if writers == []: # no track artists either: get global artists
-            writers += self.release.data['artists']
+            writers += self.release['artists']
 
-        real_names = []
-        '''for writer in writers:
-            real_name = self.real_name.get(writer['name'])
-            real_names += real_name'''
+        return writers
 
-        threads = []
-        for writer in writers: # now we have a list of strings; could be names, could be artist aliases -- get real names
-            thread = threading.Thread(target = self.thread_get_name, args = (writer['name'], real_names))
-            threads.append(thread)
-            thread.start()
+    def prefetch_writers(self):
+        '''
+        Works out the writer credits of every track first, then looks up the
+        real names of all the distinct writers on the release in parallel.
+        After this, get_writers only reads names from memory.
+        '''
+        if self.track_writers is None:
+            track_writers = {}
+            for track in self.release_tracklist:
+                position = track['position']
+                track_writers[position] = self.get_writer_credits(track, position)
+            self.track_writers = track_writers
+
+        names = []
+        for writers in self.track_writers.values():
+            for writer in writers:
+                if writer['name'] not in self.real_names:
+                    names.append(writer['name'])
 
-        for thread in threads:
-            thread.join()
+        self.real_name.resolve(names, self.real_names)
+
+    def get_writers(self, track, position):
+        if self.track_writers is not None and position in self.track_writers:
+            writers = self.track_writers[position]
+        else:
+            writers = self.get_writer_credits(track, position)
+
+        # now we have a list of strings; could be names, could be artist aliases -- get real names
+        missing = [writer['name'] for writer in writers
+                   if writer['name'] not in self.real_names]
+        if missing != []:
+            self.real_name.resolve(missing, self.real_names)
+
+        real_names = []
+        for writer in writers:
+            real_names += self.real_names[writer['name']]
 
         return self.utils.concat_list(real_names, '/')
 
@@ -448,17 +746,143 @@ class DiscogsTracklist(object):
         return self.tracklisting[count - 1][TRACK]
 
     def get_track_total(self, disc):
-        i = 0
-        while i < len(self.tracklisting) and self.tracklisting[i][DISC] == disc:
-            i += 1
-
-        return self.tracklisting[i - 1][TRACK]
+        return self.positions.totals[disc]
 
     def get_disc_this(self, count):
         return self.tracklisting[count - 1][DISC]
 
     def get_disc_total(self):
-        return self.tracklisting[-1][DISC]
+        return self.positions.disc_total
+
+
+class TrackPositions(object):
+    '''
+    The track positions of a release, parsed once.
+
+    Every position gets its number on its disc, counted in tracklist order
+    (so on vinyl, side B carries on where side A stopped), and the number of
+    tracks on each disc is counted up front. Parsed positions are memoized
+    for every release, since the same few strings ('1', 'A2', '2-13') come
+    up over and over.
+    '''
+
+    parsed = {} # position string -> (disc, side, track)
+
+    def __init__(self, positions):
+        self.numbers = [] # (track, disc) of each position
+        self.totals = {}  # disc -> number of tracks on it
+
+        prev_disc = -1
+        count = 0
+        for position in positions:
+            count += 1
+            disc = self.parse(position)[0]
+            if prev_disc < disc:
+                count = 1
+                prev_disc = disc
+            self.numbers.append((count, disc))
+            self.totals[disc] = max(self.totals.get(disc, 0), count)
+
+        self.disc_total = self.numbers[-1][DISC] if self.numbers else 0
+
+    @classmethod
+    def parse(cls, position):
+        '''
+        '5' -> (1, 0, 5), '2-13' -> (2, 0, 13), 'C2' -> (2, 1, 2), 'D' -> (2, 2, 1)
+        (disc, side, track); the side of a record is 1 or 2, 0 if it has none
+        '''
+        position = str(position)
+        if position in cls.parsed:
+            return cls.parsed[position]
+
+        if position[0].isdigit():
+            match = re.match(r'(\d+)-(\d+)', position)
+            if match is not None:
+                disc, track = int(match.group(1)), int(match.group(2))
+            else:
+                disc, track = 1, int(re.match(r'\d+', position).group())
+            side = 0
+        else:
+            # two sides per disc: A and B are disc 1, C and D disc 2...
+            letter = ord(position[0].upper()) - 65
+            disc = letter // 2 + 1
+            side = letter % 2 + 1
+            match = re.match(r'\d+', position[1:])
+            track = int(match.group()) if match is not None else 1
+
+        cls.parsed[position] = (disc, side, track)
+        return cls.parsed[position]
+
+    @classmethod
+    def key(cls, position):
+        '''
+        Integer that sorts positions in the order they are on the release
+        '''
+        disc, side, track = cls.parse(position)
+        return (disc << 32) | (side << 16) | track
+
+
+class CreditIndex(object):
+    '''
+    Release-wide credits, indexed by the tracks they apply to.
+
+    The 'tracks' strings of the credits ('1 to 4, 7', 'A2 to B4') are parsed
+    once, and every track position of the release gets its list of credits
+    up front, so looking up the credits for a track is a single dict lookup.
+    Credits with no tracks apply to every track if :unscoped: is True, and
+    are ignored otherwise.
+    '''
+
+    def __init__(self, credits, positions, unscoped = True):
+        self.utils = Utilities()
+        self.ranges = [] # (first key, last key, credit), in credit order
+        self.unscoped = []
+
+        for credit in credits:
+            if credit['tracks'] != '':
+                for pos in credit['tracks'].split(', '):
+                    first, last = self.utils.track_range(pos)
+                    self.ranges.append((self.key(first), self.key(last), credit))
+            elif unscoped:
+                self.unscoped.append(credit)
+
+        self.index = {}
+        for position in positions:
+            self.index[position] = []
+
+        keyed = sorted((self.key(position), position) for position in positions)
+        keys = [key for key, position in keyed]
+        self.order = dict((id(credit), i) for i, credit in enumerate(credits))
+        for first, last, credit in self.ranges:
+            for key, position in keyed[bisect_left(keys, first):
+                                       bisect_right(keys, last)]:
+                if credit not in self.index[position]:
+                    self.index[position].append(credit)
+
+        for position in positions:
+            self.index[position] = self.in_order(self.unscoped +
+                                                 self.index[position])
+
+    def key(self, position):
+        return TrackPositions.key(position)
+
+    def get(self, position):
+        '''
+        Credits that apply to the track at :position:, in the order they are
+        listed on the release
+        '''
+        if position in self.index:
+            return list(self.index[position])
+
+        key = self.key(position)
+        credited = []
+        for first, last, credit in self.ranges:
+            if first <= key <= last and credit not in credited:
+                credited.append(credit)
+        return self.in_order(self.unscoped + credited)
+
+    def in_order(self, credits):
+        return sorted(credits, key = lambda credit: self.order[id(credit)])
 
 
 class ItunesInfo(object):
@@ -467,53 +891,78 @@ class ItunesInfo(object):
     iTunes library. PyTunesFixer prefers a label name which already exists in
     the user's library. Right now it also gets genre info, but this isn't
     used yet.
+
+    Nothing is done until it's needed: iTunes is only connected to when the
+    library is read, and the stats are loaded once, on first use.
     '''
 
     def __init__(self):
-        iTunes = win32com.client.gencache.EnsureDispatch("iTunes.Application")
-        self.library = iTunes.LibraryPlaylist.Tracks
+        self.iTunes = None
+        self.snapshot = LibrarySnapshot()
+        self.loaded = False
+        self.lock = threading.RLock()
+
+        # counts from before the snapshot existed
         self.genre_file = 'genres.pkl'
         self.label_file = 'labels.pkl'
-        self.genres = {}
-        self.labels = {}
-
-    def update(self, d, key):
-        if key not in d.keys():
-            d[key] = 1
-        else:
-            d[key] += 1
-        return
-
-    def update_info(self):
-        print "Getting information from iTunes Library"
+        self.legacy_genres = {}
+        self.legacy_labels = {}
+
+    def connect(self):
+        with self.lock:
+            if self.iTunes is None:
+                self.iTunes = win32com.client.gencache.EnsureDispatch("iTunes.Application")
+        return self.iTunes
+
+    @property
+    def library(self):
+        return self.connect().LibraryPlaylist.Tracks
+
+    def load(self):
+        with self.lock:
+            if not self.loaded:
+                if not self.snapshot.load():
+                    self.legacy_genres = self.read_legacy(self.genre_file)
+                    self.legacy_labels = self.read_legacy(self.label_file)
+                self.loaded = True
+
+    def read_track(self, track):
+        try:
+            genre = track.Genre
+        except:
+            genre = None
+            print 'failed to retrieve genre'
+        try:
+            label = track.Grouping
+        except:
+            label = None
+            print 'failed to retrieve label'
+        return genre, label
 
+    def library_entries(self):
+        '''
+        (key, modification stamp, read) for every track in the library;
+        genre and label are only read if the snapshot asks for them
+        '''
         for track in self.library:
             try:
-                print track.Name
-            except:
-                print 'fail'
-            try:
-                genre = track.Genre
-            except:
-                genre = None
-                print 'failed to retrieve genre'
-            try:
-                label = track.Grouping
+                key = self.iTunes.GetITObjectPersistentIDs(track)
+                stamp = str(track.ModificationDate)
             except:
-                label = None
-                print 'failed to retrieve label'
+                print 'failed to retrieve track'
+                continue
 
-            self.update(self.genres, genre)
-            self.update(self.labels, label)
+            yield key, stamp, lambda track = track: self.read_track(track)
 
-        genre_pickle = open(self.genre_file, 'wb')
-        label_pickle = open(self.label_file, 'wb')
+    def update_info(self):
+        print "Getting information from iTunes Library"
 
-        pickle.dump(self.genres, genre_pickle)
-        pickle.dump(self.labels, label_pickle)
+        with self.lock:
+            self.load()
+            added, changed, removed = self.snapshot.refresh(self.library_entries())
+            self.snapshot.save()
 
-        genre_pickle.close()
-        label_pickle.close()
+        print '%s tracks added, %s changed, %s removed' % (added, changed, removed)
         return
 
     def print_d(self, d):
@@ -534,17 +983,151 @@ class ItunesInfo(object):
             print "{0:40} {1}".format(keys[highest_key], highest)
             keys.pop(highest_key)
 
+    def read_legacy(self, pickle_file):
+        if not os.path.exists(pickle_file):
+            return {}
+        legacy_pickle = open(pickle_file, 'rb')
+        d = pickle.load(legacy_pickle)
+        legacy_pickle.close()
+        return d
+
     def get_genres(self):
-        genre_pickle = open(self.genre_file, 'rb')
-        genres = pickle.load(genre_pickle)
-        genre_pickle.close()
-        return genres
+        self.load()
+        if self.snapshot.tracks == {}:
+            return self.legacy_genres
+        return self.snapshot.genres
 
     def get_labels(self):
-        label_pickle = open(self.label_file, 'rb')
-        labels = pickle.load(label_pickle)
-        label_pickle.close()
-        return labels
+        self.load()
+        if self.snapshot.tracks == {}:
+            return self.legacy_labels
+        return self.snapshot.labels
+
+
+_itunes_info = None
+_itunes_info_lock = threading.Lock()
+
+def shared_itunes_info():
+    '''
+    The ItunesInfo every DiscogsTracklist in the process uses, so the library
+    stats are loaded at most once.
+    '''
+    global _itunes_info
+    with _itunes_info_lock:
+        if _itunes_info is None:
+            _itunes_info = ItunesInfo()
+        return _itunes_info
+
+
+def normalize_name(name):
+    '''
+    The form names are compared in: NFC, lowercase, single spaces
+    '''
+    if not isinstance(name, unicode):
+        name = name.decode('utf-8')
+    return u' '.join(unicodedata.normalize('NFC', name).lower().split())
+
+
+class NameExceptions(object):
+    '''
+    The real names in :exceptions_file: that should be shown differently:
+    each Discogs real name is on a line, followed by the name to use on the
+    next line. Lines starting with # are comments.
+
+    Names are indexed normalized (see normalize_name), so an entry matches
+    whatever case or Unicode form Discogs uses. The file is read again when
+    it changes, checked at most every :check_interval: seconds; if the new
+    version is invalid, the old one stays in use.
+    '''
+
+    def __init__(self, exceptions_file = 'realname_exceptions.txt', check_interval = 1.0):
+        self.exceptions_file = exceptions_file
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.index = {}
+        self.stamp = None # modification time and size of the file read
+        self.checked = 0
+        self._digest = None
+        self.reload()
+
+    def read(self):
+        '''
+        Parses and validates the file; returns {normalized name: name to use}
+        '''
+        f = codecs.open(self.exceptions_file, encoding = 'utf-8-sig')
+        try:
+            lines = f.read().replace('\r', '').split('\n')
+        finally:
+            f.close()
+
+        entries = [(number + 1, line.strip()) for number, line in enumerate(lines)
+                   if line.strip() != '' and not line.startswith('#')]
+        if len(entries) % 2 != 0:
+            raise ValueError('%s line %s: %s has no replacement' %
+                             ((self.exceptions_file,) + entries[-1]))
+
+        index = {}
+        for i in range(0, len(entries), 2):
+            (number, name), (unused, replacement) = entries[i], entries[i + 1]
+            key = normalize_name(name)
+            replacement = unicodedata.normalize('NFC', replacement)
+            if index.get(key, replacement) != replacement:
+                raise ValueError('%s line %s: %s is already replaced with %s' %
+                                 (self.exceptions_file, number, name, index[key]))
+            index[key] = replacement
+        return index
+
+    def reload(self):
+        '''
+        Reads the file if it changed since it was last read
+        '''
+        with self.lock:
+            self.checked = time.time()
+            try:
+                stat = os.stat(self.exceptions_file)
+                stamp = (stat.st_mtime, stat.st_size)
+            except OSError:
+                stamp = None
+            if stamp == self.stamp and self._digest is not None:
+                return False
+
+            if stamp is None:
+                index = {}
+            else:
+                try:
+                    index = self.read()
+                except (ValueError, UnicodeError), e:
+                    if self._digest is None:
+                        raise # nothing to fall back on
+                    print 'Not reloading name exceptions: %s' % e
+                    self.stamp = stamp
+                    return False
+
+            self.index = index
+            self.stamp = stamp
+            self._digest = hashlib.md5(repr(sorted(index.items()))).hexdigest()
+            return True
+
+    def check(self):
+        if time.time() - self.checked >= self.check_interval:
+            self.reload()
+
+    def get(self, name):
+        '''
+        The name to use instead of :name:, or None
+        '''
+        self.check()
+        return self.index.get(normalize_name(name))
+
+    def digest(self):
+        '''
+        Fingerprint of the exceptions in use
+        '''
+        self.check()
+        return self._digest
+
+    def __len__(self):
+        return len(self.index)
 
 
 class RealName(object):
@@ -552,25 +1135,29 @@ class RealName(object):
     The 'get' function is useful. It gets (a) real name(s) from an artist name.
     '''
 
-    def __init__(self, exceptions_file = 'realname_exceptions.txt'):
+    # shared by every RealName: at most this many lookups run at once, and
+    # the same name is never looked up twice at the same time
+    lookups = SingleFlight(WorkerPool(workers = 8))
+    # the members of a group are fetched together, on their own pool so that
+    # lookups already running can wait for them
+    member_fetches = SingleFlight(WorkerPool(workers = 8))
+
+    # groups within groups are expanded this deep; deeper ones are credited
+    # by their own name
+    max_depth = 4
+
+    def __init__(self, exceptions_file = 'realname_exceptions.txt', cache = None,
+                 api = None):
+        self.api = api if api is not None else default_api()
         self.utils = Utilities()
-        self.exceptions = self.read_exceptions(exceptions_file)
-        self.artist_cache = {}
-
-    def read_exceptions(self, exceptions_file):
-        exceptions = {}
-        f = codecs.open(exceptions_file, encoding = 'utf-8')
-        contents = f.read()
-        f.close()
-        contents = contents.replace('\r', '')
-        contents = contents.split('\n')
-        contents = filter(lambda line: line[0].startswith('#') == False,
-                          contents)
-        assert len(contents) % 2 == 0
-        for i in range(len(contents)):
-            if i % 2 == 0:
-                exceptions[contents[i]] = contents[i + 1]
-        return exceptions
+        self.exceptions = NameExceptions(exceptions_file)
+        self.cache = cache if cache is not None else shared_cache()
+
+    @property
+    def realname_ns(self):
+        # resolved names depend on the exceptions, so they are cached per
+        # version of the exceptions file
+        return 'realname:' + self.exceptions.digest()[:8]
 
     def fix(self, name):
         '''
@@ -582,13 +1169,9 @@ class RealName(object):
              -> Norman Cook
         '''
         # process any possible listed exception
-        exempted = False
-        for exception in self.exceptions:
-            if exception[0] == name:
-                result = exception[1]
-                exempted = True
+        result = self.exceptions.get(name)
 
-        if not exempted:
+        if result is None:
             # this removes any type of bullshit in brackets
             i = len(name)
             while i >= 0:
@@ -624,29 +1207,150 @@ class RealName(object):
 
         return result
 
-    def get(self, writer):
-        if writer in self.artist_cache.keys():
-            artist = self.artist_cache[writer]
-        else:
-            artist = discogs.Artist(writer)
-            self.artist_cache[writer] = artist
+    def get_artist_data(self, writer):
+        '''
+        Artist data from the cache, or from Discogs if it isn't cached yet.
+        Returns None if Discogs doesn't know the artist.
+        '''
+        adata = self.cache.get('artist', writer)
+        if adata is FAILED:
+            return None
+        if adata is MISS:
+            try:
+                with profile.timer('realname.fetch'):
+                    adata = self.api.artist(writer)
+            except discogs.DiscogsAPIError:
+                self.cache.put_negative('artist', writer)
+                return None
+            self.cache.put('artist', writer, adata)
             print '.',
+        return adata
 
-        if artist.name == 'Various':
-            result = ['']
+    def get(self, writer):
+        return self.expand(writer, ())[0]
+
+    def get_cached(self, writer, artist_id = None):
+        '''
+        Resolved names of a writer from the cache, by name or artist ID, or
+        None
+        '''
+        keys = [writer]
+        if artist_id is not None:
+            keys.append('id:%s' % artist_id)
+        for key in keys:
+            result = self.cache.get(self.realname_ns, key)
+            if result is not MISS and result is not FAILED:
+                return result
+        return None
+
+    def expand(self, writer, path, artist_id = None):
+        '''
+        Returns (names, complete). :path: are the groups being expanded that
+        this writer is a member of. complete is False if a cycle or
+        max_depth cut the expansion short; such results aren't cached.
+        '''
+        if writer == 'Various':
+            return [''], True
+
+        result = self.get_cached(writer, artist_id)
+        if result is not None:
+            return result, True
+
+        adata = self.get_artist_data(writer)
+        complete = True
+        if adata is None:
+            # unknown to Discogs: the credited name is the best we've got
+            result = [self.utils.fix_discogs_string(writer)]
+        elif 'members' in adata.keys():
+            result, complete = self.expand_members(adata, path + (writer,))
+        elif 'realname' in adata.keys():
+            result = []
+            for name in re.split(' & |, ', adata['realname']):
+                result += [self.fix(name.strip())]
         else:
-            adata = artist.data
-            if 'members' in adata.keys():
-                result = []
-                for artist in adata['members']:
-                    result += self.get(artist)
-            elif 'realname' in adata.keys():
-                result = []
-                for name in re.split(' & |, ', adata['realname']):
-                    result += [self.fix(name.strip())]
+            result = [self.utils.fix_discogs_string(adata['name'])]
+
+        if complete:
+            self.cache.put(self.realname_ns, writer, result)
+            if adata is not None and adata.get('id') is not None:
+                self.cache.put(self.realname_ns, 'id:%s' % adata['id'], result)
+        return result, complete
+
+    def expand_members(self, adata, path):
+        '''
+        Real names of every member of a group
+        '''
+        # members are names, or {'id', 'name'} dicts
+        members = []
+        for member in adata['members']:
+            if isinstance(member, dict):
+                members.append((member['name'], member.get('id')))
             else:
-                result = [self.utils.fix_discogs_string(adata['name'])]
+                members.append((member, None))
+
+        if len(path) > self.max_depth:
+            return [self.utils.fix_discogs_string(name) for name, artist_id in members], False
+
+        # everything that isn't resolved yet is fetched at once
+        futures = [self.member_fetches.submit(('artist', name), self.get_artist_data, name)
+                   for name, artist_id in members
+                   if name not in path and self.get_cached(name, artist_id) is None]
+        for future in futures:
+            future.result()
+
+        result = []
+        complete = True
+        for name, artist_id in members:
+            if name in path: # a group that is (indirectly) its own member
+                complete = False
+                continue
+            names, member_complete = self.expand(name, path, artist_id)
+            result += names
+            complete = complete and member_complete
+
+        if result == []:
+            result = [self.utils.fix_discogs_string(adata['name'])]
+        return result, complete
+
+    def resolve(self, writers, resolved = None):
+        '''
+        Looks up the real names of several writers in parallel.
+        Returns a dict of writer -> list of real names; with :resolved:, adds
+        them to that dict. Names that resolved are kept even if others fail;
+        the first failure is raised once every lookup has finished.
+        '''
+        if resolved is None:
+            resolved = {}
+
+        futures = {}
+        for writer in writers:
+            if writer not in futures:
+                key = (self.realname_ns, writer)
+                futures[writer] = self.lookups.submit(key, self.get, writer)
+
+        error = None
+        for writer, future in futures.items():
+            try:
+                resolved[writer] = future.result()
+            except Exception:
+                if error is None:
+                    error = sys.exc_info()
+
+        if error is not None:
+            raise error[0], error[1], error[2]
+        return resolved
+
+    def get_many(self, writers):
+        '''
+        Real names for several writers, looked up in parallel. Names come back
+        in the order the writers were given, whatever order the lookups
+        finish in.
+        '''
+        resolved = self.resolve(writers)
 
+        result = []
+        for writer in writers:
+            result += resolved[writer]
         return result
 
 
@@ -763,18 +1467,4 @@ class Utilities(object):
         return result
 
     def compare_track_numbers(self, track1, track2):
-        track_1, disc_1 = self.track_and_disc(track1)
-        track_2, disc_2 = self.track_and_disc(track2)
-
-        if disc_1 > disc_2:
-            result = GREATER
-        elif disc_1 < disc_2:
-            result = LESSER
-        else:
-            if track_1 > track_2:
-                result = GREATER
-            elif track_1 < track_2:
-                result = LESSER
-            else:
-                result = EQUALS
-        return result
+        return cmp(TrackPositions.key(track1), TrackPositions.key(track2))
@@ -0,0 +1,250 @@
+'''
+Created on Oct 18, 2026
+Author: George Lifchits
+
+Finds the Discogs release a set of iTunes tracks most likely came from, so
+nobody has to look up and type in release IDs by hand.
+
+Candidates come from a local ReleaseIndex of releases we already know (the
+ones in the PayloadStore) and from the Discogs search. They are ranked by
+how well the album title and artist match and by how close the number of
+tracks is to the number of tracks selected.
+'''
+
+from discogs_api import default_api
+from collections import defaultdict
+import unicodedata
+import threading
+import re
+
+STOP_WORDS = frozenset(['the', 'a', 'and', 'of', 'feat', 'ft', 'vs'])
+
+
+def normalize(text):
+    '''
+    Lowercase, without accents, brackets or punctuation:
+    u'Beyonc\xe9 (2)' -> u'beyonce 2'
+    '''
+    if text is None:
+        return u''
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8', 'replace')
+    text = unicodedata.normalize('NFKD', text)
+    text = u''.join(char for char in text if not unicodedata.combining(char))
+    return u' '.join(re.findall(r'\w+', text.lower(), re.UNICODE))
+
+def tokens(text):
+    return set(normalize(text).split()) - STOP_WORDS
+
+def ngrams(text, n = 3):
+    '''
+    Character n-grams of the normalized text, padded so that short words
+    still have some
+    '''
+    text = u' %s ' % normalize(text)
+    return set(text[i:i + n] for i in range(len(text) - n + 1))
+
+def similarity(grams1, grams2):
+    '''
+    Jaccard similarity of two sets of n-grams
+    '''
+    if not grams1 or not grams2:
+        return 0.0
+    return len(grams1 & grams2) / float(len(grams1 | grams2))
+
+def release_artist(release):
+    '''
+    'Artist & Other Artist' of a release dict, without the numbers Discogs
+    puts on duplicate names
+    '''
+    names = [re.sub(r' \(\d+\)$', '', artist.get('name', ''))
+             for artist in release.get('artists', [])]
+    return u' & '.join(names)
+
+
+class Candidate(object):
+    '''
+    A release the tracks might be from, and how likely that is (0-1)
+    '''
+
+    def __init__(self, release_id, artist, title, track_count = None, score = 0.0):
+        self.release_id = release_id
+        self.artist = artist
+        self.title = title
+        self.track_count = track_count
+        self.score = score
+
+    def __unicode__(self):
+        tracks = '?' if self.track_count is None else self.track_count
+        return u'%s - %s (%s tracks, ID %s): %.0f%%' % \
+               (self.artist, self.title, tracks, self.release_id, self.score * 100)
+
+    def __str__(self):
+        return unicode(self).encode('utf-8', 'replace')
+
+
+class ReleaseIndex(object):
+    '''
+    Releases we know, indexed by the normalized tokens and the character
+    trigrams of their artist and title. Tokens find the candidates quickly;
+    trigrams still find them when a word is spelled a little differently.
+    Finders on several threads add to it and search it at the same time.
+    '''
+
+    def __init__(self):
+        self.releases = {} # release ID -> (artist, title, track count)
+        self.token_index = defaultdict(set)
+        self.gram_index = defaultdict(set)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.releases)
+
+    def add(self, release_id, artist, title, track_count = None):
+        text = u'%s %s' % (normalize(artist), normalize(title))
+        release_tokens = tokens(text)
+        release_grams = ngrams(text)
+        with self.lock:
+            self.releases[release_id] = (artist, title, track_count)
+            for token in release_tokens:
+                self.token_index[token].add(release_id)
+            for gram in release_grams:
+                self.gram_index[gram].add(release_id)
+
+    def add_release(self, release):
+        tracks = [track for track in release.get('tracklist', [])
+                  if track.get('position', '') != '']
+        self.add(release['id'], release_artist(release), release.get('title', ''),
+                 len(tracks))
+
+    @classmethod
+    def from_store(cls, store):
+        '''
+        Index of every release in a PayloadStore
+        '''
+        index = cls()
+        for key, release in store.items('release'):
+            index.add_release(release)
+        return index
+
+    def search(self, artist, title, limit = 20):
+        '''
+        Up to :limit: candidates, those sharing the most tokens (or, with no
+        tokens in common, trigrams) with the artist and title first
+        '''
+        text = u'%s %s' % (normalize(artist), normalize(title))
+        hits = defaultdict(int)
+        with self.lock:
+            for token in tokens(text):
+                for release_id in self.token_index.get(token, ()):
+                    hits[release_id] += 1
+            if not hits:
+                grams = ngrams(text)
+                for gram in grams:
+                    for release_id in self.gram_index.get(gram, ()):
+                        hits[release_id] += 1
+                # a few shared trigrams is just noise
+                hits = dict((release_id, count) for release_id, count in hits.items()
+                            if count >= len(grams) // 3)
+
+            best = sorted(hits, key = lambda release_id: -hits[release_id])[:limit]
+            return [Candidate(release_id, *self.releases[release_id]) for release_id in best]
+
+
+class ReleaseFinder(object):
+    '''
+    Ranks the candidate releases for a group of tracks (one album).
+
+    Title, artist and track count are weighted by :title_weight:,
+    :artist_weight: and :count_weight:. Candidates from the search whose
+    track count isn't known are fetched for it, at most :fetch: of them,
+    the best first.
+    '''
+
+    def __init__(self, api = None, index = None, search = True, limit = 5,
+                 fetch = 5, title_weight = 0.45, artist_weight = 0.35,
+                 count_weight = 0.2):
+        self.api = api if api is not None else default_api()
+        self.index = index
+        self.search = search
+        self.limit = limit
+        self.fetch = fetch
+        self.title_weight = title_weight
+        self.artist_weight = artist_weight
+        self.count_weight = count_weight
+
+    def describe(self, tracks):
+        '''
+        (artist, album, number of tracks) of a group of tracks: the values
+        most of them have
+        '''
+        def most_common(values):
+            values = [value for value in values if value]
+            if values == []:
+                return u''
+            return max(set(values), key = values.count)
+
+        artist = most_common([getattr(track, 'AlbumArtist', None) for track in tracks])
+        if not artist:
+            artist = most_common([track.Artist for track in tracks])
+        album = most_common([track.Album for track in tracks])
+        return artist, album, len(tracks)
+
+    def candidates(self, artist, album):
+        found = {}
+        if self.index is not None:
+            for candidate in self.index.search(artist, album):
+                found[candidate.release_id] = candidate
+        if self.search:
+            for result in self.api.search(u'%s %s' % (artist, album)):
+                if result['id'] not in found:
+                    found[result['id']] = Candidate(result['id'], result['artist'],
+                                                    result['title'])
+        return found.values()
+
+    def score(self, candidate, artist, album, count):
+        title_score = similarity(ngrams(album), ngrams(candidate.title))
+        artist_score = similarity(ngrams(artist), ngrams(candidate.artist))
+        if candidate.track_count:
+            count_score = min(count, candidate.track_count) / \
+                          float(max(count, candidate.track_count))
+        else:
+            count_score = 0.0
+        return self.title_weight * title_score + \
+               self.artist_weight * artist_score + \
+               self.count_weight * count_score
+
+    def find(self, tracks):
+        '''
+        The :limit: best candidates for :tracks:, best first
+        '''
+        artist, album, count = self.describe(tracks)
+        if not album:
+            return []
+
+        candidates = self.candidates(artist, album)
+        for candidate in candidates:
+            candidate.score = self.score(candidate, artist, album, count)
+        candidates.sort(key = lambda candidate: -candidate.score)
+
+        # the track count of the best ones decides between them
+        unknown = [candidate for candidate in candidates if candidate.track_count is None]
+        for candidate in unknown[:self.fetch]:
+            release = self.api.release(candidate.release_id)
+            candidate.track_count = len([track for track in release.get('tracklist', [])
+                                         if track.get('position', '') != ''])
+            candidate.score = self.score(candidate, artist, album, count)
+            if self.index is not None:
+                self.index.add_release(release)
+        candidates.sort(key = lambda candidate: -candidate.score)
+
+        return candidates[:self.limit]
+
+    def best(self, tracks, min_score = 0.75):
+        '''
+        The best candidate, or None if it isn't at least :min_score:
+        '''
+        candidates = self.find(tracks)
+        if candidates and candidates[0].score >= min_score:
+            return candidates[0]
+        return None
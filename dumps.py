@@ -0,0 +1,244 @@
+'''
+Created on Oct 18, 2026
+Author: George Lifchits
+
+Reads the monthly Discogs data dumps (http://data.discogs.com) into a local
+DumpStore, so releases, masters and artists can be looked up without going
+through the API at all:
+
+    python dumps.py discogs_20260901_artists.xml.gz discogs_20260901_releases.xml.gz
+
+The dumps are many gigabytes, so they are parsed incrementally, one
+<artist>/<release>/<master> at a time, and written in batches. The data is
+stored in the same shape the API returns it in.
+'''
+
+import xml.etree.cElementTree as etree
+import argparse
+import sqlite3
+import sys
+import gzip
+import json
+import zlib
+import time
+import threading
+
+KINDS = {'artists': 'artist', 'releases': 'release', 'masters': 'master'}
+
+
+class DumpStore(object):
+    '''
+    Artists (by name), releases and masters (by ID) from the dumps, as
+    compressed JSON.
+    '''
+
+    def __init__(self, store_file = 'discogs_dump.db'):
+        self.store_file = store_file
+        self.lock = threading.RLock()
+
+        self.db = sqlite3.connect(store_file, check_same_thread = False)
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS artist (
+                               key TEXT PRIMARY KEY,
+                               id INTEGER,
+                               data BLOB NOT NULL)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS artist_id ON artist (id)')
+        for kind in ('release', 'master'):
+            self.db.execute('''CREATE TABLE IF NOT EXISTS %s (
+                                   key INTEGER PRIMARY KEY,
+                                   id INTEGER,
+                                   data BLOB NOT NULL)''' % kind)
+        self.db.commit()
+
+    def get(self, kind, key):
+        '''
+        The data of an artist, release or master, or None if it isn't in the
+        dumps
+        '''
+        if kind not in KINDS.values():
+            return None
+        if kind != 'artist':
+            try:
+                key = int(key)
+            except ValueError:
+                return None
+        with self.lock:
+            row = self.db.execute('SELECT data FROM %s WHERE key = ?' % kind,
+                                  (key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(zlib.decompress(row[0]))
+
+    def put_many(self, kind, items):
+        '''
+        Stores a batch of data dicts of one kind, in one transaction
+        '''
+        rows = []
+        for data in items:
+            key = data['name'] if kind == 'artist' else data['id']
+            text = json.dumps(data, separators = (',', ':'))
+            rows.append((key, data.get('id'), sqlite3.Binary(zlib.compress(text))))
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO %s (key, id, data) '
+                                'VALUES (?, ?, ?)' % kind, rows)
+            self.db.commit()
+
+    def count(self, kind):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM %s' % kind).fetchone()[0]
+
+
+def text(elem, path):
+    return elem.findtext(path) or u''
+
+def texts(elem, path):
+    return [child.text for child in elem.findall(path) if child.text]
+
+def number(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def credits(elem, path):
+    '''
+    <artist> credits, like the API's 'artists' and 'extraartists'
+    '''
+    return [{'id': number(artist.findtext('id')),
+             'name': text(artist, 'name'),
+             'anv': text(artist, 'anv'),
+             'join': text(artist, 'join'),
+             'role': text(artist, 'role'),
+             'tracks': text(artist, 'tracks')}
+            for artist in elem.findall(path)]
+
+def artist_data(elem):
+    data = {'id': number(elem.findtext('id')),
+            'name': text(elem, 'name')}
+    if elem.findtext('realname'):
+        data['realname'] = text(elem, 'realname')
+    for key in ('aliases', 'namevariations', 'members', 'groups'):
+        names = texts(elem, key + '/name')
+        if names != []:
+            data[key] = names
+    return data
+
+def release_data(elem):
+    released = text(elem, 'released')
+    data = {'id': number(elem.get('id')),
+            'status': elem.get('status', ''),
+            'title': text(elem, 'title'),
+            'artists': credits(elem, 'artists/artist'),
+            'extraartists': credits(elem, 'extraartists/artist'),
+            'labels': [{'name': label.get('name', ''), 'catno': label.get('catno', '')}
+                       for label in elem.findall('labels/label')],
+            'formats': [{'name': form.get('name', ''),
+                         'qty': form.get('qty', ''),
+                         'descriptions': texts(form, 'descriptions/description')}
+                        for form in elem.findall('formats/format')],
+            'genres': texts(elem, 'genres/genre'),
+            'styles': texts(elem, 'styles/style'),
+            'country': text(elem, 'country'),
+            'released': released,
+            'year': number(released[:4]) or 0,
+            'notes': text(elem, 'notes'),
+            'master_id': number(elem.findtext('master_id')),
+            'tracklist': []}
+
+    for track in elem.findall('tracklist/track'):
+        track_data = {'position': text(track, 'position'),
+                      'title': text(track, 'title'),
+                      'duration': text(track, 'duration')}
+        # like the API: only tracks with their own credits have these
+        for key in ('artists', 'extraartists'):
+            if track.find(key) is not None:
+                track_data[key] = credits(track, key + '/artist')
+        data['tracklist'].append(track_data)
+    return data
+
+def master_data(elem):
+    return {'id': number(elem.get('id')),
+            'main_release': number(elem.findtext('main_release')),
+            'title': text(elem, 'title'),
+            'year': number(elem.findtext('year')) or 0,
+            'artists': credits(elem, 'artists/artist'),
+            'genres': texts(elem, 'genres/genre'),
+            'styles': texts(elem, 'styles/style')}
+
+CONVERTERS = {'artist': artist_data, 'release': release_data, 'master': master_data}
+
+
+def open_dump(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+def ingest(path, store, batch_size = 1000, progress = None):
+    '''
+    Streams one dump file into :store:. Only the element being read is in
+    memory; the rest of the tree is thrown away as it goes. Every
+    :batch_size: items are written in one transaction, and
+    progress(kind, count) is called after each batch. Returns the number of
+    items read.
+    '''
+    f = open_dump(path)
+    try:
+        depth = 0
+        root = None
+        kind = None
+        batch = []
+        count = 0
+
+        for event, elem in etree.iterparse(f, events = ('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = elem
+                    kind = KINDS.get(elem.tag)
+                    if kind is None:
+                        raise ValueError('%s is not a Discogs dump (<%s>)' % (path, elem.tag))
+                depth += 1
+                continue
+
+            depth -= 1
+            if depth != 1: # only whole artists/releases/masters
+                continue
+
+            batch.append(CONVERTERS[kind](elem))
+            root.clear()
+            if len(batch) >= batch_size:
+                store.put_many(kind, batch)
+                count += len(batch)
+                batch = []
+                if progress is not None:
+                    progress(kind, count)
+
+        if batch != []:
+            store.put_many(kind, batch)
+            count += len(batch)
+            if progress is not None:
+                progress(kind, count)
+        return count
+    finally:
+        f.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.split('\n\n')[1])
+    parser.add_argument('dumps', nargs = '+',
+                        help = 'artists, releases or masters dumps (.xml or .xml.gz)')
+    parser.add_argument('--store', default = 'discogs_dump.db')
+    parser.add_argument('--batch', type = int, default = 1000)
+    args = parser.parse_args()
+
+    store = DumpStore(args.store)
+    for path in args.dumps:
+        start = time.time()
+        report = lambda kind, count: \
+            sys.stdout.write('\r%s: %s %ss (%.0f/s)' %
+                             (path, count, kind, count / max(time.time() - start, 0.001)))
+        count = ingest(path, store, args.batch, report)
+        print '\n%s: %s items in %.0fs' % (path, count, time.time() - start)
+
+
+if __name__ == '__main__':
+    main()
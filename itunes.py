@@ -10,8 +10,16 @@ detailed metadata from Discogs.com and systematically apply it to
 iTunes library music.
 '''
 
-from discogs_tracklist import DiscogsTracklist
+from discogs_tracklist import DiscogsTracklist, RealName, Track
+from discogs_api import default_api
+from discovery import ReleaseFinder, ReleaseIndex
+from matching import TrackMatcher
+from pipeline import Pipeline
+from profiling import profile
 import win32com.client
+import argparse
+import atexit
+import threading
 import time
 import sys
 import difflib
@@ -30,26 +38,89 @@ def connect_to_itunes():
         log.error('Connection failed. Application terminated.')
         sys.exit()
 
+def snapshot(track):
+    '''
+    A Track holding the fields of an iTunes track that matching and release
+    discovery need, read once so nothing else has to touch the COM object
+    '''
+    profile.count('com.reads', 6)
+    return Track(Name = track.Name,
+                 Artist = track.Artist,
+                 AlbumArtist = track.AlbumArtist,
+                 Album = track.Album,
+                 TrackNumber = track.TrackNumber,
+                 DiscNumber = track.DiscNumber)
+
+def release_finder():
+    '''
+    A ReleaseFinder that also looks through the releases fetched before
+    '''
+    api = default_api()
+    index = ReleaseIndex.from_store(api.store) if api.store is not None else None
+    return ReleaseFinder(api, index)
+
 
 class FixiTunesFromID(object):
 
-    def __init__(self):
+    def __init__(self, dry_run = False):
+        self.dry_run = dry_run
         self.iTunes = connect_to_itunes()
+        self._finder = None
+        self.finder_lock = threading.Lock()
         rel_id = self.get_release_id()
-        discogs = DiscogsTracklist(rel_id)
+        discogs = DiscogsTracklist(rel_id, build = False)
         self.discogs_tracklist = discogs.get_release_info()
         self.utils = FixerUtilities()
         self.start_tool()
 
+    @property
+    def finder(self):
+        # indexing the stored releases takes a while: only when looking one
+        # up, and only once however many fetch workers ask for it
+        with self.finder_lock:
+            if self._finder is None:
+                self._finder = release_finder()
+        return self._finder
+
     def get_release_id(self):
+        answer = raw_input('Enter Discogs release ID (or nothing to look it up '
+                           'from the selected tracks): ').strip()
+        if answer == '':
+            return self.find_release_id()
+
         try:
-            rel_id = int(raw_input('Enter Discogs release ID: ').strip())
+            rel_id = int(answer)
         except:
             log.info('Invalid release ID. Try again.')
             rel_id = self.get_release_id()
 
         return rel_id
 
+    def find_release_id(self):
+        '''
+        Lists the releases the selected tracks could be from and lets the
+        user pick one
+        '''
+        raw_input('Select the tracks of one album in iTunes (any key to continue)')
+        selected = self.iTunes.SelectedTracks
+        if selected is None:
+            log.info('Nothing selected in iTunes')
+            return self.get_release_id()
+
+        candidates = self.finder.find([snapshot(track) for track in selected])
+        if candidates == []:
+            log.info('No releases found. Enter the ID instead.')
+            return self.get_release_id()
+
+        for n in range(len(candidates)):
+            print '%3s %s' % (n + 1, candidates[n])
+        choice = raw_input('Pick a release (1-%s, anything else to enter an ID): '
+                           % len(candidates)).strip()
+        try:
+            return candidates[int(choice) - 1].release_id
+        except (ValueError, IndexError):
+            return self.get_release_id()
+
     def get_selected(self):
         itunes_tracklist = []
         while itunes_tracklist == []:
@@ -73,23 +144,33 @@ class FixiTunesFromID(object):
         return itunes_tracklist
 
     def match_tracks(self, itunes_tracklist):
-        '''Returns a list of tuple pairs: (itunes_track, discogs_track)
+        '''Returns a list of tuples: (itunes_track, discogs_track, confidence)
         '''
-        tracks = []
-        for i_track in itunes_tracklist:
-            d_track = self.utils.match_track(i_track, self.discogs_tracklist)
-            tracks.append((i_track, d_track))
-        return tracks
+        return self.utils.match_tracks(itunes_tracklist, self.discogs_tracklist)
 
     def print_matches(self, matched):
         print ''
         for i in range(len(matched)):
-            i_track, d_track = matched[i]
+            i_track, d_track, confidence = matched[i]
             print self.utils.pf(i_track, '%s i' % i)
             print self.utils.pf(d_track, '%s d' % i)
+            print '    match confidence: %.0f%%' % (confidence * 100)
             print ''
 
     def write_info(self, matched):
+        plan = WritePlan([(i, d) for i, d, confidence in matched])
+        plan.read()
+        print plan.summary()
+
+        if self.dry_run:
+            plan.print_changes()
+            print 'Dry run: nothing written'
+            return True
+
+        if plan.changes == []:
+            print 'Nothing to write'
+            return True
+
         cont = raw_input('Press \'y\' to write track info, any key to abort: ').strip()
         if cont != 'y':
             print 'Aborted'
@@ -97,10 +178,10 @@ class FixiTunesFromID(object):
         else:
             print 'Writing...'
 
-        for itunes_track, discogs_track in matched:
-            self.utils.write(itunes_track, discogs_track)
+        plan.apply()
 
         print 'Write complete'
+        print plan.report()
         return True
 
     def start_tool(self):
@@ -119,8 +200,28 @@ class FixiTunesFromID(object):
 
 
 class Scanner(FixiTunesFromID):
-
-    def __init__(self):
+    '''
+    Re-fixes tracks that were fixed before, using the Discogs ID
+    ('D:<id>') they were tagged with. Releases go through a pipeline:
+    fetching runs for several releases at once, and while one release is
+    being matched and written the next ones are already being fetched.
+
+    With :discover: the release of tracks without an ID is looked up by
+    album, and used if the best candidate scores at least :min_score:.
+    '''
+
+    def __init__(self, dry_run = False, fetchers = 4, queue_size = 2,
+                 discover = False, min_score = 0.75):
+        self.dry_run = dry_run
+        self.fetchers = fetchers
+        self.queue_size = queue_size
+        self.discover = discover
+        self.min_score = min_score
+        self._finder = None # only looked up when discovering
+        self.finder_lock = threading.Lock()
+        # one RealName for every release: the exceptions file is read once
+        # and the same writer is never looked up twice at once
+        self.real_name = RealName()
         self.utils = FixerUtilities()
         self.iTunes = connect_to_itunes()
         self.start_tool()
@@ -139,48 +240,119 @@ class Scanner(FixiTunesFromID):
 
         return itunes_tracklist
 
+    def get_discogs_id(self, track):
+        '''
+        Discogs release ID a track was tagged with, or None.
+        DiscogsTracklist puts it in the comments; older fixes used grouping.
+        '''
+        for field in (track.Comment, track.Grouping):
+            if field is not None and field.startswith('D:'):
+                try:
+                    return int(field[2:])
+                except ValueError:
+                    pass
+        return None
+
     def group_itunes_tracklist_by_release(self, tracklist):
+        '''
+        Returns {release_id: [(itunes_track, snapshot)]}. The snapshot is a
+        Track holding the fields matching needs, read here so the other
+        pipeline stages never touch the iTunes COM objects.
+        When discovering, tracks without an ID are grouped by album instead,
+        under ('album', album name).
+        '''
         releases = {}
 
         for track in tracklist:
-            this_id = None
-
-            if track.Grouping.startswith('D:'):
-                this_id = int(track.Grouping[2:])
+            this_id = self.get_discogs_id(track)
 
             if this_id: # track has an ID -- deal with it
-                if this_id in releases.keys():
-                    releases[this_id].append(track)
-                else:
-                    releases[this_id] = [track]
+                releases.setdefault(this_id, []).append((track, snapshot(track)))
+            elif self.discover and track.Album:
+                releases.setdefault(('album', track.Album), []).append((track, snapshot(track)))
             else:
                 print '%s has no associated Discogs ID' % track.Name
 
         return releases
 
+    def find_release_id(self, album, tracks):
+        candidate = self.finder.best([snapshot for track, snapshot in tracks],
+                                     self.min_score)
+        if candidate is None:
+            raise LookupError('no release found for %s' % album)
+        log.info(u'%s: %s' % (album, candidate))
+        return candidate.release_id
+
+    def fetch(self, job):
+        release_id, tracks = job
+        if isinstance(release_id, tuple):
+            release_id = self.find_release_id(release_id[1], tracks)
+        return release_id, tracks, DiscogsTracklist(release_id, build = False,
+                                                    real_name = self.real_name)
+
+    def resolve(self, job):
+        release_id, tracks, discogs = job
+        return release_id, tracks, discogs.get_release_info()
+
+    def match(self, job):
+        release_id, tracks, discogs_tracklist = job
+        snapshots = [snapshot for track, snapshot in tracks]
+        matched = self.utils.match_tracks(snapshots, discogs_tracklist)
+
+        pairs = []
+        for (track, snapshot), (s, d_track, confidence) in zip(tracks, matched):
+            pairs.append((track, d_track))
+        return release_id, pairs
+
+    def write(self, job):
+        release_id, pairs = job
+        plan = WritePlan(pairs)
+        with profile.timer('write', release_id):
+            plan.read()
+            print 'Release %s: %s' % (release_id, plan.summary())
+
+            if self.dry_run:
+                plan.print_changes()
+            else:
+                plan.apply()
+                print '    ' + plan.report()
+        sys.stdout.flush()
+
     def fix(self):
-        for release_id in self.itunes_releases:
-            discogs = DiscogsTracklist(release_id)
-            self.discogs_tracklist = discogs.get_release_info()
-            self.itunes_tracklist = self.itunes_releases[release_id]
-        return
+        pipeline = Pipeline(self.queue_size)
+        pipeline.stage('fetch', self.fetch, self.fetchers)
+        pipeline.stage('resolve names', self.resolve, self.fetchers)
+        pipeline.stage('match', self.match)
+
+        # writing stays in this thread: the iTunes COM objects belong to it
+        failures = pipeline.run(self.itunes_releases.items(), self.write)
+
+        for failure in failures:
+            log.error(str(failure))
+        return failures
 
     def start_tool(self):
         end = False
         while not end:
-            self.itunes_releases = self.split_itunes_tracklist_by_release(self.get_selected())
-            sys.stdout.flush()
-            self.fix()
+            self.itunes_releases = self.group_itunes_tracklist_by_release(self.get_selected())
             sys.stdout.flush()
-            self.matched = self.match_tracks()
-            sys.stdout.flush()
-            end = self.write_info()
+
+            count = sum(len(tracks) for tracks in self.itunes_releases.values())
+            cont = raw_input('Fix %s tracks from %s releases? (\'y\' to continue, '
+                             'any other key to select new iTunes tracks) '
+                             % (count, len(self.itunes_releases))).strip()
+            if cont == 'y':
+                self.fix()
+                end = True
         print "done"
         return
 
 
 class FixerUtilities(object):
 
+    def __init__(self):
+        self.matcher = TrackMatcher()
+
     def pf(self, track, id = ''):
         if track is None:
             return 'track is None'
@@ -206,51 +378,30 @@ class FixerUtilities(object):
             log.error(self.pf(i))
             return
 
-        if d.Name is not None and i.Name != d.Name:
-            i.Name = d.Name
+        plan = WritePlan([(i, d)])
+        plan.read()
+        plan.apply()
+        return
 
-        if d.Artist is not None and i.Artist != d.Artist:
-            i.Artist = d.Artist
-        '''
-        if d.AlbumArtist is not None:
-            i.AlbumArtist = d.AlbumArtist
+    def match_tracks(self, itunes_tracklist, discogs_tracklist):
+        '''Pairs up a whole selection of iTunes tracks with a Discogs tracklist
+        at once. Returns (itunes_track, discogs_track, confidence) tuples in
+        the order of the iTunes tracks; discogs_track is None if nothing
+        matched.
         '''
-        if d.Album is not None and i.Album != d.Album:
-            i.Album = d.Album
-
-        if d.Grouping is not None and i.Grouping != d.Grouping:
-            i.Grouping = d.Grouping
-
-        if d.Composer is not None and i.Composer != d.Composer:
-            i.Composer = d.Composer
-
-        if d.Comments is not None and i.Comment != d.Comments:
-            i.Comment = d.Comments
-
-        if d.Genre is not None and i.Genre != d.Genre:
-            i.Genre = d.Genre
-
-        if d.Year is not None and i.Year != d.Year:
-            i.Year = d.Year
-
-        if d.TrackNumber is not None and i.TrackNumber != d.TrackNumber:
-            i.TrackNumber = d.TrackNumber
-
-        if d.TrackCount is not None and i.TrackCount != d.TrackCount:
-            i.TrackCount = d.TrackCount
+        with profile.timer('match'):
+            matched = self.matcher.match(itunes_tracklist, discogs_tracklist)
 
-        if d.DiscNumber is not None and i.DiscNumber != d.DiscNumber:
-            i.DiscNumber = d.DiscNumber
-
-        if d.DiscCount is not None and i.DiscCount != d.DiscCount:
-            i.DiscCount = d.DiscCount
-
-        return
+        for itunes_track, discogs_track, confidence in matched:
+            log.debug('%s <- %s (%.2f)' % (self.pf(itunes_track),
+                                           self.pf(discogs_track), confidence))
+        return matched
 
     def match_track(self, itunes_track, discogs_tracklist):
         '''Consumes an iTunes track, and selects its best match from a Discogs
         tracklist. Removes that Discogs track from the list and returns it.
         '''
+        start = time.time()
         i_str = '%s%s' % (itunes_track.Name, itunes_track.Artist)
 
         highest_index = -1
@@ -272,6 +423,7 @@ class FixerUtilities(object):
         for track in discogs_tracklist:
             log.debug(self.pf(track))
 
+        profile.add_time('match', time.time() - start)
         log.debug('highest_index %s' % highest_index)
         log.debug('highest_ratio %s' % highest_ratio)
         if highest_index > -1:
@@ -282,6 +434,126 @@ class FixerUtilities(object):
             log.debug('no match')
 
 
+class WritePlan(object):
+    '''
+    Works out everything that has to change to make a selection of iTunes
+    tracks agree with their matched Discogs tracks, then writes just that.
+
+    Every COM property access is a round-trip to iTunes, so each field is read
+    once, only fields that differ are written, and the calls are counted.
+    '''
+
+    # (Discogs track attribute, iTunes track property)
+    # AlbumArtist is deliberately left alone
+    FIELDS = (('Name', 'Name'),
+              ('Artist', 'Artist'),
+              ('Album', 'Album'),
+              ('Grouping', 'Grouping'),
+              ('Composer', 'Composer'),
+              ('Comments', 'Comment'),
+              ('Genre', 'Genre'),
+              ('Year', 'Year'),
+              ('TrackNumber', 'TrackNumber'),
+              ('TrackCount', 'TrackCount'),
+              ('DiscNumber', 'DiscNumber'),
+              ('DiscCount', 'DiscCount'))
+
+    def __init__(self, matched):
+        self.matched = matched      # (itunes_track, discogs_track) pairs
+        self.changes = []           # (itunes_track, [(property, old, new)])
+        self.utils = FixerUtilities()
+
+        self.reads = 0
+        self.writes = 0
+        self.failed = 0
+        self.read_time = 0.0
+        self.write_time = 0.0
+
+    def read(self):
+        '''
+        Reads the current fields of every iTunes track and computes the
+        changeset for the whole selection.
+        '''
+        start = time.time()
+        reads = self.reads
+        self.changes = []
+
+        for i, d in self.matched:
+            if d is None:
+                log.error('Discogs track is None: will not write. iTunes track:')
+                log.error(self.utils.pf(i))
+                continue
+
+            track_changes = []
+            for d_field, i_field in self.FIELDS:
+                new = getattr(d, d_field)
+                if new is None:
+                    continue
+                old = getattr(i, i_field)
+                self.reads += 1
+                if old != new:
+                    track_changes.append((i_field, old, new))
+
+            if track_changes != []:
+                self.changes.append((i, track_changes))
+
+        self.read_time += time.time() - start
+        profile.add_time('com.read', time.time() - start)
+        profile.count('com.reads', self.reads - reads)
+        return self.changes
+
+    def apply(self):
+        '''
+        Writes the planned changes. A field that can't be written is logged
+        and skipped.
+        '''
+        start = time.time()
+        writes, failed = self.writes, self.failed
+
+        for i, track_changes in self.changes:
+            for field, old, new in track_changes:
+                self.writes += 1
+                try:
+                    setattr(i, field, new)
+                except Exception, e:
+                    self.failed += 1
+                    log.error('Could not write %s of %s: %s' % (field, self.utils.pf(i), e))
+
+        self.write_time += time.time() - start
+        profile.add_time('com.write', time.time() - start)
+        profile.count('com.writes', self.writes - writes)
+        profile.count('com.write_failures', self.failed - failed)
+
+    def count(self):
+        return sum(len(track_changes) for i, track_changes in self.changes)
+
+    def summary(self):
+        return '%s changes to %s of %s tracks' % (self.count(), len(self.changes),
+                                                  len(self.matched))
+
+    def print_changes(self):
+        for i, track_changes in self.changes:
+            print self.utils.pf(i)
+            for field, old, new in track_changes:
+                try:
+                    print u'    {0:<12} {1} -> {2}'.format(field, old, new)
+                except:
+                    print '    {0:<12} (could not print change)'.format(field)
+
+    def report(self):
+        return '%s COM reads in %.2fs, %s writes (%s failed) in %.2fs' % \
+               (self.reads, self.read_time, self.writes, self.failed, self.write_time)
+
+
 if __name__ == '__main__':
-    fixer = FixiTunesFromID()
+    parser = argparse.ArgumentParser(description = 'Fixes iTunes tracks with metadata from Discogs')
+    parser.add_argument('--profile', nargs = '?', const = 'profile.json', metavar = 'FILE',
+                        help = 'at exit, write timings and counters to FILE (profile.json)')
+    parser.add_argument('--dry-run', action = 'store_true',
+                        help = 'show the changes that would be written, write nothing')
+    args = parser.parse_args()
+    if args.profile is not None:
+        atexit.register(profile.dump, args.profile)
+
+    fixer = FixiTunesFromID(dry_run = args.dry_run)
     #scanner = Scanner()
@@ -0,0 +1,111 @@
+'''
+Created on Oct 18, 2026
+Author: George Lifchits
+
+Label and genre counts of the user's iTunes library, kept up to date
+incrementally. Only tracks that were added or modified since the last
+refresh are read again.
+'''
+
+import os
+import pickle
+
+
+class LibrarySnapshot(object):
+    '''
+    Remembers the key, modification stamp, genre and label of every track
+    in the library, along with how often each genre and label occurs.
+    Stored in a single versioned pickle.
+    '''
+
+    VERSION = 1
+
+    def __init__(self, snapshot_file = 'library.pkl'):
+        self.snapshot_file = snapshot_file
+        self.tracks = {}    # key -> (stamp, genre, label)
+        self.genres = {}
+        self.labels = {}
+
+    def load(self):
+        '''
+        Loads the snapshot file. Returns False if there is no usable one.
+        '''
+        if not os.path.exists(self.snapshot_file):
+            return False
+
+        snapshot_pickle = open(self.snapshot_file, 'rb')
+        try:
+            snapshot = pickle.load(snapshot_pickle)
+        finally:
+            snapshot_pickle.close()
+
+        if snapshot.get('version') != self.VERSION:
+            return False
+
+        self.tracks = snapshot['tracks']
+        self.genres = snapshot['genres']
+        self.labels = snapshot['labels']
+        return True
+
+    def save(self):
+        snapshot = {'version': self.VERSION,
+                    'tracks': self.tracks,
+                    'genres': self.genres,
+                    'labels': self.labels}
+
+        temp_file = self.snapshot_file + '.tmp'
+        snapshot_pickle = open(temp_file, 'wb')
+        try:
+            pickle.dump(snapshot, snapshot_pickle, pickle.HIGHEST_PROTOCOL)
+        finally:
+            snapshot_pickle.close()
+
+        # os.rename won't replace an existing file on Windows
+        if os.path.exists(self.snapshot_file):
+            os.remove(self.snapshot_file)
+        os.rename(temp_file, self.snapshot_file)
+
+    def count(self, d, key, amount):
+        d[key] = d.get(key, 0) + amount
+        if d[key] <= 0:
+            del d[key]
+
+    def add(self, key, stamp, genre, label):
+        self.tracks[key] = (stamp, genre, label)
+        self.count(self.genres, genre, 1)
+        self.count(self.labels, label, 1)
+
+    def remove(self, key):
+        stamp, genre, label = self.tracks.pop(key)
+        self.count(self.genres, genre, -1)
+        self.count(self.labels, label, -1)
+
+    def refresh(self, entries):
+        '''
+        :entries: is every track in the library as (key, stamp, read) where
+        read() returns the (genre, label) of the track. read is only called
+        for tracks that are new or whose stamp changed; tracks that weren't
+        listed are dropped.
+        Returns the number of tracks (added, changed, removed).
+        '''
+        added = changed = 0
+        seen = set()
+
+        for key, stamp, read in entries:
+            seen.add(key)
+            if key in self.tracks:
+                if self.tracks[key][0] == stamp:
+                    continue
+                self.remove(key)
+                changed += 1
+            else:
+                added += 1
+
+            genre, label = read()
+            self.add(key, stamp, genre, label)
+
+        gone = [key for key in self.tracks if key not in seen]
+        for key in gone:
+            self.remove(key)
+
+        return added, changed, len(gone)
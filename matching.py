@@ -0,0 +1,213 @@
+'''
+Created on Oct 18, 2026
+Author: George Lifchits
+
+Matches a selection of iTunes tracks to a Discogs tracklist as a whole:
+scores every pair once, then picks the one-to-one pairing with the best
+total score (Hungarian algorithm) instead of greedily taking the best
+remaining track for each iTunes track in turn.
+'''
+
+import re
+import difflib
+
+INFINITY = float('inf')
+
+
+def hungarian(cost):
+    '''
+    Minimum cost assignment for a rectangular cost matrix (list of rows) with
+    no more rows than columns. Returns a list with the assigned column of
+    each row.
+    '''
+    n = len(cost)
+    if n == 0:
+        return []
+    m = len(cost[0])
+    assert n <= m
+
+    # potentials and matching are 1-indexed; column 0 is a dummy
+    u = [0.0] * (n + 1)
+    v = [0.0] * (m + 1)
+    match = [0] * (m + 1)   # match[column] = row
+    way = [0] * (m + 1)
+
+    for row in range(1, n + 1):
+        match[0] = row
+        col0 = 0
+        minv = [INFINITY] * (m + 1)
+        used = [False] * (m + 1)
+        while True:
+            used[col0] = True
+            row0 = match[col0]
+            row_cost = cost[row0 - 1]
+            delta = INFINITY
+            col1 = 0
+            for col in range(1, m + 1):
+                if not used[col]:
+                    current = row_cost[col - 1] - u[row0] - v[col]
+                    if current < minv[col]:
+                        minv[col] = current
+                        way[col] = col0
+                    if minv[col] < delta:
+                        delta = minv[col]
+                        col1 = col
+            for col in range(m + 1):
+                if used[col]:
+                    u[match[col]] += delta
+                    v[col] -= delta
+                else:
+                    minv[col] -= delta
+            col0 = col1
+            if match[col0] == 0:
+                break
+        while col0 != 0:
+            col1 = way[col0]
+            match[col0] = match[col1]
+            col0 = col1
+
+    assignment = [None] * n
+    for col in range(1, m + 1):
+        if match[col] != 0:
+            assignment[match[col] - 1] = col - 1
+    return assignment
+
+
+class TrackMatcher(object):
+    '''
+    Scores iTunes tracks against Discogs tracks and pairs them up.
+
+    Cheap prefilters decide which pairs are worth the full SequenceMatcher
+    comparison: for each iTunes track only the :candidates: Discogs tracks
+    sharing the most normalized words (and of a plausible length), plus the
+    one at the same disc/track position, are compared. Every other pair
+    scores 0. A pair scoring below :min_score: is not considered a match.
+    '''
+
+    def __init__(self, min_score = 0.2, position_weight = 0.15,
+                 name_weight = 0.7, candidates = 5):
+        self.min_score = min_score
+        self.position_weight = position_weight
+        self.name_weight = name_weight
+        self.candidates = candidates
+
+    def info(self, track):
+        '''
+        (name, artist, words of both, position) of a track
+        '''
+        name = (track.Name or u'').lower()
+        artist = (track.Artist or u'').lower()
+        tokens = frozenset(re.findall(r'\w+', name + u' ' + artist, re.UNICODE))
+        return name, artist, tokens, (track.DiscNumber, track.TrackNumber)
+
+    def overlap(self, i_info, d_info):
+        '''
+        Share of words in common, or 0 if the names are too different in
+        length for the pair to be a match
+        '''
+        shorter, longer = sorted([len(i_info[0]), len(d_info[0])])
+        if longer > 0 and shorter / float(longer) < self.min_score:
+            return 0.0
+
+        common = len(i_info[2] & d_info[2])
+        if common == 0:
+            return 0.0
+        return common / float(len(i_info[2] | d_info[2]))
+
+    def same_position(self, i_info, d_info):
+        return i_info[3] == d_info[3] and i_info[3] != (None, None)
+
+    def candidate_columns(self, i_info, d_info):
+        '''
+        Indices of the Discogs tracks worth comparing to one iTunes track
+        '''
+        overlaps = []
+        columns = set()
+        for j, d in enumerate(d_info):
+            if self.same_position(i_info, d):
+                columns.add(j)
+            overlap = self.overlap(i_info, d)
+            if overlap > 0:
+                overlaps.append((overlap, j))
+
+        overlaps.sort(reverse = True)
+        columns.update(j for overlap, j in overlaps[:self.candidates])
+        return columns
+
+    def matrix(self, itunes_tracklist, discogs_tracklist):
+        '''
+        Similarity (0 to 1) of every iTunes track (rows) to every Discogs
+        track (columns)
+        '''
+        i_info = [self.info(track) for track in itunes_tracklist]
+        d_info = [self.info(track) for track in discogs_tracklist]
+
+        scores = [[0.0] * len(d_info) for i in i_info]
+        wanted = [[] for d in d_info]
+        for i, row_info in enumerate(i_info):
+            for j in self.candidate_columns(row_info, d_info):
+                wanted[j].append(i)
+
+        # most tracks of a release share an artist
+        artist_ratios = {}
+        def artist_ratio(i_artist, d_artist):
+            if (i_artist, d_artist) not in artist_ratios:
+                matcher = difflib.SequenceMatcher(None, i_artist, d_artist)
+                artist_ratios[(i_artist, d_artist)] = matcher.ratio()
+            return artist_ratios[(i_artist, d_artist)]
+
+        # SequenceMatcher caches its analysis of the second sequence, so
+        # compare column by column
+        matcher = difflib.SequenceMatcher(None)
+        text_weight = 1 - self.position_weight
+        for j, rows in enumerate(wanted):
+            matcher.set_seq2(d_info[j][0])
+            for i in rows:
+                bonus = 0.0
+                if self.same_position(i_info[i], d_info[j]):
+                    bonus = self.position_weight
+
+                artist = (1 - self.name_weight) * \
+                         artist_ratio(i_info[i][1], d_info[j][1])
+                matcher.set_seq1(i_info[i][0])
+
+                # quick upper bounds first: skip pairs that can't make it
+                needed = ((self.min_score - bonus) / text_weight - artist) / \
+                         self.name_weight
+                if matcher.real_quick_ratio() < needed or \
+                   matcher.quick_ratio() < needed:
+                    scores[i][j] = bonus
+                else:
+                    name = self.name_weight * matcher.ratio()
+                    scores[i][j] = text_weight * (name + artist) + bonus
+        return scores
+
+    def match(self, itunes_tracklist, discogs_tracklist):
+        '''
+        Returns a list of (itunes_track, discogs_track, confidence) in the
+        order of :itunes_tracklist:. discogs_track is None (confidence 0) if
+        no Discogs track was a good enough match.
+        '''
+        scores = self.matrix(itunes_tracklist, discogs_tracklist)
+        n, m = len(itunes_tracklist), len(discogs_tracklist)
+
+        if n == 0 or m == 0:
+            assignment = [None] * n
+        elif n <= m:
+            assignment = hungarian([[1 - score for score in row]
+                                    for row in scores])
+        else:
+            transposed = hungarian([[1 - scores[i][j] for i in range(n)]
+                                    for j in range(m)])
+            assignment = [None] * n
+            for j, i in enumerate(transposed):
+                assignment[i] = j
+
+        matched = []
+        for i, j in enumerate(assignment):
+            if j is None or scores[i][j] < self.min_score:
+                matched.append((itunes_tracklist[i], None, 0.0))
+            else:
+                matched.append((itunes_tracklist[i], discogs_tracklist[j],
+                                scores[i][j]))
+        return matched
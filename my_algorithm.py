@@ -3,6 +3,16 @@ Created on Feb 21, 2012
 Author: George Lifchits
 '''
 from __future__ import division
+from bisect import bisect_left
+
+try:
+    import numpy
+except ImportError:
+    numpy = None # similarity_matrix falls back to plain Python
+
+STRIP = ' ()[]{}/\|-.,:;!@#$%^&*'
+
+_unicode_tables = {}
 
 def findclosest(s1, i, s2):
     diff = 0
@@ -29,33 +39,58 @@ def findclosest(s1, i, s2):
 
     return result
 
-def normalize_string(string, chars = ' ()[]{}/\|-.,:;!@#$%^&*'):
+def normalize_string(string, chars = STRIP):
     string = string.replace('feat', '').lower()
     string = string.replace('original mix', '')
     string = string.replace('original', '')
-    for char in chars:
-        string = string.replace(char, '')
-    return string
-
-def similar(s1, s2):
-    total = 0
-
-    s1 = normalize_string(s1)
-    s2 = normalize_string(s2)
-
+    # strips every char in one pass
+    if isinstance(string, bytes):
+        return string.translate(None, chars)
+    if chars not in _unicode_tables:
+        _unicode_tables[chars] = dict.fromkeys(map(ord, chars))
+    return string.translate(_unicode_tables[chars])
+
+def char_positions(string):
+    '''
+    {char: sorted positions of char in string}
+    '''
+    positions = {}
+    for j, char in enumerate(string):
+        positions.setdefault(char, []).append(j)
+    return positions
+
+def closest_distance(positions, i):
+    '''
+    Distance from i to the nearest of positions within i // 2 (the window
+    findclosest searches), or -1
+    '''
+    k = bisect_left(positions, i)
+    dist = min(abs(positions[n] - i) for n in (k - 1, k) if 0 <= n < len(positions))
+    return dist if dist <= i // 2 else -1
+
+def similar_normalized(s1, s2, positions2 = None):
+    '''
+    similar() for strings that are already normalized. :positions2: is
+    char_positions(s2) if it's already known.
+    '''
     if len(s1) < len(s2):
         s1, s2 = s2, s1
+        positions2 = None
+    if len(s1) == 0:
+        return 1.0
+    if positions2 is None:
+        positions2 = char_positions(s2)
 
+    total = 0
     prev_dist = 0
 
-    for i in range(len(s1)):
-        j = findclosest(s1, i, s2)
+    for i, char in enumerate(s1):
+        dist = closest_distance(positions2[char], i) if char in positions2 else -1
 
-        if j is not -1:
-            dist = abs(i - j)
+        if dist != -1:
             index = dist / len(s1)
 
-            if prev_dist is dist:
+            if prev_dist == dist:
                 index = 0
 
             prev_dist = dist
@@ -65,3 +100,107 @@ def similar(s1, s2):
         total += index
 
     return 1 - (total / len(s1))
+
+def similar(s1, s2):
+    return similar_normalized(normalize_string(s1), normalize_string(s2))
+
+def similarity_matrix(strings1, strings2):
+    '''
+    [[similar(s1, s2) for s2 in strings2] for s1 in strings1], with every
+    string normalized once. With NumPy, each string of strings1 is compared
+    with all of strings2 at once.
+    '''
+    normalized1 = [normalize_string(string) for string in strings1]
+    normalized2 = [normalize_string(string) for string in strings2]
+
+    if numpy is None:
+        positions2 = [char_positions(s2) for s2 in normalized2]
+        return [[similar_normalized(s1, s2, p2)
+                 for s2, p2 in zip(normalized2, positions2)]
+                for s1 in normalized1]
+
+    codes2, lengths2 = encode(normalized2, -2)
+    rows = []
+    for s1 in normalized1:
+        code1 = numpy.array([ord(char) for char in s1], dtype = numpy.int32)
+        row = numpy.empty(len(normalized2))
+
+        # s1 is the longer string of the pair
+        longer = lengths2 <= len(s1)
+        if longer.any():
+            count = longer.sum()
+            width = max(1, lengths2[longer].max())
+            row[longer] = scores(numpy.tile(code1, (count, 1)),
+                                 numpy.repeat(len(s1), count),
+                                 codes2[longer][:, :width])
+        # or the string of strings2 is
+        shorter = ~longer
+        if shorter.any():
+            count = shorter.sum()
+            width = lengths2[shorter].max()
+            row[shorter] = scores(codes2[shorter][:, :width],
+                                  lengths2[shorter],
+                                  numpy.tile(code1, (count, 1)))
+        rows.append(row.tolist())
+    return rows
+
+def encode(strings, pad):
+    '''
+    Strings as rows of character codes, padded with :pad:, and their lengths
+    '''
+    lengths = numpy.array([len(string) for string in strings], dtype = numpy.int32)
+    codes = numpy.empty((len(strings), max([1] + lengths.tolist())), dtype = numpy.int32)
+    codes.fill(pad)
+    for n, string in enumerate(strings):
+        codes[n, :len(string)] = [ord(char) for char in string]
+    return codes, lengths
+
+def scores(long_codes, long_lengths, short_codes, chunk = 2 ** 22):
+    '''
+    similar_normalized for each pair of rows: long_codes[k] (the longer
+    string, of length long_lengths[k]) and short_codes[k]. Padding codes
+    must differ between the two so that padding never matches.
+    '''
+    count, width = long_codes.shape
+    short_width = short_codes.shape[1]
+    if width == 0 or short_width == 0:
+        # empty against empty, or nothing to match against
+        return numpy.where(long_lengths > 0, 0.0, 1.0)
+
+    i = numpy.arange(width)[:, None]
+    j = numpy.arange(short_width)[None, :]
+    distance = numpy.abs(i - j)
+    window = distance <= i // 2
+    missing = width + short_width # larger than any distance
+
+    step = max(1, chunk // max(1, width * short_width))
+    result = numpy.empty(count)
+    for start in range(0, count, step):
+        longs = long_codes[start:start + step]
+        shorts = short_codes[start:start + step]
+        lengths = long_lengths[start:start + step]
+
+        # nearest matching char of the short string for every char of the long one
+        matches = (longs[:, :, None] == shorts[:, None, :]) & window
+        dist = numpy.where(matches, distance, missing).min(axis = 2)
+        found = dist < missing
+
+        # distance of the previous char that was found (0 before the first)
+        positions = numpy.where(found, numpy.arange(width), -1)
+        last = numpy.maximum.accumulate(positions, axis = 1)
+        previous = numpy.empty_like(last)
+        previous[:, 0] = -1
+        previous[:, 1:] = last[:, :-1]
+        rows = numpy.arange(len(longs))[:, None]
+        prev_dist = numpy.where(previous >= 0,
+                                dist[rows, numpy.maximum(previous, 0)], 0)
+
+        safe_lengths = numpy.maximum(lengths, 1)[:, None]
+        index = numpy.where(found,
+                            numpy.where(dist == prev_dist, 0, dist / safe_lengths),
+                            1)
+        index[numpy.arange(width)[None, :] >= lengths[:, None]] = 0
+        total = index.sum(axis = 1)
+        result[start:start + step] = numpy.where(lengths > 0,
+                                                 1 - total / safe_lengths[:, 0], 1.0)
+    return result
@@ -0,0 +1,127 @@
+'''
+Created on Oct 18, 2026
+Author: George Lifchits
+
+A small staged pipeline: each stage has its own worker threads, and the
+stages are connected by bounded queues, so a slow stage holds back the ones
+before it instead of letting work pile up in memory. The last step (the
+sink) runs in the calling thread.
+'''
+
+import sys
+import threading
+import Queue
+
+DONE = object() # end of input marker passed down the queues
+
+
+class StageError(object):
+    '''
+    Takes the place of an item that failed in a stage. Later stages pass it
+    along untouched.
+    '''
+
+    def __init__(self, stage, item, exc_info):
+        self.stage = stage
+        self.item = item
+        self.exc_info = exc_info
+
+    def __str__(self):
+        return '%s failed for %r: %s' % (self.stage, self.item, self.exc_info[1])
+
+
+class Stage(object):
+
+    def __init__(self, name, fn, workers, inbox, outbox):
+        self.name = name
+        self.fn = fn
+        self.inbox = inbox
+        self.outbox = outbox
+        self.running = workers
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target = self.work)
+                        for i in range(workers)]
+        for thread in self.threads:
+            thread.daemon = True
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def work(self):
+        while True:
+            item = self.inbox.get()
+            if item is DONE:
+                self.inbox.put(DONE) # for the other workers of this stage
+                with self.lock:
+                    self.running -= 1
+                    last = self.running == 0
+                if last:
+                    self.outbox.put(DONE)
+                return
+
+            if isinstance(item, StageError):
+                self.outbox.put(item)
+                continue
+
+            try:
+                result = self.fn(item)
+            except Exception:
+                result = StageError(self.name, item, sys.exc_info())
+            self.outbox.put(result)
+
+
+class Pipeline(object):
+    '''
+    Add stages with stage(), then run() items through them.
+    '''
+
+    def __init__(self, queue_size = 2):
+        self.queue_size = queue_size
+        self.stages = [] # (name, fn, workers)
+
+    def stage(self, name, fn, workers = 1):
+        self.stages.append((name, fn, workers))
+        return self
+
+    def run(self, items, sink):
+        '''
+        Feeds :items: through every stage and calls sink(result) in this
+        thread for each result, in the order they come out. Returns the
+        StageErrors of the items that failed.
+        '''
+        queues = [Queue.Queue(self.queue_size) for i in range(len(self.stages) + 1)]
+        stages = [Stage(name, fn, workers, queues[i], queues[i + 1])
+                  for i, (name, fn, workers) in enumerate(self.stages)]
+        for stage in stages:
+            stage.start()
+
+        def feed():
+            for item in items:
+                queues[0].put(item)
+            queues[0].put(DONE)
+
+        feeder = threading.Thread(target = feed)
+        feeder.daemon = True
+        feeder.start()
+
+        failures = []
+        while True:
+            # get() with a timeout so Ctrl+C still works
+            try:
+                result = queues[-1].get(True, 1)
+            except Queue.Empty:
+                continue
+
+            if result is DONE:
+                break
+            if isinstance(result, StageError):
+                failures.append(result)
+                continue
+
+            try:
+                sink(result)
+            except Exception:
+                failures.append(StageError('sink', result, sys.exc_info()))
+
+        return failures
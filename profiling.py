@@ -0,0 +1,157 @@
+'''
+Created on Oct 18, 2026
+Author: George Lifchits
+
+Timings and counters for working out where a run spends its time: Discogs,
+the caches, matching or iTunes (COM).
+
+Everything reports to the one Profile of the process, `profile`:
+
+    with profile.timer('match', release_id):
+        ...
+    profile.count('com.writes')
+    profile.observe('api.release', latency)
+
+and profile.dump() writes it all out as JSON (--profile in itunes.py).
+'''
+
+from contextlib import contextmanager
+import threading
+import bisect
+import json
+import time
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+           1.0, 2.0, 5.0, 10.0, 30.0)
+
+
+class Histogram(object):
+    '''
+    Counts of values (latencies) per bucket, with their total and maximum
+    '''
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def count(self):
+        return sum(self.counts)
+
+    def percentile(self, fraction):
+        '''
+        Upper bound of the bucket the :fraction: percentile falls in
+        '''
+        wanted = fraction * self.count()
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= wanted:
+                return BUCKETS[i] if i < len(BUCKETS) else self.max
+        return 0.0
+
+    def report(self):
+        count = self.count()
+        buckets = {}
+        for i, bucket_count in enumerate(self.counts):
+            if bucket_count:
+                bound = '<=%gs' % BUCKETS[i] if i < len(BUCKETS) else '>%gs' % BUCKETS[-1]
+                buckets[bound] = bucket_count
+        return {'count': count,
+                'total': self.total,
+                'mean': self.total / count if count else 0.0,
+                'max': self.max,
+                'p50': self.percentile(0.5),
+                'p90': self.percentile(0.9),
+                'p99': self.percentile(0.99),
+                'buckets': buckets}
+
+
+class Profile(object):
+    '''
+    Stage timings (overall and per release), counters and histograms.
+    Safe to use from any thread.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.stages = {}     # stage -> [calls, seconds, longest]
+            self.counters = {}
+            self.histograms = {}
+            self.releases = {}   # release ID -> {stage: seconds}
+
+    @contextmanager
+    def timer(self, stage, release = None):
+        '''
+        Times the with block as :stage: (and as part of :release:)
+        '''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.time() - start, release)
+
+    def add_time(self, stage, seconds, release = None):
+        with self.lock:
+            calls, total, longest = self.stages.get(stage, (0, 0.0, 0.0))
+            self.stages[stage] = [calls + 1, total + seconds, max(longest, seconds)]
+            if release is not None:
+                times = self.releases.setdefault(str(release), {})
+                times[stage] = times.get(stage, 0.0) + seconds
+
+    def count(self, name, n = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, value):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].add(value)
+
+    def hit_rates(self):
+        '''
+        hit / (hit + miss) of every '<name>.hit' and '<name>.miss' counter pair
+        '''
+        prefixes = set(name.rsplit('.', 1)[0] for name in self.counters
+                       if name.endswith('.hit') or name.endswith('.miss'))
+        rates = {}
+        for prefix in prefixes:
+            hits = self.counters.get(prefix + '.hit', 0)
+            misses = self.counters.get(prefix + '.miss', 0)
+            rates[prefix] = hits / float(hits + misses)
+        return rates
+
+    def report(self):
+        with self.lock:
+            stages = dict((stage, {'calls': calls, 'seconds': total, 'longest': longest})
+                          for stage, (calls, total, longest) in self.stages.items())
+            return {'wall_time': time.time() - self.started,
+                    'stages': stages,
+                    'counters': dict(self.counters),
+                    'hit_rates': self.hit_rates(),
+                    'histograms': dict((name, histogram.report())
+                                       for name, histogram in self.histograms.items()),
+                    'releases': dict((release, dict(times))
+                                     for release, times in self.releases.items())}
+
+    def dump(self, path):
+        f = open(path, 'wb')
+        try:
+            json.dump(self.report(), f, indent = 2, sort_keys = True)
+        finally:
+            f.close()
+
+
+profile = Profile()
@@ -3,6 +3,32 @@ Created on Sep 1, 2012
 Author: George Lifchits
 '''
 from discogs_tracklist import *
+from cache import PersistentCache, PayloadStore, MISS, FAILED
+from workers import WorkerPool, SingleFlight
+from matching import TrackMatcher, hungarian
+from library import LibrarySnapshot
+from itunes import WritePlan
+from pipeline import Pipeline
+from discogs_api import DiscogsAPI, FixtureTransport, RecordingTransport
+from discogs_api import TransientHTTPError, TokenBucket, AdaptiveLimit
+from discogs_api import parse_retry_after, search_results
+from discovery import ReleaseIndex, ReleaseFinder
+from dumps import DumpStore, ingest
+from profiling import Profile, profile
+from builder import TracklistBuilder
+import benchmark
+from batch import BatchFixer, read_jobs, split_persistent_id
+import my_algorithm
+import discogs_tracklist
+import time
+from requests.exceptions import ConnectionError
+import threading
+import tempfile
+import json
+import codecs
+import gzip
+import pickle
+import os
 import unittest
 
 
@@ -145,3 +171,1246 @@ class TestTrackRange(unittest.TestCase):
         expected = ('A2', 'B4')
         result = self.utilities.track_range('A2 to B4')
         self.assertEqual(expected, result)
+
+class TestTrack(unittest.TestCase):
+
+    def test_order(self):
+        first = Track(Name = 'a', TrackNumber = 9, DiscNumber = 1)
+        second = Track(Name = 'b', TrackNumber = 1, DiscNumber = 2)
+        self.assertTrue(first < second)
+        self.assertTrue(second >= first)
+        self.assertEqual(first, Track(Name = 'c', TrackNumber = 9, DiscNumber = 1))
+        self.assertNotEqual(first, second)
+
+    def test_slotted(self):
+        self.assertFalse(hasattr(Track(), '__dict__'))
+
+    def test_pickle(self):
+        track = Track(Name = 'Da Funk', TrackNumber = 2, DiscNumber = 1)
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            copy = pickle.loads(pickle.dumps(track, protocol))
+            self.assertEqual('Da Funk', copy.Name)
+            self.assertEqual(2, copy.TrackNumber)
+
+class TestTracklistTable(unittest.TestCase):
+
+    def setUp(self):
+        self.table = TracklistTable(
+            [Track(Name = 'Track %s' % n, Album = 'Homework', TrackNumber = n,
+                   DiscNumber = disc)
+             for disc, n in [(2, 1), (1, 2), (1, 1)]])
+
+    def test_rows(self):
+        row = self.table[1]
+        self.assertEqual('Track 2', row.Name)
+        self.assertEqual('Homework', row.Album)
+        self.assertEqual(None, row.Artist)
+        self.assertEqual(2, row.TrackNumber)
+
+    def test_strings_are_shared(self):
+        self.assertEqual(3, len(self.table.strings)) # two names and the album
+
+    def test_sort(self):
+        self.assertEqual([2, 1, 0], self.table.order())
+        self.table.sort()
+        self.assertEqual(['Track 1', 'Track 2', 'Track 1'],
+                         [row.Name for row in self.table])
+        self.assertEqual([1, 1, 2], [row.DiscNumber for row in self.table])
+
+    def test_row_writes_through(self):
+        self.table[-1].Artist = 'Daft Punk'
+        self.assertEqual('Daft Punk', self.table.track(2).Artist)
+
+    def test_rows_compare_with_tracks(self):
+        self.assertEqual(Track(TrackNumber = 1, DiscNumber = 1), self.table[2])
+        self.assertTrue(self.table[2] < self.table[0])
+
+class TestSimilar(unittest.TestCase):
+
+    def test_normalize(self):
+        self.assertEqual('dafunkmix',
+                         my_algorithm.normalize_string('Da Funk (Original Mix) [Mix]'))
+        self.assertEqual(u'dafunk', my_algorithm.normalize_string(u'Da-Funk!'))
+
+    def test_identical(self):
+        self.assertEqual(1.0, my_algorithm.similar('Da Funk', 'da funk'))
+
+    def test_matrix(self):
+        strings1 = ['Da Funk', 'Around the World', '']
+        strings2 = ['Da Funk (Original Mix)', 'Revolution 909', 'Around The World', '']
+        matrix = my_algorithm.similarity_matrix(strings1, strings2)
+        for s1, row in zip(strings1, matrix):
+            for s2, score in zip(strings2, row):
+                self.assertAlmostEqual(my_algorithm.similar(s1, s2), score)
+        self.assertEqual(1.0, matrix[0][0])
+        self.assertEqual(1.0, matrix[2][3])
+
+class TestNameExceptions(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+        self.write(u'# comment\nGuillaume Emmanuel de Homem-Christo\n'
+                   u'Guy-Manuel de Homem-Christo\n\nBjo\u0308rk Gudmundsdottir\nBj\xf6rk\n')
+        self.exceptions = NameExceptions(self.path, check_interval = 0)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def write(self, content):
+        f = codecs.open(self.path, 'w', encoding = 'utf-8')
+        f.write(content)
+        f.close()
+
+    def test_lookup(self):
+        self.assertEqual(u'Guy-Manuel de Homem-Christo',
+                         self.exceptions.get('guillaume emmanuel  de homem-christo'))
+        self.assertEqual(None, self.exceptions.get('Thomas Bangalter'))
+
+    def test_unicode_forms(self):
+        # the file has a decomposed \xf6, Discogs the composed one
+        self.assertEqual(u'Bj\xf6rk', self.exceptions.get(u'Bj\xf6rk Gudmundsdottir'))
+
+    def test_validation(self):
+        self.write(u'Only A Name\n')
+        self.assertRaises(ValueError, NameExceptions, self.path)
+        self.write(u'A B\nC\na b\nD\n')
+        self.assertRaises(ValueError, NameExceptions, self.path)
+
+    def test_reload(self):
+        digest = self.exceptions.digest()
+        self.write(u'Thomas Bangalter\nTommy B\n')
+        self.assertEqual(u'Tommy B', self.exceptions.get('Thomas Bangalter'))
+        self.assertNotEqual(digest, self.exceptions.digest())
+
+    def test_invalid_reload_keeps_old(self):
+        self.write(u'Half An Entry\n')
+        self.assertEqual(u'Bj\xf6rk', self.exceptions.get(u'Bj\xf6rk Gudmundsdottir'))
+
+    def test_real_name_fix(self):
+        real_name = RealName(self.path, cache = PersistentCache(':memory:'),
+                             api = DiscogsAPI(StaticTransport({}), rate = None))
+        self.assertEqual(u'Guy-Manuel de Homem-Christo',
+                         real_name.fix(u'Guillaume Emmanuel de Homem-Christo'))
+        self.assertEqual(u'Norman Cook', real_name.fix(u'norman cook (born 1963)'))
+
+class TestPersistentCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = PersistentCache(':memory:', max_entries = 3,
+                                     memory_entries = 2)
+
+    def test_miss(self):
+        self.assertTrue(self.cache.get('artist', 'Nobody') is MISS)
+
+    def test_put_get(self):
+        self.cache.put('realname', 'Daft Punk', ['Thomas Bangalter'])
+        self.assertEqual(['Thomas Bangalter'],
+                         self.cache.get('realname', 'Daft Punk'))
+
+    def test_from_disk(self):
+        self.cache.put('artist', 'A', {'name': 'A'})
+        self.cache.memory.clear()
+        self.assertEqual({'name': 'A'}, self.cache.get('artist', 'A'))
+
+    def test_negative(self):
+        self.cache.put_negative('artist', 'Unknown')
+        self.assertTrue(self.cache.get('artist', 'Unknown') is FAILED)
+
+    def test_expired(self):
+        self.cache.store('artist', 'Old', 'data', False, -1)
+        self.assertTrue(self.cache.get('artist', 'Old') is MISS)
+
+    def test_lru_eviction(self):
+        for key in ['A', 'B', 'C']:
+            self.cache.put('artist', key, key)
+        self.cache.memory.clear()
+        self.cache.get('artist', 'A') # A is now more recent than B
+        self.cache.put('artist', 'D', 'D')
+        self.assertEqual(3, len(self.cache))
+        self.cache.memory.clear()
+        self.assertEqual('A', self.cache.get('artist', 'A'))
+        self.assertEqual('D', self.cache.get('artist', 'D'))
+
+    def test_read_does_not_write(self):
+        self.cache.put('artist', 'A', 'A')
+        self.cache.memory.clear()
+        changes = self.cache.db.total_changes
+        self.assertEqual('A', self.cache.get('artist', 'A'))
+        self.assertEqual(changes, self.cache.db.total_changes)
+
+    def test_access_times_flushed(self):
+        self.cache.flush_every = 2
+        for key in ['A', 'B', 'C']:
+            self.cache.put('artist', key, key)
+        self.cache.memory.clear()
+        self.cache.get('artist', 'A')
+        self.assertEqual(1, len(self.cache.accessed))
+        self.cache.get('artist', 'B') # reaches :flush_every:
+        self.assertEqual({}, self.cache.accessed)
+
+class TestWorkerPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = WorkerPool(workers = 3)
+
+    def test_map_keeps_order(self):
+        expected = [0, 1, 4, 9, 16, 25, 36, 49]
+        self.assertEqual(expected, self.pool.map(lambda x: x * x, range(8)))
+
+    def test_exception(self):
+        future = self.pool.submit(int, 'not a number')
+        self.assertRaises(ValueError, future.result)
+
+    def test_bounded(self):
+        for x in range(20):
+            self.pool.submit(lambda: None).result()
+        self.assertTrue(len(self.pool.threads) <= 3)
+
+    def test_warm_pool_runs_burst_in_parallel(self):
+        pool = WorkerPool(workers = 8)
+        pool.submit(lambda: None).result()
+        start = time.time()
+        pool.map(lambda x: time.sleep(0.1), range(8))
+        self.assertEqual(8, len(pool.threads))
+        self.assertTrue(time.time() - start < 0.5)
+
+    def test_nested_submit(self):
+        pool = WorkerPool(workers = 1)
+        inner = lambda: pool.submit(lambda: 'inner').result()
+        self.assertEqual('inner', pool.submit(inner).result(timeout = 5))
+
+class TestSingleFlight(unittest.TestCase):
+
+    def test_collapses_concurrent_calls(self):
+        flight = SingleFlight(WorkerPool(workers = 4))
+        release = threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            release.wait(5)
+            return 'result'
+
+        futures = [flight.submit('Daft Punk', fetch) for x in range(5)]
+        release.set()
+        self.assertEqual(['result'] * 5, [f.result() for f in futures])
+        self.assertEqual(1, len(calls))
+
+class TestCreditIndex(unittest.TestCase):
+
+    def setUp(self):
+        credit = lambda name, tracks: {'name': name, 'tracks': tracks}
+        self.a = credit('A', '1 to 3')
+        self.b = credit('B', '')
+        self.c = credit('C', '2-1, 3')
+        self.d = credit('D', 'A2 to B1')
+        positions = ['1', '2', '3', '4', '2-1', '2-2']
+        self.index = CreditIndex([self.a, self.b, self.c], positions)
+
+    def test_range(self):
+        self.assertEqual([self.a, self.b], self.index.get('2'))
+
+    def test_list_keeps_credit_order(self):
+        self.assertEqual([self.a, self.b, self.c], self.index.get('3'))
+
+    def test_other_disc(self):
+        self.assertEqual([self.b, self.c], self.index.get('2-1'))
+
+    def test_unscoped_excluded(self):
+        index = CreditIndex([self.a, self.b], ['1', '4'], unscoped = False)
+        self.assertEqual([], index.get('4'))
+
+    def test_unindexed_position(self):
+        self.assertEqual([self.b], self.index.get('5'))
+
+    def test_vinyl(self):
+        index = CreditIndex([self.d], ['A1', 'A2', 'A3', 'B1', 'B2', 'C2'])
+        self.assertEqual([self.d], index.get('A3'))
+        self.assertEqual([self.d], index.get('B1'))
+        self.assertEqual([], index.get('B2'))
+        self.assertEqual([], index.get('C2'))
+
+class TestTrackPositions(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual((1, 0, 5), TrackPositions.parse('5'))
+        self.assertEqual((2, 0, 13), TrackPositions.parse('2-13'))
+        self.assertEqual((2, 1, 2), TrackPositions.parse('C2'))
+        self.assertEqual((1, 2, 1), TrackPositions.parse('B'))
+        self.assertEqual((1, 0, 3), TrackPositions.parse('3a'))
+
+    def test_key_order(self):
+        positions = ['B1', '2-1', 'A10', '1-2', 'A2', 'C1']
+        self.assertEqual(['1-2', 'A2', 'A10', 'B1', '2-1', 'C1'],
+                         sorted(positions, key = TrackPositions.key))
+
+    def test_vinyl_numbers(self):
+        positions = TrackPositions(['A1', 'A2', 'B1', 'B2', 'C1'])
+        self.assertEqual([(1, 1), (2, 1), (3, 1), (4, 1), (1, 2)],
+                         positions.numbers)
+        self.assertEqual({1: 4, 2: 1}, positions.totals)
+        self.assertEqual(2, positions.disc_total)
+
+    def test_totals_per_disc(self):
+        positions = TrackPositions(['1-1', '1-2', '2-1', '2-2', '2-3', '3-1'])
+        self.assertEqual({1: 2, 2: 3, 3: 1}, positions.totals)
+
+class TestHungarian(unittest.TestCase):
+
+    def test_square(self):
+        cost = [[4, 1, 3],
+                [2, 0, 5],
+                [3, 2, 2]]
+        self.assertEqual([1, 0, 2], hungarian(cost))
+
+    def test_rectangular(self):
+        cost = [[9, 1, 9, 9],
+                [9, 9, 9, 1]]
+        self.assertEqual([1, 3], hungarian(cost))
+
+    def test_beats_greedy(self):
+        # greedy would give row 0 column 0 and leave row 1 with cost 10
+        cost = [[1, 2],
+                [2, 10]]
+        self.assertEqual([1, 0], hungarian(cost))
+
+class TestTrackMatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.matcher = TrackMatcher()
+        names = ['Around the World', 'Da Funk', 'One More Time', 'Aerodynamic']
+        self.discogs = [Track(Name = name, Artist = 'Daft Punk', TrackNumber = n,
+                              DiscNumber = 1) for n, name in enumerate(names)]
+
+    def test_matches_by_name(self):
+        itunes = [Track(Name = 'one more time', Artist = 'Daft Punk'),
+                  Track(Name = 'Da Funk (Original Mix)', Artist = 'Daft Punk')]
+        matched = self.matcher.match(itunes, self.discogs)
+        self.assertTrue(matched[0][1] is self.discogs[2])
+        self.assertTrue(matched[1][1] is self.discogs[1])
+        self.assertTrue(matched[0][2] > 0.5)
+
+    def test_one_to_one(self):
+        itunes = [Track(Name = 'Around the World', Artist = 'Daft Punk')] * 2
+        matched = self.matcher.match(itunes, self.discogs[:2])
+        self.assertFalse(matched[0][1] is matched[1][1])
+
+    def test_more_itunes_tracks(self):
+        itunes = [Track(Name = 'Aerodynamic', Artist = 'Daft Punk'),
+                  Track(Name = 'Something Else', Artist = 'Nobody')]
+        matched = self.matcher.match(itunes, self.discogs[3:])
+        self.assertTrue(matched[0][1] is self.discogs[3])
+        self.assertEqual((None, 0.0), matched[1][1:])
+
+class TestLibrarySnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.snapshot = LibrarySnapshot()
+        self.reads = []
+
+    def entries(self, tracks):
+        for key, stamp, genre, label in tracks:
+            def read(key = key, genre = genre, label = label):
+                self.reads.append(key)
+                return genre, label
+            yield key, stamp, read
+
+    def test_first_refresh(self):
+        tracks = [(1, 'a', 'House', 'Roule'), (2, 'a', 'House', 'Crydamoure')]
+        self.assertEqual((2, 0, 0), self.snapshot.refresh(self.entries(tracks)))
+        self.assertEqual({'House': 2}, self.snapshot.genres)
+
+    def test_only_changed_tracks_read(self):
+        tracks = [(1, 'a', 'House', 'Roule'), (2, 'a', 'House', 'Roule')]
+        self.snapshot.refresh(self.entries(tracks))
+        self.reads = []
+        tracks = [(1, 'a', 'House', 'Roule'), (2, 'b', 'Techno', 'Roule'),
+                  (3, 'a', 'Techno', 'Vulture')]
+        self.assertEqual((1, 1, 0), self.snapshot.refresh(self.entries(tracks)))
+        self.assertEqual([2, 3], self.reads)
+        self.assertEqual({'House': 1, 'Techno': 2}, self.snapshot.genres)
+        self.assertEqual({'Roule': 2, 'Vulture': 1}, self.snapshot.labels)
+
+    def test_removed(self):
+        self.snapshot.refresh(self.entries([(1, 'a', 'House', 'Roule')]))
+        self.assertEqual((0, 0, 1), self.snapshot.refresh(self.entries([])))
+        self.assertEqual({}, self.snapshot.labels)
+
+    def test_save_load(self):
+        path = os.path.join(tempfile.mkdtemp(), 'library.pkl')
+        snapshot = LibrarySnapshot(path)
+        snapshot.refresh(self.entries([(1, 'a', 'House', 'Roule')]))
+        snapshot.save()
+        loaded = LibrarySnapshot(path)
+        self.assertTrue(loaded.load())
+        self.assertEqual(snapshot.tracks, loaded.tracks)
+        self.assertEqual({'Roule': 1}, loaded.labels)
+
+class FakeItunesTrack(object):
+
+    def __init__(self, **fields):
+        for d_field, i_field in WritePlan.FIELDS:
+            setattr(self, i_field, None)
+        self.__dict__.update(fields)
+
+class TestWritePlan(unittest.TestCase):
+
+    def setUp(self):
+        self.i = FakeItunesTrack(Name = 'Da Funk', Artist = 'daft punk',
+                                 TrackNumber = 2)
+        self.d = Track(Name = 'Da Funk', Artist = 'Daft Punk', TrackNumber = 2,
+                       Comments = 'D:123')
+
+    def test_minimal_changes(self):
+        plan = WritePlan([(self.i, self.d)])
+        changes = plan.read()
+        self.assertEqual([(self.i, [('Artist', 'daft punk', 'Daft Punk'),
+                                    ('Comment', None, 'D:123')])], changes)
+        self.assertEqual(4, plan.reads)
+
+    def test_dry_run_writes_nothing(self):
+        WritePlan([(self.i, self.d)]).read()
+        self.assertEqual('daft punk', self.i.Artist)
+
+    def test_apply(self):
+        plan = WritePlan([(self.i, self.d), (FakeItunesTrack(), None)])
+        plan.read()
+        plan.apply()
+        self.assertEqual('Daft Punk', self.i.Artist)
+        self.assertEqual('D:123', self.i.Comment)
+        self.assertEqual(2, plan.writes)
+
+class TestPipeline(unittest.TestCase):
+
+    def test_all_items_through_every_stage(self):
+        pipeline = Pipeline(queue_size = 1)
+        pipeline.stage('double', lambda x: x * 2, workers = 3)
+        pipeline.stage('add', lambda x: x + 1)
+        results = []
+        failures = pipeline.run(range(10), results.append)
+        self.assertEqual([], failures)
+        self.assertEqual([x * 2 + 1 for x in range(10)], sorted(results))
+
+    def test_failures_skip_later_stages(self):
+        pipeline = Pipeline()
+        pipeline.stage('parse', int, workers = 2)
+        pipeline.stage('negate', lambda x: -x)
+        results = []
+        failures = pipeline.run(['1', 'x', '3'], results.append)
+        self.assertEqual([-3, -1], sorted(results))
+        self.assertEqual(['parse'], [failure.stage for failure in failures])
+        self.assertEqual('x', failures[0].item)
+
+    def test_interrupt_in_sink_propagates(self):
+        def sink(result):
+            raise KeyboardInterrupt
+        pipeline = Pipeline()
+        pipeline.stage('negate', lambda x: -x)
+        self.assertRaises(KeyboardInterrupt, pipeline.run, [1, 2], sink)
+
+class StaticTransport(object):
+
+    def __init__(self, data):
+        self.data = data
+
+    def fetch(self, kind, key):
+        return self.data[(kind, key)]
+
+class TestFixtureTransport(unittest.TestCase):
+
+    def setUp(self):
+        self.fixture_dir = tempfile.mkdtemp()
+        data = {('release', 1491027): {'id': 1491027, 'title': 'Test'},
+                ('artist', u'Mehdi & Fafi'): {'name': u'Mehdi & Fafi'}}
+        recorder = DiscogsAPI(RecordingTransport(self.fixture_dir,
+                                                 StaticTransport(data)))
+        recorder.release(1491027)
+        recorder.artist(u'Mehdi & Fafi')
+
+    def test_replay(self):
+        api = DiscogsAPI(FixtureTransport(self.fixture_dir))
+        self.assertEqual('Test', api.release(1491027)['title'])
+        self.assertEqual(u'Mehdi & Fafi', api.artist(u'Mehdi & Fafi')['name'])
+        self.assertEqual(2, api.stats()['total_requests'])
+
+    def test_not_found(self):
+        api = DiscogsAPI(FixtureTransport(self.fixture_dir))
+        self.assertRaises(discogs.DiscogsAPIError, api.master, 1)
+        self.assertEqual(1, api.stats()['errors'])
+
+    def test_error_injection(self):
+        api = DiscogsAPI(FixtureTransport(self.fixture_dir, error_rate = 1),
+                         retries = 0)
+        self.assertRaises(ConnectionError, api.release, 1491027)
+
+class FlakyTransport(object):
+
+    def __init__(self, failures):
+        self.failures = list(failures)
+        self.calls = 0
+
+    def fetch(self, kind, key):
+        self.calls += 1
+        if self.failures:
+            raise self.failures.pop(0)
+        return {'id': key}
+
+class TestDiscogsAPIRetries(unittest.TestCase):
+
+    def api(self, transport, **options):
+        return DiscogsAPI(transport, rate = None, backoff = 0.001, **options)
+
+    def test_retries_transient_errors(self):
+        transport = FlakyTransport([ConnectionError(), TransientHTTPError(503)])
+        api = self.api(transport)
+        self.assertEqual({'id': 1}, api.release(1))
+        self.assertEqual(3, transport.calls)
+        self.assertEqual(2, api.stats()['retried'])
+
+    def test_gives_up(self):
+        transport = FlakyTransport([ConnectionError()] * 3)
+        api = self.api(transport, retries = 2)
+        self.assertRaises(ConnectionError, api.release, 1)
+        self.assertEqual(3, transport.calls)
+
+    def test_not_found_not_retried(self):
+        transport = FlakyTransport([discogs.DiscogsAPIError('404 Not Found')])
+        self.assertRaises(discogs.DiscogsAPIError, self.api(transport).artist, 'x')
+        self.assertEqual(1, transport.calls)
+
+    def test_retry_after(self):
+        api = self.api(FlakyTransport([]))
+        self.assertEqual(7, api.delay(0, TransientHTTPError(429, 7)))
+        self.assertTrue(api.delay(3, ConnectionError()) <= 0.008)
+
+    def test_parse_retry_after(self):
+        self.assertEqual(30.0, parse_retry_after('30'))
+        self.assertEqual(0.0, parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'))
+        self.assertEqual(None, parse_retry_after(None))
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(rate = 100, capacity = 3)
+        start = time.time()
+        for i in range(5):
+            bucket.acquire()
+        self.assertTrue(time.time() - start >= 0.015)
+
+class TestAdaptiveLimit(unittest.TestCase):
+
+    def test_throttled_halves(self):
+        limit = AdaptiveLimit(initial = 8)
+        limit.acquire()
+        limit.release(0.1, throttled = True)
+        self.assertEqual(4, limit.limit)
+
+    def test_grows_when_fast(self):
+        limit = AdaptiveLimit(initial = 2, window = 3)
+        for i in range(3):
+            limit.acquire()
+            limit.release(0.1)
+        self.assertEqual(3, limit.limit)
+
+    def test_slow_halves(self):
+        limit = AdaptiveLimit(initial = 2, slow = 1.0)
+        limit.acquire()
+        limit.release(5.0)
+        self.assertEqual(1, limit.limit)
+
+def make_release(tracks = 3):
+    artist = {'name': 'Daft Punk', 'anv': '', 'join': '', 'role': '', 'tracks': ''}
+    return {'id': 1, 'title': 'Homework', 'year': 1997,
+            'genres': ['Electronic'], 'labels': [{'name': 'Virgin'}],
+            'artists': [artist], 'extraartists': [],
+            'tracklist': [{'position': str(n), 'title': 'Track %s' % n}
+                          for n in range(1, tracks + 1)]}
+
+class TestResumableTracklist(unittest.TestCase):
+
+    def setUp(self):
+        self.checkpoint_dir = tempfile.mkdtemp()
+        self.data = {('release', 1): make_release(),
+                     ('artist', 'Daft Punk'): {'name': 'Daft Punk'}}
+        self.api = DiscogsAPI(StaticTransport(self.data), rate = None)
+        self.real_name = RealName(cache = PersistentCache(':memory:'),
+                                  api = self.api)
+
+    def tracklist(self):
+        tracklist = DiscogsTracklist(1, build = False, api = self.api,
+                                     real_name = self.real_name,
+                                     checkpoint_dir = self.checkpoint_dir)
+        tracklist.retry_delay = 0
+        return tracklist
+
+    def test_resumes_from_checkpoint(self):
+        first = self.tracklist()
+        first.prefetch_writers()
+        first.built.append(first.build_track(first.release_tracklist[0], 1))
+        first.save_checkpoint()
+
+        second = self.tracklist()
+        self.assertEqual(1, len(second.built))
+        built = []
+        build_track = second.build_track
+        second.build_track = lambda track, count: built.append(count) or \
+                                                  build_track(track, count)
+        tracks = second.get_release_info()
+        self.assertEqual([2, 3], built)
+        self.assertEqual(['Track 1', 'Track 2', 'Track 3'],
+                         [track.Name for track in tracks])
+        self.assertEqual([], os.listdir(self.checkpoint_dir))
+
+    def test_changed_release_starts_over(self):
+        first = self.tracklist()
+        first.prefetch_writers()
+        first.built.append(first.build_track(first.release_tracklist[0], 1))
+        first.save_checkpoint()
+
+        self.data[('release', 1)] = make_release(tracks = 4)
+        self.assertEqual([], self.tracklist().built)
+
+    def test_retry_keeps_built_tracks(self):
+        tracklist = self.tracklist()
+        build_track = tracklist.build_track
+        failures = [2]
+        def flaky(track, count):
+            if count in failures:
+                failures.remove(count)
+                raise ConnectionError()
+            return build_track(track, count)
+        tracklist.build_track = flaky
+        tracklist.checkpoint_every = 2
+        calls = []
+        tracklist.save_checkpoint = lambda: calls.append(len(tracklist.built))
+        self.assertEqual(3, len(tracklist.get_release_info()))
+        self.assertEqual([1, 2], calls)
+
+    def test_changed_exceptions_start_over(self):
+        first = self.tracklist()
+        first.prefetch_writers()
+        first.built.append(first.build_track(first.release_tracklist[0], 1))
+        first.save_checkpoint()
+
+        exceptions_file = os.path.join(self.checkpoint_dir, 'exceptions.txt')
+        f = open(exceptions_file, 'wb')
+        f.write('Daft Punk\nDaft Punk (Duo)\n')
+        f.close()
+        self.real_name.exceptions = NameExceptions(exceptions_file)
+        self.assertEqual([], self.tracklist().built)
+
+class TestMasterYear(unittest.TestCase):
+
+    def setUp(self):
+        self.release = make_release()
+        self.release['master_id'] = 7
+        self.data = {('release', 1): self.release,
+                     ('master', 7): {'id': 7, 'year': 1995}}
+        self.api = DiscogsAPI(StaticTransport(self.data), rate = None)
+
+    def tracklist(self, year_policy = 'auto'):
+        return DiscogsTracklist(1, build = False, api = self.api,
+                                real_name = RealName(cache = PersistentCache(':memory:'),
+                                                     api = self.api),
+                                year_policy = year_policy)
+
+    def test_original_release_skips_master(self):
+        tracklist = self.tracklist()
+        self.assertEqual(None, tracklist.master)
+        self.assertEqual(1997, tracklist.year)
+
+    def test_reissue_uses_master_year(self):
+        self.release['formats'] = [{'name': 'CD', 'descriptions': ['Album', 'Reissue']}]
+        self.assertEqual(1995, self.tracklist().year)
+
+    def test_missing_year_uses_master_year(self):
+        self.release['year'] = 0
+        self.assertEqual(1995, self.tracklist().year)
+
+    def test_policies(self):
+        self.assertEqual(1995, self.tracklist('master').year)
+        self.release['year'] = 0
+        self.assertEqual(0, self.tracklist('release').year)
+
+class TestTracklistBuilder(unittest.TestCase):
+
+    def setUp(self):
+        self.data = {('artist', 'Daft Punk'): {'name': 'Daft Punk'}}
+        for release_id in range(1, 6):
+            release = make_release(tracks = release_id)
+            release['id'] = release_id
+            self.data[('release', release_id)] = release
+        api = DiscogsAPI(StaticTransport(self.data), rate = None, retries = 0)
+        self.builder = TracklistBuilder(3, api = api,
+                                        real_name = RealName(cache = PersistentCache(':memory:'),
+                                                             api = api),
+                                        attempts = 1, retry_delay = 0)
+
+    def test_needs_an_attempt(self):
+        self.assertRaises(ValueError, TracklistBuilder, api = self.builder.api,
+                          real_name = self.builder.real_name, attempts = 0)
+
+    def test_build_many(self):
+        finished = []
+        tracklists, failures = self.builder.build_many([1, 2, 3, 4, 5, 3],
+                                                       lambda release_id, future:
+                                                       finished.append(release_id))
+        self.assertEqual({}, failures)
+        self.assertEqual([1, 2, 3, 4, 5], sorted(finished))
+        for release_id, tracklist in tracklists.items():
+            self.assertEqual(release_id, len(tracklist.discogs_tracklist))
+
+    def test_failures_are_collected(self):
+        tracklists, failures = self.builder.build_many([1, 99])
+        self.assertEqual([1], tracklists.keys())
+        self.assertEqual([99], failures.keys())
+
+    def test_connection_failures_fail_the_build(self):
+        fetched = []
+        class DownTransport(StaticTransport):
+            def fetch(self, kind, key):
+                fetched.append(kind)
+                if kind == 'artist':
+                    raise ConnectionError()
+                return StaticTransport.fetch(self, kind, key)
+
+        api = DiscogsAPI(DownTransport(self.data), rate = None, retries = 0)
+        builder = TracklistBuilder(2, api = api, attempts = 3, retry_delay = 0,
+                                   real_name = RealName(cache = PersistentCache(':memory:'),
+                                                        api = api))
+        tracklists, failures = builder.build_many([1, 2])
+        self.assertEqual({}, tracklists)
+        self.assertTrue(isinstance(failures[1], ConnectionError))
+        self.assertEqual(2, fetched.count('release'))
+
+    def test_submit_returns_future(self):
+        future = self.builder.submit(2)
+        self.assertEqual(['Track 1', 'Track 2'],
+                         [track.Name for track in future.result().discogs_tracklist])
+
+class TestReleaseIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = ReleaseIndex()
+        self.index.add(1, u'Daft Punk', u'Homework', 16)
+        self.index.add(2, u'Daft Punk', u'Discovery', 14)
+        self.index.add(3, u'Beyonc\xe9', u'Lemonade', 12)
+
+    def test_tokens(self):
+        self.assertEqual([2, 1], [candidate.release_id for candidate in
+                                  self.index.search('Daft Punk', 'Discovery')])
+
+    def test_accents(self):
+        self.assertEqual([3], [candidate.release_id for candidate in
+                               self.index.search('Beyonce', '')])
+
+    def test_misspelled(self):
+        candidates = self.index.search('Daftpunk', 'Homwork')
+        self.assertEqual(1, candidates[0].release_id)
+
+    def test_add_while_searching(self):
+        errors = []
+        def add():
+            for release_id in range(4, 2000):
+                self.index.add(release_id, u'Daft Punk', u'Homework %s' % release_id)
+        def search():
+            try:
+                for n in range(100):
+                    self.index.search('Daft Punk', 'Homework')
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target = add)] + \
+                  [threading.Thread(target = search) for n in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        self.assertEqual(1999, len(self.index))
+
+    def test_from_store(self):
+        store = PayloadStore(':memory:')
+        release = make_release()
+        store.put('release', 1, release)
+        index = ReleaseIndex.from_store(store)
+        self.assertEqual((u'Daft Punk', u'Homework', 3), index.releases[1])
+
+class TestReleaseFinder(unittest.TestCase):
+
+    def setUp(self):
+        homework = make_release()
+        reissue = make_release(tracks = 5)
+        reissue['id'] = 2
+        other = make_release(tracks = 3)
+        other['id'] = 3
+        other['title'] = 'Alive 1997'
+        data = {('release', 1): homework,
+                ('release', 2): reissue,
+                ('release', 3): other,
+                ('search', u'Daft Punk Homework'): [
+                    {'id': 3, 'artist': u'Daft Punk', 'title': u'Alive 1997'},
+                    {'id': 2, 'artist': u'Daft Punk', 'title': u'Homework'},
+                    {'id': 1, 'artist': u'Daft Punk', 'title': u'Homework'}]}
+        self.api = DiscogsAPI(StaticTransport(data), rate = None)
+        self.tracks = [Track(Name = 'Track %s' % n, Artist = 'Daft Punk',
+                             Album = 'Homework') for n in range(3)]
+
+    def test_ranks_by_title_and_track_count(self):
+        finder = ReleaseFinder(self.api)
+        self.assertEqual([1, 2, 3], [candidate.release_id for candidate in
+                                     finder.find(self.tracks)])
+        self.assertEqual(1, finder.best(self.tracks).release_id)
+
+    def test_nothing_good_enough(self):
+        tracks = [Track(Name = 'Song', Artist = 'Daft Punk', Album = 'Homework')]
+        self.assertEqual(None, ReleaseFinder(self.api).best(tracks, min_score = 0.99))
+
+    def test_search_results(self):
+        data = {'searchresults': {'results': [
+            {'type': 'artist', 'title': 'Daft Punk', 'uri': 'http://www.discogs.com/artist/Daft+Punk'},
+            {'type': 'release', 'title': 'Daft Punk - Homework',
+             'uri': 'http://www.discogs.com/Daft-Punk-Homework/release/1491027'}]}}
+        self.assertEqual([{'id': 1491027, 'artist': 'Daft Punk', 'title': 'Homework'}],
+                         search_results(data))
+
+ARTISTS_DUMP = """<?xml version="1.0" encoding="UTF-8"?>
+<artists>
+<artist><id>1</id><name>Daft Punk</name><profile></profile>
+<members><id>2</id><name>Thomas Bangalter</name><name id="3">Guy-Manuel de Homem-Christo</name></members>
+</artist>
+<artist><id>2</id><name>Thomas Bangalter</name><realname>Thomas Bangalter</realname>
+<groups><name id="1">Daft Punk</name></groups></artist>
+<artist><id>3</id><name>Guy-Manuel de Homem-Christo</name></artist>
+</artists>"""
+
+RELEASES_DUMP = """<?xml version="1.0" encoding="UTF-8"?>
+<releases>
+<release id="1" status="Accepted"><artists><artist><id>1</id><name>Daft Punk</name><anv></anv><join></join><role></role><tracks></tracks></artist></artists>
+<title>Homework</title><labels><label name="Virgin" catno="V2821"/></labels>
+<extraartists><artist><id>2</id><name>Thomas Bangalter</name><anv></anv><join></join><role>Written-By</role><tracks>1 to 2</tracks></artist></extraartists>
+<formats><format name="CD" qty="1" text=""><descriptions><description>Album</description></descriptions></format></formats>
+<genres><genre>Electronic</genre></genres><released>1997-01-20</released><master_id is_main_release="true">7</master_id>
+<tracklist><track><position>1</position><title>Daftendirekt</title><duration>2:45</duration></track>
+<track><position>2</position><title>WDPK 83.7 FM</title><duration>0:28</duration>
+<artists><artist><id>1</id><name>Daft Punk</name><anv>DP</anv><join></join><role></role><tracks></tracks></artist></artists></track></tracklist>
+</release>
+</releases>"""
+
+class TestDumps(unittest.TestCase):
+
+    def setUp(self):
+        self.dump_dir = tempfile.mkdtemp()
+        self.store = DumpStore(':memory:')
+
+    def write(self, name, content):
+        path = os.path.join(self.dump_dir, name)
+        f = gzip.open(path, 'wb') if name.endswith('.gz') else open(path, 'wb')
+        f.write(content)
+        f.close()
+        return path
+
+    def test_artists(self):
+        batches = []
+        count = ingest(self.write('artists.xml.gz', ARTISTS_DUMP), self.store,
+                       batch_size = 1, progress = lambda kind, n: batches.append(n))
+        self.assertEqual(3, count)
+        self.assertEqual([1, 2, 3], batches)
+        self.assertEqual(['Thomas Bangalter', 'Guy-Manuel de Homem-Christo'],
+                         self.store.get('artist', 'Daft Punk')['members'])
+        self.assertEqual('Thomas Bangalter',
+                         self.store.get('artist', 'Thomas Bangalter')['realname'])
+        self.assertEqual(None, self.store.get('artist', 'Nobody'))
+
+    def test_releases(self):
+        ingest(self.write('releases.xml', RELEASES_DUMP), self.store)
+        release = self.store.get('release', '1')
+        self.assertEqual('Homework', release['title'])
+        self.assertEqual(1997, release['year'])
+        self.assertEqual(7, release['master_id'])
+        self.assertEqual([{'name': 'Virgin', 'catno': 'V2821'}], release['labels'])
+        self.assertEqual('1 to 2', release['extraartists'][0]['tracks'])
+        self.assertFalse('artists' in release['tracklist'][0])
+        self.assertEqual('DP', release['tracklist'][1]['artists'][0]['anv'])
+
+    def test_not_a_dump(self):
+        self.assertRaises(ValueError, ingest,
+                          self.write('other.xml', '<labels><label/></labels>'), self.store)
+
+    def test_api_reads_dump(self):
+        ingest(self.write('artists.xml', ARTISTS_DUMP), self.store)
+        ingest(self.write('releases.xml', RELEASES_DUMP), self.store)
+        api = DiscogsAPI(StaticTransport({}), rate = None, dump = self.store)
+        tracklist = DiscogsTracklist(1, build = False, api = api,
+                                     real_name = RealName(cache = PersistentCache(':memory:'),
+                                                          api = api),
+                                     year_policy = 'release')
+        self.assertEqual(['Daftendirekt', 'WDPK 83.7 FM'],
+                         [track.Name for track in tracklist.get_release_info()])
+        self.assertEqual(0, api.stats()['total_requests'])
+        self.assertTrue(api.stats()['dumped'] > 0)
+
+class CountingTransport(StaticTransport):
+
+    def __init__(self, data):
+        StaticTransport.__init__(self, data)
+        self.fetched = []
+
+    def fetch(self, kind, key):
+        self.fetched.append(key)
+        if (kind, key) not in self.data:
+            raise discogs.DiscogsAPIError('404 Not Found')
+        return self.data[(kind, key)]
+
+class TestGroupMembers(unittest.TestCase):
+
+    def setUp(self):
+        artist = lambda name, **data: (('artist', name), dict(name = name, **data))
+        self.transport = CountingTransport(dict([
+            artist('Collective', id = 1, members = ['A', 'Duo']),
+            artist('Duo', id = 2, members = [{'id': 5, 'name': 'B'}, 'Collective']),
+            artist('A', id = 4, realname = 'alice smith'),
+            artist('B', id = 5, realname = 'Bob Jones')] +
+            [artist('G%s' % n, members = ['G%s' % (n + 1)]) for n in range(6)] +
+            [artist('G6', realname = 'Deep Down')]))
+        api = DiscogsAPI(self.transport, rate = None)
+        self.real_name = RealName(cache = PersistentCache(':memory:'), api = api)
+
+    def test_cycle(self):
+        self.assertEqual(['Alice Smith', 'Bob Jones'], self.real_name.get('Collective'))
+        self.assertEqual(['Alice Smith', 'Bob Jones'], self.real_name.get('Collective'))
+        self.assertEqual(['A', 'B', 'Collective', 'Duo'], sorted(self.transport.fetched))
+
+    def test_depth_limit(self):
+        self.assertEqual(['G5'], self.real_name.get('G0'))
+        self.assertEqual(['Deep Down'], self.real_name.get('G3'))
+
+    def test_memoized_by_id(self):
+        self.real_name.get('B')
+        self.transport.data[('artist', 'Trio')] = {'name': 'Trio',
+                                                   'members': [{'id': 5, 'name': 'B (2)'}]}
+        self.assertEqual(['Bob Jones'], self.real_name.get('Trio'))
+        self.assertFalse('B (2)' in self.transport.fetched)
+
+class TestPrefetchWriters(unittest.TestCase):
+
+    def test_writers_resolved_once_up_front(self):
+        release = make_release(tracks = 4)
+        credit = lambda name: {'name': name, 'anv': '', 'join': '', 'role': '', 'tracks': ''}
+        for n, writers in enumerate([['Alice'], ['Alice'], ['Bob'], ['Alice', 'Carol']]):
+            release['tracklist'][n]['artists'] = [credit(name) for name in writers]
+        transport = CountingTransport(dict([(('release', 1), release)] +
+                                           [(('artist', name), {'name': name})
+                                            for name in ('Alice', 'Bob', 'Carol')]))
+        api = DiscogsAPI(transport, rate = None)
+        real_name = RealName(cache = PersistentCache(':memory:'), api = api)
+        calls = []
+        resolve = real_name.resolve
+        real_name.resolve = lambda names, resolved = None: \
+            calls.append(sorted(set(names))) or resolve(names, resolved)
+
+        tracklist = DiscogsTracklist(1, build = False, api = api, real_name = real_name)
+        build_track = tracklist.build_track
+        tracklist.build_track = lambda track, count: \
+            calls.append(count) or build_track(track, count)
+        tracks = tracklist.get_release_info()
+
+        self.assertEqual([['Alice', 'Bob', 'Carol'], 1, 2, 3, 4], calls)
+        for name in ('Alice', 'Bob', 'Carol'):
+            self.assertEqual(1, transport.fetched.count(name))
+        self.assertEqual(['Alice', 'Alice', 'Bob', 'Alice/Carol'],
+                         [track.Composer for track in tracks])
+
+class TestLazyItunesInfo(unittest.TestCase):
+
+    def setUp(self):
+        self.shared = discogs_tracklist._itunes_info
+        self.info = ItunesInfo()
+        self.calls = []
+        self.info.connect = lambda: self.calls.append('connect')
+        self.info.snapshot.load = lambda: self.calls.append('load') or False
+        discogs_tracklist._itunes_info = self.info
+
+    def tearDown(self):
+        discogs_tracklist._itunes_info = self.shared
+
+    def tracklist(self, labels):
+        release = make_release()
+        release['labels'] = [{'name': label} for label in labels]
+        api = DiscogsAPI(StaticTransport({('release', 1): release,
+                                          ('artist', 'Daft Punk'): {'name': 'Daft Punk'}}),
+                         rate = None)
+        return DiscogsTracklist(1, api = api,
+                                real_name = RealName(cache = PersistentCache(':memory:'),
+                                                     api = api))
+
+    def test_untouched_without_label_choice(self):
+        self.tracklist(['Virgin'])
+        self.assertEqual([], self.calls)
+        self.assertFalse(self.info.loaded)
+
+    def test_loaded_once_for_label_choice(self):
+        self.tracklist(['Virgin', 'Soma'])
+        self.tracklist(['Virgin', 'Soma'])
+        self.assertEqual(['load'], self.calls)
+
+class TestProfile(unittest.TestCase):
+
+    def setUp(self):
+        self.profile = Profile()
+
+    def test_timer(self):
+        with self.profile.timer('match', 1):
+            pass
+        with self.profile.timer('match'):
+            pass
+        report = self.profile.report()
+        self.assertEqual(2, report['stages']['match']['calls'])
+        self.assertEqual(['match'], report['releases']['1'].keys())
+
+    def test_histogram(self):
+        for latency in [0.003] * 9 + [1.5]:
+            self.profile.observe('api.release', latency)
+        histogram = self.profile.report()['histograms']['api.release']
+        self.assertEqual(10, histogram['count'])
+        self.assertEqual(0.005, histogram['p50'])
+        self.assertEqual(2.0, histogram['p99'])
+        self.assertEqual({'<=0.005s': 9, '<=2s': 1}, histogram['buckets'])
+
+    def test_hit_rates(self):
+        self.profile.count('cache.artist.hit', 3)
+        self.profile.count('cache.artist.miss')
+        self.assertEqual({'cache.artist': 0.75}, self.profile.report()['hit_rates'])
+
+    def test_build_is_profiled(self):
+        profile.reset()
+        api = DiscogsAPI(StaticTransport({('release', 1): make_release(),
+                                          ('artist', 'Daft Punk'): {'name': 'Daft Punk'}}),
+                         rate = None)
+        real_name = RealName(cache = PersistentCache(':memory:'), api = api)
+        DiscogsTracklist(1, api = api, real_name = real_name)
+        report = profile.report()
+        for stage in ('release.fetch', 'release.prepare', 'release.writers',
+                      'release.tracks', 'realname.fetch'):
+            self.assertTrue(stage in report['stages'], stage)
+        self.assertEqual(1, report['histograms']['api.release']['count'])
+        self.assertEqual(0.0, report['hit_rates']['cache.artist'])
+        json.dumps(report)
+
+class TestBenchmarkSuite(unittest.TestCase):
+
+    def test_box_set(self):
+        release = benchmark.synthetic_release(discs = 20, tracks = 12, credits = 2)
+        tracks = benchmark.build_release(release)
+        self.assertEqual(240, len(tracks))
+        self.assertEqual((12, 20, 12, 20), (tracks[-1].TrackNumber, tracks[-1].DiscNumber,
+                                            tracks[-1].TrackCount, tracks[-1].DiscCount))
+
+    def test_match_all(self):
+        tracks = benchmark.build_release(benchmark.synthetic_release(tracks = 5))
+        matched = benchmark.match_all(tracks)
+        self.assertEqual([track.Name for track in reversed(tracks)],
+                         [d_track.Name for i_track, d_track, confidence in matched])
+
+    def test_growth_exponent(self):
+        self.assertAlmostEqual(2.0, benchmark.growth_exponent({'10': 1.0, '30': 9.0,
+                                                                '100': 100.0}))
+
+    def test_compare(self):
+        baseline = {'timings': {'similar': {'100': 1.0}, 'match_tracks': {'100': 1.0}},
+                    'growth': {'similar': 1.0, 'match_tracks': 1.0}}
+        results = {'timings': {'similar': {'100': 1.1}, 'match_tracks': {'100': 1.5},
+                               'new': {'100': 9.0}},
+                   'growth': {'similar': 1.2, 'match_tracks': 2.0}}
+        self.assertEqual([('match_tracks@100', 'timing', 1.0, 1.5),
+                          ('match_tracks', 'growth', 1.0, 2.0)],
+                         benchmark.compare(results, baseline))
+        del baseline['timings']
+        self.assertEqual([('match_tracks', 'growth', 1.0, 2.0)],
+                         benchmark.compare(results, baseline))
+
+class FakeITunes(object):
+    '''
+    The parts of the iTunes COM API BatchFixer uses
+    '''
+
+    def __init__(self, tracks, playlists):
+        self.tracks = tracks
+        self.playlists = playlists
+        self.LibrarySource = self
+        self.Playlists = self
+        self.LibraryPlaylist = self
+        self.Tracks = self
+
+    def __iter__(self):
+        return iter(self.tracks.values())
+
+    def ItemByName(self, name):
+        return self.playlists.get(name)
+
+    def ItemByPersistentID(self, high, low):
+        return self.tracks.get((high, low))
+
+    def Search(self, text, field):
+        return [track for track in self.tracks.values() if text in track.Album] or None
+
+class TestBatchFixer(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.tracks = {}
+        for n in range(1, 4):
+            self.tracks[(0, n)] = FakeItunesTrack(Name = 'track %s' % n, Artist = 'Daft Punk',
+                                                  AlbumArtist = None, Album = 'Homework',
+                                                  TrackNumber = n, DiscNumber = 1)
+        self.tracks[(-1, 9)] = FakeItunesTrack(Name = 'Something Else', Artist = 'Other',
+                                               AlbumArtist = None, Album = 'Homework',
+                                               TrackNumber = 4, DiscNumber = 1)
+        playlist = FakeITunes(dict((n, self.tracks[(0, n)]) for n in (3, 1, 2)), {})
+        itunes = FakeITunes(self.tracks, {'Homework': playlist})
+        api = DiscogsAPI(StaticTransport({('release', 1): make_release(),
+                                          ('artist', 'Daft Punk'): {'name': 'Daft Punk'}}),
+                         rate = None)
+        self.log_file = os.path.join(self.temp_dir, 'results.jsonl')
+        self.fixer = BatchFixer(itunes, api, RealName(cache = PersistentCache(':memory:'), api = api),
+                                log_file = self.log_file)
+
+    def jobs(self, *lines):
+        path = os.path.join(self.temp_dir, 'jobs.txt')
+        f = open(path, 'wb')
+        f.write('\n'.join(lines))
+        f.close()
+        return read_jobs(path)
+
+    def test_read_jobs(self):
+        jobs = self.jobs('# comment', '', '{"release": 1, "playlist": "Homework"}',
+                         '{"album": "Homework", "artist": "Daft Punk", "min_confidence": 0.9}')
+        self.assertEqual([3, 4], [job.line for job in jobs])
+        self.assertEqual(None, jobs[1].release_id)
+        self.assertRaises(ValueError, self.jobs, '{"release": 1}')
+        self.assertRaises(ValueError, self.jobs, '{"playlist": "a", "album": "b"}')
+        self.assertRaises(ValueError, self.jobs, '{"persistent_ids": ["xyz"]}')
+
+    def test_split_persistent_id(self):
+        self.assertEqual((0, 1), split_persistent_id('0000000000000001'))
+        self.assertEqual((-1, 9), split_persistent_id('FFFFFFFF00000009'))
+
+    def test_writes_confident_job(self):
+        log = self.fixer.run(self.jobs('{"release": 1, "playlist": "Homework"}'))
+        self.assertEqual({'written': 1}, log.counts())
+        self.assertEqual(['Track 1', 'Track 2', 'Track 3'],
+                         [self.tracks[(0, n)].Name for n in range(1, 4)])
+        result = json.loads(open(self.log_file).read())
+        self.assertEqual(1, result['release'])
+        self.assertEqual(3, result['confident'])
+
+    def test_low_confidence_needs_review(self):
+        jobs = self.jobs('{"release": 1, "persistent_ids": ["1", "2", "FFFFFFFF00000009"]}')
+        self.assertEqual({'review': 1}, self.fixer.run(jobs).counts())
+        self.assertEqual('track 1', self.tracks[(0, 1)].Name)
+
+        self.fixer.partial = True
+        self.assertEqual(['review', 'partial'],
+                         [result['status'] for result in self.fixer.run(jobs).results])
+        self.assertEqual('Track 1', self.tracks[(0, 1)].Name)
+        self.assertEqual('Something Else', self.tracks[(-1, 9)].Name)
+
+    def test_finder_built_once(self):
+        built = []
+        from_store = ReleaseIndex.__dict__['from_store']
+        def slow_from_store(cls, store):
+            built.append(store)
+            time.sleep(0.05)
+            return from_store.__get__(None, cls)(store)
+        self.fixer.api.store = PayloadStore(':memory:')
+        ReleaseIndex.from_store = classmethod(slow_from_store)
+        try:
+            finders = WorkerPool(workers = 4).map(lambda n: self.fixer.finder, range(4))
+        finally:
+            ReleaseIndex.from_store = from_store
+        self.assertEqual(1, len(built))
+        self.assertEqual(1, len(set(map(id, finders))))
+
+    def test_release_that_keeps_failing_fails_its_job(self):
+        class DownTransport(StaticTransport):
+            def fetch(self, kind, key):
+                if kind == 'artist':
+                    raise ConnectionError()
+                return StaticTransport.fetch(self, kind, key)
+
+        api = DiscogsAPI(DownTransport({('release', 1): make_release()}),
+                         rate = None, retries = 0)
+        fixer = BatchFixer(self.fixer.iTunes, api,
+                           RealName(cache = PersistentCache(':memory:'), api = api),
+                           attempts = 2, retry_delay = 0)
+        results = fixer.run(self.jobs('{"release": 1, "playlist": "Homework"}')).results
+        self.assertEqual('failed', results[0]['status'])
+        self.assertTrue(results[0]['error'].startswith('resolve names'))
+
+    def test_failures_are_logged(self):
+        jobs = self.jobs('{"release": 1, "playlist": "Missing"}',
+                         '{"release": 2, "album": "Homework", "artist": "Daft Punk"}')
+        results = self.fixer.run(jobs).results
+        self.assertEqual(['failed', 'failed'], [result['status'] for result in results])
+        self.assertTrue(results[0]['error'].startswith('select'))
+        self.assertTrue(results[1]['error'].startswith('fetch'))
+        self.assertEqual(2, len(open(self.log_file).readlines()))
+
+class TestPayloadStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = PayloadStore(':memory:')
+
+    def test_put_get(self):
+        self.store.put('release', 1, {'id': 1}, 'etag')
+        data, etag, fetched = self.store.get('release', 1)
+        self.assertEqual(({'id': 1}, 'etag'), (data, etag))
+        self.assertTrue(self.store.is_fresh(fetched))
+
+    def test_same_content_stored_once(self):
+        self.store.put('release', 1, {'title': 'Same'})
+        self.store.put('release', 2, {'title': 'Same'})
+        count = self.store.db.execute('SELECT COUNT(*) FROM payloads').fetchone()[0]
+        self.assertEqual(1, count)
+
+    def test_prune(self):
+        self.store.put('master', 1, {'year': 1997})
+        self.store.put('master', 1, {'year': 1998})
+        self.store.prune()
+        count = self.store.db.execute('SELECT COUNT(*) FROM payloads').fetchone()[0]
+        self.assertEqual(1, count)
+        self.assertEqual({'year': 1998}, self.store.get('master', 1)[0])
+
+class TestDiscogsAPIStore(unittest.TestCase):
+
+    def setUp(self):
+        self.fixture_dir = tempfile.mkdtemp()
+        recorder = DiscogsAPI(RecordingTransport(self.fixture_dir,
+            StaticTransport({('release', 1): {'id': 1}})))
+        recorder.release(1)
+        self.store = PayloadStore(':memory:')
+
+    def api(self, **options):
+        return DiscogsAPI(FixtureTransport(self.fixture_dir), rate = None,
+                          store = self.store, **options)
+
+    def test_fresh_payload_needs_no_request(self):
+        self.api().release(1)
+        api = self.api()
+        self.assertEqual({'id': 1}, api.release(1))
+        self.assertEqual(0, api.stats()['total_requests'])
+
+    def test_stale_payload_revalidated(self):
+        self.api().release(1)
+        self.store.max_age = -1
+        api = self.api()
+        self.assertEqual({'id': 1}, api.release(1))
+        self.assertEqual(1, api.stats()['revalidated'])
+
+    def test_offline(self):
+        self.api().release(1)
+        self.store.max_age = -1
+        api = self.api(offline = True)
+        self.assertEqual({'id': 1}, api.release(1))
+        self.assertRaises(ConnectionError, api.release, 2)
+        self.assertEqual(0, api.stats()['total_requests'])
@@ -0,0 +1,159 @@
+'''
+Created on Oct 18, 2026
+Author: George Lifchits
+
+A bounded pool of worker threads shared by everything that waits on Discogs,
+plus 'single-flight' deduplication so the same lookup is never running
+twice at the same time.
+'''
+
+import sys
+import threading
+import Queue
+
+
+class Future(object):
+    '''
+    The eventual result of a task submitted to a WorkerPool.
+    '''
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.exc_info = None
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def set_result(self, value):
+        self.value = value
+        self.finish()
+
+    def set_exception(self, exc_info):
+        self.exc_info = exc_info
+        self.finish()
+
+    def finish(self):
+        with self.lock:
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def done(self):
+        return self.event.is_set()
+
+    def result(self, timeout = None):
+        '''
+        Waits for the task and returns its value, re-raising its exception
+        if it failed.
+        '''
+        # Event.wait without a timeout can't be interrupted with Ctrl+C
+        while not self.event.wait(timeout if timeout is not None else 1):
+            if timeout is not None:
+                raise RuntimeError('timed out waiting for result')
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+
+class WorkerPool(object):
+    '''
+    At most :workers: threads, started as they are needed. Tasks submitted
+    from inside one of the pool's own threads run immediately in that thread
+    so that nested lookups can't deadlock a full pool.
+    '''
+
+    def __init__(self, workers = 8):
+        self.workers = workers
+        self.tasks = Queue.Queue()
+        self.threads = []
+        self.idle = 0
+        self.pending = 0 # submitted, not yet taken by a worker
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def submit(self, fn, *args):
+        future = Future()
+        if getattr(self.local, 'in_pool', False):
+            self.run(future, fn, args)
+            return future
+
+        with self.lock:
+            self.tasks.put((future, fn, args))
+            self.pending += 1
+            # one thread per queued task, unless enough are already waiting
+            if self.pending > self.idle and len(self.threads) < self.workers:
+                thread = threading.Thread(target = self.work)
+                thread.daemon = True
+                self.threads.append(thread)
+                thread.start()
+        return future
+
+    def map(self, fn, items):
+        '''
+        Like map(), but in parallel. Results are in the order of :items:
+        '''
+        futures = [self.submit(fn, item) for item in items]
+        return [future.result() for future in futures]
+
+    def run(self, future, fn, args):
+        try:
+            future.set_result(fn(*args))
+        except:
+            future.set_exception(sys.exc_info())
+
+    def work(self):
+        self.local.in_pool = True
+        while True:
+            with self.lock:
+                self.idle += 1
+            future, fn, args = self.tasks.get()
+            with self.lock:
+                self.idle -= 1
+                self.pending -= 1
+            self.run(future, fn, args)
+
+
+class SingleFlight(object):
+    '''
+    Submits tasks to a pool by key. While a task for a key is running, more
+    requests for the same key get the future of the running task instead of
+    starting another one.
+    '''
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    def submit(self, key, fn, *args):
+        with self.lock:
+            if key in self.in_flight:
+                return self.in_flight[key]
+            future = Future()
+            self.in_flight[key] = future
+
+        self.pool.submit(self.run, key, future, fn, args)
+        return future
+
+    def run(self, key, future, fn, args):
+        try:
+            value = fn(*args)
+        except:
+            exc_info = sys.exc_info()
+            self.land(key)
+            future.set_exception(exc_info)
+        else:
+            self.land(key)
+            future.set_result(value)
+
+    def land(self, key):
+        with self.lock:
+            del self.in_flight[key]